@@ -1,8 +1,25 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+import threading
+import time
+import numpy as np
 import Adafruit_ADS1x15
 import config
 import prt
 from generic_sensor import SensorBase
+from calibration import GasCalibration, gas_n_factors
+from i2c_arbiter import get_arbiter
+
+# (adc, channel, name) of every sampled input, W is the working and A the auxiliary electrode
+CHANNELS = (
+    ("a", 1, "CO_W"),
+    ("a", 0, "CO_A"),
+    ("a", 3, "NO_W"),
+    ("a", 2, "NO_A"),
+    ("b", 1, "NO2_W"),
+    ("b", 0, "NO2_A"),
+    ("b", 3, "O3_W"),
+    ("b", 2, "O3_A"),
+)
 
 
 class ADCHandler(SensorBase):
@@ -10,6 +27,7 @@ class ADCHandler(SensorBase):
         super().__init__()
         self.adc_a = Adafruit_ADS1x15.ADS1115(address=config.ADC_ADDRESS_A)
         self.adc_b = Adafruit_ADS1x15.ADS1115(address=config.ADC_ADDRESS_B)
+        self.i2c = get_arbiter()
         self.ADCGain = 2
         self.mVGain = 0.0625
 
@@ -22,11 +40,74 @@ class ADCHandler(SensorBase):
         #  -  16 = +/-0.256V
         # See table 3 in the ADS1015/ADS1115 datasheet for more info on gain.
 
-    def _raw_adc_to_ppb(self, w_raw: float, a_raw: float, cali: Dict[str, int], n: float) -> float:
-        """uses raw working and auxiliary adc values as well as a calibration dict to calculate ppb values"""
-        w = w_raw * self.mVGain
-        a = a_raw * self.mVGain
-        return ((w - cali["w0"]) - (n * (a - cali["a0"]))) / cali["sens"]
+        # ppb conversion and two point calibration of every gas, compiled once from the config dicts
+        self.gas_cali = {
+            "CO": GasCalibration(config.ADC_CALI_CO, self.mVGain),
+            "NO": GasCalibration(config.ADC_CALI_NO, self.mVGain),
+            "NO2": GasCalibration(config.ADC_CALI_NO2, self.mVGain),
+            "O3": GasCalibration(config.ADC_CALI_O3, self.mVGain),
+        }
+
+        # raw samples collected by the acquisition thread since the last get_data call
+        self.samples: Dict[str, List[int]] = {name: [] for _, _, name in CHANNELS}
+        # IIR filtered median of every channel in raw adc counts
+        self.filtered: Dict[str, Optional[float]] = {name: None for _, _, name in CHANNELS}
+        self.samples_lock = threading.Lock()
+        self.read_errors = 0
+        self.last_sample_count = 0
+        self.running = True
+
+        self.thread = threading.Thread(target=self._adc_worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _adc_worker(self) -> None:
+        # Round robin over all channels ADC_OVERSAMPLING times per second at the faster ADC_DATA_RATE
+        interval = 1 / config.ADC_OVERSAMPLING
+        adcs = {"a": self.adc_a, "b": self.adc_b}
+        next_round = time.monotonic()
+        while self.running:
+            try:
+                # every single conversion is its own bus transaction, so other sensors don't wait for a whole round
+                values = [
+                    (name, self.i2c.transaction("adc_" + adc, adcs[adc].read_adc, channel, gain=self.ADCGain,
+                                                data_rate=config.ADC_DATA_RATE))
+                    for adc, channel, name in CHANNELS
+                ]
+                with self.samples_lock:
+                    for name, value in values:
+                        self.samples[name].append(value)
+                self._set_ready()
+            except OSError:
+                self.read_errors += 1
+                time.sleep(0.5)
+            next_round += interval
+            delay = next_round - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # we can't keep up, don't try to catch up with a burst of reads
+                next_round = time.monotonic()
+
+    def _filter_samples(self) -> Optional[Dict[str, float]]:
+        """Median of every channel since the last call smoothed by a first order IIR filter, plus the noise in mV"""
+        with self.samples_lock:
+            samples = self.samples
+            self.samples = {name: [] for _, _, name in CHANNELS}
+        if any(len(values) == 0 for values in samples.values()):
+            return None
+        self.last_sample_count = len(samples[CHANNELS[0][2]])
+        ret = {}
+        for name, values in samples.items():
+            values = np.asarray(values, dtype=np.float64)
+            median = float(np.median(values))
+            previous = self.filtered[name]
+            alpha = config.ADC_IIR_ALPHA
+            self.filtered[name] = median if previous is None else alpha * median + (1 - alpha) * previous
+            ret[name] = self.filtered[name]
+            # standard deviation of the raw samples within this second
+            ret[name + "_NOISE"] = float(np.std(values)) * self.mVGain
+        return ret
 
     def _raw_adc_to_mv(self, adc_raw: float) -> float:
         return round(adc_raw * self.mVGain, config.DIGIT_ACCURACY)
@@ -35,66 +116,31 @@ class ADCHandler(SensorBase):
         # The calibration has been done at 20 °C, use it as default
         # Could also be dynamically set by sht_temp
         # Calculate n factors from the temperature
-        n_co = -1 if temp < 25 else -3.8
-        n_no = 1.04 if temp < 15 else (1.82 if temp < 25 else 2)
-        n_no2 = 0.76 if temp < 15 else (0.68 if temp < 25 else 0.23)
-        n_o3 = 0.77 if temp < 5 else (1.56 if temp < 35 else 2.85)
-
-        try:
-            values_adc_a = [0] * 4
-            values_adc_b = [0] * 4
+        n = gas_n_factors(temp)
 
-            for i in range(4):
-                values_adc_a[i] = self.adc_a.read_adc(i, gain=self.ADCGain)
-                values_adc_b[i] = self.adc_b.read_adc(i, gain=self.ADCGain)
-
-            # print("Raw values:",values_adc_a, values_adc_b)
-            # print("Voltages:", [round(x * self.mVGain/1000, 3) for x in (values_adc_a + values_adc_b)])
-
-            # calculate gas values from raw adc values
-            ppb_co = self._raw_adc_to_ppb(values_adc_a[1], values_adc_a[0], config.ADC_CALI_CO, n_co)
-            ppb_no = self._raw_adc_to_ppb(values_adc_a[3], values_adc_a[2], config.ADC_CALI_NO, n_no)
-            ppb_no2 = self._raw_adc_to_ppb(values_adc_b[1], values_adc_b[0], config.ADC_CALI_NO2, n_no2)
-            ppb_o3 = self._raw_adc_to_ppb(values_adc_b[3], values_adc_b[2], config.ADC_CALI_O3, n_o3)
-
-            # Apply two point calibration
-            ppb_co = self._calibrate(ppb_co, config.ADC_CALI_CO)
-            ppb_no = self._calibrate(ppb_no, config.ADC_CALI_NO)
-            ppb_no2 = self._calibrate(ppb_no2, config.ADC_CALI_NO2)
-            ppb_o3 = self._calibrate(ppb_o3, config.ADC_CALI_O3)
+        # The acquisition thread reads the adcs, here we only filter what it collected during the last second
+        values = self._filter_samples()
+        if values is None:
+            prt.GLOBAL_ENTITY.print_once("ADC disconnected", "ADC back online")
+            ret = {"CO": None, "NO": None, "NO2": None, "O3": None}
+            ret.update({"RAW_ADC_" + name: None for _, _, name in CHANNELS})
+            ret.update({"RAW_ADC_" + name + "_NOISE": None for _, _, name in CHANNELS})
+            return ret
 
-            return {
-                "CO": ppb_co,
-                "NO": ppb_no,
-                "NO2": ppb_no2,
-                "O3": ppb_o3,
-                "RAW_ADC_CO_W": self._raw_adc_to_mv(values_adc_a[1]),
-                "RAW_ADC_CO_A": self._raw_adc_to_mv(values_adc_a[0]),
-                "RAW_ADC_NO_W": self._raw_adc_to_mv(values_adc_a[3]),
-                "RAW_ADC_NO_A": self._raw_adc_to_mv(values_adc_a[2]),
-                "RAW_ADC_NO2_W": self._raw_adc_to_mv(values_adc_b[1]),
-                "RAW_ADC_NO2_A": self._raw_adc_to_mv(values_adc_b[0]),
-                "RAW_ADC_O3_W": self._raw_adc_to_mv(values_adc_b[3]),
-                "RAW_ADC_O3_A": self._raw_adc_to_mv(values_adc_b[2]),
-            }
+        # calculate gas values from raw adc values and apply two point calibration
+        ret = {gas: cali(values[gas + "_W"], values[gas + "_A"], n[gas]) for gas, cali in self.gas_cali.items()}
+        ret.update({"RAW_ADC_" + name: self._raw_adc_to_mv(values[name]) for _, _, name in CHANNELS})
+        ret.update({
+            "RAW_ADC_" + name + "_NOISE": round(values[name + "_NOISE"], config.DIGIT_ACCURACY)
+            for _, _, name in CHANNELS
+        })
+        return ret
 
-        except OSError:
-            prt.GLOBAL_ENTITY.print_once("ADC disconnected", "ADC back online")
-            return {
-                "CO": None,
-                "NO": None,
-                "NO2": None,
-                "O3": None,
-                "RAW_ADC_CO_W": None,
-                "RAW_ADC_CO_A": None,
-                "RAW_ADC_NO_W": None,
-                "RAW_ADC_NO_A": None,
-                "RAW_ADC_NO2_W": None,
-                "RAW_ADC_NO2_A": None,
-                "RAW_ADC_O3_W": None,
-                "RAW_ADC_O3_A": None,
-            }
+    def get_telemetry(self) -> Dict[str, int]:
+        return {"adc_samples": self.last_sample_count, "adc_errors": self.read_errors}
 
     def stop(self) -> None:
-        self.adc_a.stop_adc()
-        self.adc_b.stop_adc()
+        self.running = False
+        self.thread.join(timeout=1)
+        self.i2c.transaction("adc_a", self.adc_a.stop_adc)
+        self.i2c.transaction("adc_b", self.adc_b.stop_adc)
@@ -0,0 +1,29 @@
+from typing import List, Dict, Optional
+import pandas as pd
+import config
+import prt
+
+
+def calculate_mean_data(collected_data: List[Dict[str, float]], digits: Optional[int] = None) -> Optional[Dict[str, float]]:
+    """Averages a list of per second sensor data dicts, missing (None) values are skipped"""
+    try:
+        frame = pd.DataFrame(collected_data)
+    except ValueError as e:
+        prt.GLOBAL_ENTITY.error(f"Averaging minute data failed, skipping this minute. Error dump: {e}")
+        return None
+    return calculate_mean_frame(frame, digits)
+
+
+def calculate_mean_frame(frame: pd.DataFrame, digits: Optional[int] = None) -> Optional[Dict[str, float]]:
+    """Same as calculate_mean_data for data that already is a DataFrame, e.g. a chunk of a raw log file"""
+    digits = config.DIGIT_ACCURACY if digits is None else digits
+    try:
+        ret = frame.mean().fillna(0).to_dict()
+    except (ValueError, TypeError) as e:
+        prt.GLOBAL_ENTITY.error(f"Averaging minute data failed, skipping this minute. Error dump: {e}")
+        return None
+    # Make sure lat/lon coordinates have 6 decimal digits while the rest has the configured amount
+    return {
+        key: round(val, digits if key not in ["lat", "lon"] else 6)
+        for key, val in ret.items()
+    }
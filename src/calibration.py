@@ -0,0 +1,104 @@
+from typing import Dict, Any, Optional, Union
+from types import ModuleType
+import numpy as np
+import config
+
+# Calibrations are compiled once from the config dicts into slope/offset form.
+# Every call then only costs a multiplication and an addition, and the same objects
+# can be applied to whole numpy arrays to reprocess logged raw data.
+
+ArrayLike = Union[float, np.ndarray]
+
+
+class TwoPointCalibration:
+    """Compiled form of a {"raw_low", "raw_high", "ref_low", "ref_high"} two point calibration dict"""
+    __slots__ = ("slope", "offset", "digits")
+
+    def __init__(self, slope: float, offset: float, digits: Optional[int] = None) -> None:
+        """
+        :slope: reference units per raw unit
+        :offset: reference value at a raw value of 0
+        :digits: to how many decimal digits results are rounded, defaults to config.DIGIT_ACCURACY
+        """
+        self.slope = slope
+        self.offset = offset
+        self.digits = config.DIGIT_ACCURACY if digits is None else digits
+
+    @classmethod
+    def from_dict(cls, cali: Dict[str, Any], digits: Optional[int] = None) -> "TwoPointCalibration":
+        slope = (cali["ref_high"] - cali["ref_low"]) / (cali["raw_high"] - cali["raw_low"])
+        return cls(slope, cali["ref_low"] - cali["raw_low"] * slope, digits)
+
+    def __call__(self, raw: float) -> float:
+        return round(raw * self.slope + self.offset, self.digits)
+
+    def apply_batch(self, raw: ArrayLike) -> np.ndarray:
+        return np.round(np.asarray(raw, dtype=np.float64) * self.slope + self.offset, self.digits)
+
+    def inverse(self) -> "TwoPointCalibration":
+        """The calibration that turns calibrated values back into raw values, used to re-calibrate logged data"""
+        return TwoPointCalibration(1 / self.slope, -self.offset / self.slope, self.digits)
+
+    def __repr__(self) -> str:
+        return f"TwoPointCalibration(slope={self.slope}, offset={self.offset})"
+
+
+class GasCalibration:
+    """
+    Compiled Alphasense ISB conversion from working and auxiliary electrode voltages to ppb,
+    followed by the two point calibration stored in the same config dict
+    """
+    __slots__ = ("w0", "a0", "inverse_sens", "mv_gain", "two_point")
+
+    def __init__(self, cali: Dict[str, Any], mv_gain: float = 1, digits: Optional[int] = None) -> None:
+        """
+        :cali: ADC_CALI_* dict with w0, a0 and sens as well as the two point calibration
+        :mv_gain: mV per raw adc count, 1 if the inputs are already in mV
+        """
+        self.w0 = cali["w0"]
+        self.a0 = cali["a0"]
+        self.inverse_sens = 1 / cali["sens"]
+        self.mv_gain = mv_gain
+        self.two_point = TwoPointCalibration.from_dict(cali, digits)
+
+    def to_ppb(self, w_raw: ArrayLike, a_raw: ArrayLike, n: float) -> ArrayLike:
+        """uncalibrated ppb from raw working and auxiliary values, n is the temperature dependent correction factor"""
+        w = w_raw * self.mv_gain
+        a = a_raw * self.mv_gain
+        return ((w - self.w0) - (n * (a - self.a0))) * self.inverse_sens
+
+    def __call__(self, w_raw: float, a_raw: float, n: float) -> float:
+        return self.two_point(self.to_ppb(w_raw, a_raw, n))
+
+    def apply_batch(self, w_raw: ArrayLike, a_raw: ArrayLike, n: ArrayLike) -> np.ndarray:
+        w_raw = np.asarray(w_raw, dtype=np.float64)
+        a_raw = np.asarray(a_raw, dtype=np.float64)
+        return self.two_point.apply_batch(self.to_ppb(w_raw, a_raw, np.asarray(n, dtype=np.float64)))
+
+
+def gas_n_factors(temp: float) -> Dict[str, float]:
+    """Temperature dependent auxiliary electrode correction factors of the Alphasense ISBs"""
+    return {
+        "CO": -1 if temp < 25 else -3.8,
+        "NO": 1.04 if temp < 15 else (1.82 if temp < 25 else 2),
+        "NO2": 0.76 if temp < 15 else (0.68 if temp < 25 else 0.23),
+        "O3": 0.77 if temp < 5 else (1.56 if temp < 35 else 2.85),
+    }
+
+
+def compile_calibrations(cfg: ModuleType = config, adc_mv_gain: float = 1) -> Dict[str, Any]:
+    """
+    Compiles every *_CALI_* and *_CALI entry of a config module, so logged raw data can be reprocessed with
+    the calibration parameters of any config file.
+    :adc_mv_gain: mV per raw adc count for the gas calibrations, 1 for logged RAW_ADC_* mV values
+    """
+    ret = {}
+    for name in dir(cfg):
+        if "_CALI_" not in name and not name.endswith("_CALI"):
+            continue
+        cali = getattr(cfg, name)
+        if name.startswith("ADC_CALI_"):
+            ret[name] = GasCalibration(cali, mv_gain=adc_mv_gain, digits=cfg.DIGIT_ACCURACY)
+        else:
+            ret[name] = TwoPointCalibration.from_dict(cali, digits=cfg.DIGIT_ACCURACY)
+    return ret
@@ -6,10 +6,18 @@ try:
     NODE_ID = os.environ['RESIN_DEVICE_NAME_AT_INIT']
     DIGIT_ACCURACY = int(os.environ['DIGIT_ACCURACY'])  # To how many decimal digits should the sensor values be rounded
     PUBLISH_RAW_OPC_AND_ADC = os.environ['PUBLISH_RAW_OPC_AND_ADC'] in 'True'
+    STARTUP_READY_TIMEOUT = float(os.environ.get('STARTUP_READY_TIMEOUT', '30'))  # Max seconds to wait for the first valid sample of every sensor before sampling starts
+    IO_PROCESS_ENABLE = os.environ.get('IO_PROCESS_ENABLE', 'False') in 'True'  # Average, log and publish in a separate process fed through shared memory, the OLED then always shows raw data
+    IO_PROCESS_RING_SLOTS = int(os.environ.get('IO_PROCESS_RING_SLOTS', '600'))  # Seconds of samples the io process may fall behind before they are lost
+    LIVE_FEED_ENABLE = os.environ.get('LIVE_FEED_ENABLE', 'False') in 'True'  # Share the latest samples with other containers through a memory mapped file, see live_feed.py
+    LIVE_FEED_PATH = os.environ.get('LIVE_FEED_PATH', '/dev/shm/live_feed.ring')  # Keep it on tmpfs, /data is the SD card and writeback would flush the pages every 30 s. Readers in other containers need a shared tmpfs, e.g. ipc: shareable / ipc: container
+    LIVE_FEED_SLOTS = int(os.environ.get('LIVE_FEED_SLOTS', '300'))  # Seconds of history kept in the live feed
 
     # Watchdog settings
     INTERNET_WATCHDOG_ENABLE = os.environ['INTERNET_WATCHDOG_ENABLE'] in 'True'
-    INTERNET_WATCHDOG_INTERVAL = int(os.environ['INTERNET_WATCHDOG_INTERVAL'])  # in seconds
+    INTERNET_WATCHDOG_INTERVAL = int(os.environ['INTERNET_WATCHDOG_INTERVAL'])  # in seconds without connection before the first escalation step
+    INTERNET_WATCHDOG_CHECK_INTERVAL = int(os.environ.get('INTERNET_WATCHDOG_CHECK_INTERVAL', '60'))  # Seconds between connection checks, mostly passive
+    INTERNET_WATCHDOG_MAX_BACKOFF = int(os.environ.get('INTERNET_WATCHDOG_MAX_BACKOFF', '14400'))  # Max seconds between escalation steps
     INTERNET_WATCHDOG_MODEM_POWER_PIN = int(os.environ['INTERNET_WATCHDOG_MODEM_POWER_PIN'])  # Pin which can switch modem power
 
     # Logging settings
@@ -31,42 +39,88 @@ try:
     MQTT_PASS = os.environ['MQTT_PASS']
     MQTT_PUBLISH_EVERY_SECOND = os.environ['MQTT_PUBLISH_EVERY_SECOND'] in 'True'
 
+    # EVENT LOG SETTINGS
+    EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', '500'))  # Events kept in memory
+    EVENT_RATE_LIMIT = float(os.environ.get('EVENT_RATE_LIMIT', '10'))  # Seconds between two printed events of the same kind, repeats in between are counted
+
     # GPS settings
     GPS_POLL_ENABLE = os.environ['GPS_POLL_ENABLE'] in 'True'
-    GPS_POLL_USE_DBUS = os.environ['GPS_POLL_USE_DBUS'] in 'True'  # Use DBUS to get GPS data, if false mmcli for SIM7600 is used
+    GPS_POLL_USE_DBUS = os.environ['GPS_POLL_USE_DBUS'] in 'True'  # Use the ModemManager location api to get GPS data, if false SIM7600 AT commands are sent through ModemManager
+    GPS_POLL_INTERVAL = float(os.environ.get('GPS_POLL_INTERVAL', '1'))  # Seconds between GPS updates, polling interval of the SIM7600 backend and gps refresh rate of the DBUS backend, which only supports whole seconds
+    GPS_LOCK_ENABLE = os.environ.get('GPS_LOCK_ENABLE', 'False') in 'True'  # Lock the averaged position of stationary nodes and check GPS only rarely
+    GPS_LOCK_WINDOW = float(os.environ.get('GPS_LOCK_WINDOW', '600'))  # Seconds of fixes that have to be stable before the position is locked
+    GPS_LOCK_MAX_SPREAD = float(os.environ.get('GPS_LOCK_MAX_SPREAD', '10'))  # Max standard deviation of the fixes in meters to lock the position
+    GPS_LOCK_MOVE_DISTANCE = float(os.environ.get('GPS_LOCK_MOVE_DISTANCE', '50'))  # A fix further than this many meters from the locked position unlocks it
+    GPS_LOCK_CHECK_INTERVAL = float(os.environ.get('GPS_LOCK_CHECK_INTERVAL', '3600'))  # Seconds between checks of the locked position
+    GPS_LOCK_CHECK_TIMEOUT = float(os.environ.get('GPS_LOCK_CHECK_TIMEOUT', '300'))  # Seconds a check may take to get a fix before the position is unlocked
+    GPS_LOCK_POWER_DOWN = os.environ.get('GPS_LOCK_POWER_DOWN', 'True') in 'True'  # Power the GNSS engine down while the position is locked
 
     # HARDWARE SETTINGS
     HEATER_ENABLE = os.environ['HEATER_ENABLE'] in 'True'  # This should only be enabled if an opc is used
     HEATER_PIN = int(os.environ['HEATER_PIN'])
+    HEATER_PWM_BACKEND = os.environ.get('HEATER_PWM_BACKEND', 'rpi_gpio')  # rpi_gpio for software pwm on HEATER_PIN, sysfs for hardware pwm (needs the pwm dtoverlay), fake to run without heater
+    HEATER_PWM_FREQUENCY = float(os.environ.get('HEATER_PWM_FREQUENCY', '50'))  # Heater pwm frequency in Hz
+    HEATER_PWM_CHIP = int(os.environ.get('HEATER_PWM_CHIP', '0'))  # sysfs backend: /sys/class/pwm/pwmchipN
+    HEATER_PWM_CHANNEL = int(os.environ.get('HEATER_PWM_CHANNEL', '0'))  # sysfs backend: pwm channel, 0 is GPIO18 (HEATER_PIN 12)
     HEATER_DEBUG = os.environ['HEATER_DEBUG'] in 'True'  # Enable heater debug messages
     HEATER_PID_TEMP_TUNING = literal_eval(os.environ.get("HEATER_PID_TEMP_TUNING"))
     HEATER_MIN_TEMP = int(os.environ['HEATER_MIN_TEMP'])  # Minimum temperature to always keep, even below 50% ambient humidity. Keeps Electronics warm and dry (-100) to disable
     HEATER_MAX_POWER = int(os.environ['HEATER_MAX_POWER'])  # Maximum power in % the heater pid is allowed to use, 100% -> no restrictions
+    HEATER_CONTROL_RATE = float(os.environ.get('HEATER_CONTROL_RATE', '4'))  # Heater control loop rate in Hz, runs independent of the 1 Hz sensor readout
+    HEATER_TEMP_MAX_AGE = float(os.environ.get('HEATER_TEMP_MAX_AGE', '3'))  # Heater is disabled if the newest heater temperature is older than this many seconds
+    HEATER_INPUT_MAX_AGE = float(os.environ.get('HEATER_INPUT_MAX_AGE', '5'))  # Heater is disabled if humidity and opc temperature are older than this many seconds
 
 
     HEATER_PID_AUTOTUNER_ENABLE = os.environ['HEATER_PID_AUTOTUNER_ENABLE'] in 'True'  # This runs a PID Autotuning sequence if enabled, disable this for normal operation
     HEATER_PID_AUTOTUNER_CALIBRATION_TEMPERATURE = float(os.environ['HEATER_PID_AUTOTUNER_CALIBRATION_TEMPERATURE'])  # This is the temperature at which te autotuning will be done, This temperature should be where the controller will be run at most of the time
     HEATER_PID_AUTOTUNER_RELAY_HYSTERESIS_DELTA = float(os.environ['HEATER_PID_AUTOTUNER_RELAY_HYSTERESIS_DELTA'])  # delta for the oscillation amplitude, lower values yield more aggressive less robust control parameters
+    HEATER_PID_USE_AUTOTUNED_TUNING = os.environ.get('HEATER_PID_USE_AUTOTUNED_TUNING', 'True') in 'True'  # Use the saved autotune result instead of HEATER_PID_TEMP_TUNING if there is one
+    HEATER_STATE_FILE = os.environ.get('HEATER_STATE_FILE', '/data/heater_state.json')  # Autotune result and PID state are saved here for warm restarts, empty to disable
+    HEATER_STATE_SAVE_INTERVAL = int(os.environ.get('HEATER_STATE_SAVE_INTERVAL', '60'))  # Seconds between heater state checkpoints
+    HEATER_STATE_MAX_AGE = int(os.environ.get('HEATER_STATE_MAX_AGE', '900'))  # A saved PID integral older than this many seconds is not restored
+    HEATER_TUNING_MAX_AGE = int(os.environ.get('HEATER_TUNING_MAX_AGE', '365'))  # A saved autotune result older than this many days is not used, 0 to keep it forever
 
     # Oled settings
     OLED_ENABLE = os.environ['OLED_ENABLE'] in 'True'
     OLED_ADDRESS = int(os.environ['OLED_ADDRESS'], 16)
     OLED_PORT = int(os.environ['OLED_PORT'])
     OLED_RAW = os.environ['OLED_RAW'] in 'True'  # display raw data every second if true or use average data every minute if false
+    OLED_MAX_FPS = float(os.environ.get('OLED_MAX_FPS', '2'))  # Upper limit of display updates per second, only changed parts are sent
+    OLED_PAGE_INTERVAL = float(os.environ.get('OLED_PAGE_INTERVAL', '4'))  # Seconds every page of 5 lines is shown before switching to the next one
 
     # SENSOR SETTINGS
     # Note: to use the ADC gas sensors you must have the SHT enabled because the outside temperature is required
     # {"raw_low": 0, "raw_high": 1, "ref_low": 0, "ref_high": 1} disables the two point calibration
 
+    # I2C settings
+    I2C_RETRIES = int(os.environ.get('I2C_RETRIES', '2'))  # How often a failed i2c transaction is repeated before the sensor counts as disconnected
+    I2C_BACKOFF = float(os.environ.get('I2C_BACKOFF', '0.005'))  # First delay in seconds before repeating a failed i2c transaction, doubled on every retry
+
     # OPC settings
     OPC_ENABLE = os.environ['OPC_ENABLE'] in 'True'
     OPC_CALI_TEMP = literal_eval(os.environ.get("OPC_CALI_TEMP"))
     OPC_CALI_HUMID = literal_eval(os.environ.get("OPC_CALI_HUMID"))
+    OPC_COMMAND_TIMEOUT = float(os.environ.get('OPC_COMMAND_TIMEOUT', '10'))  # Seconds a fan/laser command handshake may take before the OPC is considered unresponsive
+    OPC_RECONNECT_BACKOFF_MIN = float(os.environ.get('OPC_RECONNECT_BACKOFF_MIN', '1'))  # First reconnection delay in seconds, doubled on every failed attempt
+    OPC_RECONNECT_BACKOFF_MAX = float(os.environ.get('OPC_RECONNECT_BACKOFF_MAX', '60'))  # Upper bound for the reconnection delay in seconds
+    OPC_SPI_RESET_ATTEMPTS = int(os.environ.get('OPC_SPI_RESET_ATTEMPTS', '3'))  # SPI resets to try before power cycling fan and laser
+    OPC_PSD_ENABLE = os.environ.get('OPC_PSD_ENABLE', 'True') in 'True'  # Derive number concentration, dN/dlogDp and mass per bin from summed minute histograms
+    OPC_PSD_DENSITY = float(os.environ.get('OPC_PSD_DENSITY', '1.65'))  # Particle density in g/cm³ used for the per bin mass
+    OPC_DUTY_CYCLE_ENABLE = os.environ.get('OPC_DUTY_CYCLE_ENABLE', 'False') in 'True'  # Only run fan and laser for OPC_DUTY_CYCLE_ON_TIME out of every OPC_DUTY_CYCLE_PERIOD seconds
+    OPC_DUTY_CYCLE_PERIOD = float(os.environ.get('OPC_DUTY_CYCLE_PERIOD', '60'))  # in seconds
+    OPC_DUTY_CYCLE_ON_TIME = float(os.environ.get('OPC_DUTY_CYCLE_ON_TIME', '20'))  # in seconds, includes the warm-up time
+    OPC_DUTY_CYCLE_WARMUP = float(os.environ.get('OPC_DUTY_CYCLE_WARMUP', '5'))  # in seconds, histograms after switching on are discarded for this long
+    OPC_DUTY_CYCLE_SAVED_POWER = float(os.environ.get('OPC_DUTY_CYCLE_SAVED_POWER', '0.9'))  # Power in W saved while fan and laser are off, used for the energy saved telemetry
 
     # SHT31 settings
     SHT_ENABLE = os.environ['SHT_ENABLE'] in 'True'
     SHT_ADDRESS = int(os.environ['SHT_ADDRESS'], 16)
     SHT_HEATER_ENABLE = os.environ['SHT_HEATER_ENABLE'] in 'True'  # The SHT30 has an internal heater to remove condensation, redo calibration if changed
+    SHT_MODE = os.environ.get('SHT_MODE', 'single')  # single: one blocking measurement per second, periodic: the SHT measures on its own and results are fetched
+    SHT_PERIODIC_MPS = os.environ.get('SHT_PERIODIC_MPS', '1')  # periodic mode measurements per second: 0.5, 1, 2, 4, 10 or art (accelerated response time, 4 per second)
+    SHT_HEATER_INTERVAL = float(os.environ.get('SHT_HEATER_INTERVAL', '20'))  # periodic mode: seconds between heater cycles
+    SHT_HEATER_DURATION = float(os.environ.get('SHT_HEATER_DURATION', '1'))  # periodic mode: seconds the heater is on per cycle
+    SHT_HEATER_SETTLE = float(os.environ.get('SHT_HEATER_SETTLE', '5'))  # periodic mode: seconds after heating in which samples are discarded and RAW_SHT_HEATED is set
     SHT_CALI_TEMP = literal_eval(os.environ.get("SHT_CALI_TEMP"))
     SHT_CALI_HUMID = literal_eval(os.environ.get("SHT_CALI_HUMID"))
 
@@ -75,6 +129,7 @@ try:
     ONE_WIRE_DS_ID = os.environ['ONE_WIRE_DS_ID']  # Address string like 01145c262cc5 if multiple sensors are used, use "auto" to autodetect
     ONE_WIRE_DS_RESOLUTION = int(os.environ['ONE_WIRE_DS_RESOLUTION']) # 12bit -> 800ms, 11bit -> 400ms, 10 bit -> 200ms, 9bit -> 100ms conversion time, 0 to use default
     ONE_WIRE_DS_CALI = literal_eval(os.environ.get("ONE_WIRE_DS_CALI"))
+    ONE_WIRE_ROLES = literal_eval(os.environ.get('ONE_WIRE_ROLES', '{}')) or {"heater_temp": ONE_WIRE_DS_ID, "air_temp": "auto"}  # data key -> sensor address like {"heater_temp": "01145c262cc5", "air_temp": "0d4c0f496ba6"}, "auto" takes any unused sensor and is left out if there is none, defaults to the heater sensor and air_temp from a second sensor
 
     # HYT sensor settings
     HYT_ENABLE = os.environ['HYT_ENABLE'] in 'True'
@@ -87,6 +142,9 @@ try:
 
     ADC_ADDRESS_A = int(os.environ['ADC_ADDRESS_A'], 16)
     ADC_ADDRESS_B = int(os.environ['ADC_ADDRESS_B'], 16)
+    ADC_DATA_RATE = int(os.environ.get('ADC_DATA_RATE', '475'))  # ADS1115 samples per second: 8, 16, 32, 64, 128, 250, 475 or 860
+    ADC_OVERSAMPLING = int(os.environ.get('ADC_OVERSAMPLING', '10'))  # How often every channel is sampled per second, the median is used
+    ADC_IIR_ALPHA = float(os.environ.get('ADC_IIR_ALPHA', '0.5'))  # Weight of the newest median in the IIR filter, 1 disables filtering
 
     ADC_CALI_CO = literal_eval(os.environ.get("ADC_CALI_CO"))
     ADC_CALI_NO = literal_eval(os.environ.get("ADC_CALI_NO"))
@@ -0,0 +1,195 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import importlib
+import time
+import psutil
+import config
+import prt
+from io_process import get_io_status
+
+# Every sensor and actuator registers itself here with the config key that enables it.
+# Only enabled drivers are imported and started, so a node without an OLED never loads luma and so on.
+# Drivers are imported in registration order and then constructed all at once, a driver only waits for those it requires.
+# Registration order is the order in which get_data results are merged (the CSV column order),
+# drivers are stopped in reverse order, those with stop_first before all others.
+
+
+class Driver:
+    __slots__ = ("name", "module", "class_name", "enable_key", "enable_value", "data", "stop_first", "kwargs", "requires",
+                 "io")
+
+    def __init__(self, name: str, module: str, class_name: str, enable_key: Optional[str] = None,
+                 enable_value: bool = True, data: bool = False, stop_first: bool = False,
+                 kwargs: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None, requires: Tuple[str, ...] = (),
+                 io: bool = False) -> None:
+        """
+        :name: key of the started instance in the plugin dict, several drivers may share a name if only one is enabled
+        :enable_key: config key that enables the driver, None for drivers that always run
+        :enable_value: value of the config key that enables the driver
+        :data: get_data of the driver is merged into the per second data
+        :stop_first: stopped before every other driver, e.g. the heater
+        :kwargs: returns the constructor arguments given the already started plugins
+        :requires: names of earlier registered drivers that have to be constructed before this one, i.e. used in kwargs
+        :io: runs in the io process instead of the acquisition process if IO_PROCESS_ENABLE is set, see io_process.py
+        """
+        self.name = name
+        self.module = module
+        self.class_name = class_name
+        self.enable_key = enable_key
+        self.enable_value = enable_value
+        self.data = data
+        self.stop_first = stop_first
+        self.kwargs = kwargs
+        self.requires = requires
+        self.io = io
+
+    @property
+    def enabled(self) -> bool:
+        return self.enable_key is None or getattr(config, self.enable_key) == self.enable_value
+
+
+DRIVERS: List[Driver] = []
+
+
+def register(name: str, module: str, class_name: str, **kwargs) -> None:
+    DRIVERS.append(Driver(name, module, class_name, **kwargs))
+
+
+register("opc", "opc_handler", "OPCHandler", enable_key="OPC_ENABLE", data=True)
+register("sht", "sht_handler", "SHTHandler", enable_key="SHT_ENABLE", data=True)
+register("hyt", "hyt_handler", "HYTHandler", enable_key="HYT_ENABLE", data=True)
+register("adc", "adc_handler", "ADCHandler", enable_key="ADC_ENABLE", data=True)
+register("one_wire", "one_wire_handler", "OneWireHandler", enable_key="ONE_WIRE_ENABLE", data=True)
+# the control loop of the heater reads the 1-Wire sensor directly
+register("heater", "heating_controller", "HeatingController", enable_key="HEATER_ENABLE", data=True, stop_first=True,
+         kwargs=lambda plugins: {"one_wire_handler": plugins.get("one_wire")}, requires=("one_wire",))
+# gps and signal strength, the modem is always started because the watchdog and the timestamps need it
+register("modem", "modem_handler_dbus", "ModemHandlerDBus", enable_key="GPS_POLL_USE_DBUS", data=True)
+register("modem", "modem_handler", "ModemHandler", enable_key="GPS_POLL_USE_DBUS", enable_value=False, data=True)
+register("logging", "logging_controller", "LoggingController", io=True)
+register("mqtt", "mqtt_controller", "MQTTController", enable_key="MQTT_ENABLE", io=True)
+register("oled", "oled_controller", "OLEDController", enable_key="OLED_ENABLE")
+register("watchdog", "internet_watchdog", "InternetWatchdog", enable_key="INTERNET_WATCHDOG_ENABLE",
+         kwargs=lambda plugins: {"interval": config.INTERNET_WATCHDOG_INTERVAL, "modem_handler_instance": plugins.get("modem"),
+                                 "mqtt_instance": get_io_status() if config.IO_PROCESS_ENABLE else plugins.get("mqtt")},
+         requires=("modem", "mqtt"))
+
+
+class PluginCost:
+    __slots__ = ("import_time", "start_time", "ready_time", "rss")
+
+    def __init__(self, import_time: float, rss: int) -> None:
+        self.import_time = import_time
+        self.start_time = 0.
+        self.ready_time: Optional[float] = None  # from the start of the construction to the first valid sample
+        self.rss = rss  # RSS growth of the import, constructors run concurrently and can't be told apart
+
+
+class Plugins:
+    """The started drivers by name, with generic data, telemetry and stop loops"""
+    def __init__(self) -> None:
+        self.instances: Dict[str, Any] = {}
+        self.drivers: List[Driver] = []
+        self.costs: Dict[str, PluginCost] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        return self.instances[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.instances
+
+    def get(self, name: str) -> Any:
+        return self.instances.get(name)
+
+    def start_enabled(self, io: Optional[bool] = None) -> None:
+        """
+        Imports the enabled drivers one after the other, then constructs them concurrently.
+        A driver that fails to start is left out and logged, the node keeps running without it.
+        :io: only start the io drivers if True, only the others if False, all if None
+        """
+        enabled = [driver for driver in DRIVERS if driver.enabled and io in (None, driver.io)]
+        classes = {}
+        process = psutil.Process()
+        for driver in enabled:
+            rss_start = process.memory_info().rss
+            start = time.perf_counter()
+            try:
+                classes[driver.name] = getattr(importlib.import_module(driver.module), driver.class_name)
+            except Exception as e:
+                prt.GLOBAL_ENTITY.error(f"Failed to import {driver.name}, continuing without it, dump: {e}")
+                continue
+            self.costs[driver.name] = PluginCost(time.perf_counter() - start, process.memory_info().rss - rss_start)
+
+        started: Dict[str, Future] = {}
+        with ThreadPoolExecutor(max_workers=max(len(classes), 1), thread_name_prefix="driver_start") as executor:
+            for driver in enabled:
+                if driver.name in classes:
+                    started[driver.name] = executor.submit(self._construct, driver, classes[driver.name], started)
+        # keep the registration order, it is the CSV column order
+        self.drivers = [driver for driver in enabled if driver.name in self.instances]
+
+    def _construct(self, driver: Driver, cls: type, started: Dict[str, Future]) -> None:
+        for name in driver.requires:
+            if name in started:
+                started[name].result()
+        cost = self.costs[driver.name]
+        start = time.perf_counter()
+        try:
+            instance = cls(**(driver.kwargs(self.instances) if driver.kwargs is not None else {}))
+        except Exception as e:
+            prt.GLOBAL_ENTITY.error(f"Failed to start {driver.name}, continuing without it, dump: {e}")
+            return
+        cost.start_time = time.perf_counter() - start
+        ready = getattr(instance, "ready", None)
+        if ready is not None:
+            ready.add_done_callback(lambda _: setattr(cost, "ready_time", time.perf_counter() - start))
+        self.instances[driver.name] = instance
+
+    def wait_ready(self, timeout: float) -> List[str]:
+        """Waits up to timeout seconds for the first valid sample of every sensor, returns the sensors without one"""
+        readies = {driver.name: self.instances[driver.name].ready for driver in self.drivers
+                   if hasattr(self.instances[driver.name], "ready")}
+        wait(readies.values(), timeout=timeout)
+        return [name for name, ready in readies.items() if not ready.done() or ready.exception() is not None]
+
+    def get_data(self) -> Dict[str, Any]:
+        ret = {}
+        for driver in self.drivers:
+            if driver.data:
+                ret.update(self.instances[driver.name].get_data())
+        return ret
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        ret = {}
+        for driver in self.drivers:
+            instance = self.instances[driver.name]
+            if hasattr(instance, "get_telemetry"):
+                ret.update(instance.get_telemetry())
+        return ret
+
+    def stop(self) -> None:
+        for driver in sorted(reversed(self.drivers), key=lambda driver: not driver.stop_first):
+            instance = self.instances[driver.name]
+            if not hasattr(instance, "stop"):
+                continue
+            try:
+                instance.stop()
+                prt.GLOBAL_ENTITY.info(f"{driver.name} stopped")
+            except Exception as e:
+                prt.GLOBAL_ENTITY.error(f"Failed to stop {driver.name}, dump: {e}")
+
+    def get_report(self) -> List[Tuple[str, float, float, Optional[float], float]]:
+        """(name, import time in ms, start time in ms, time to the first sample in ms, import RSS growth in MB) per plugin"""
+        ret = []
+        for driver in self.drivers:
+            cost = self.costs[driver.name]
+            ready_time = None if cost.ready_time is None else round(1000 * cost.ready_time, 1)
+            ret.append((driver.name, round(1000 * cost.import_time, 1), round(1000 * cost.start_time, 1), ready_time,
+                        round(cost.rss / 1e6, 1)))
+        return ret
+
+    def print_report(self) -> None:
+        prt.GLOBAL_ENTITY.info("Plugin startup cost (import ms, start ms, first sample ms, import RSS MB):")
+        for name, import_time, start_time, ready_time, rss in self.get_report():
+            prt.GLOBAL_ENTITY.info(f"  {name}: {import_time}, {start_time}, {'-' if ready_time is None else ready_time}, {rss}")
+        prt.GLOBAL_ENTITY.info(f"  total RSS: {round(psutil.Process().memory_info().rss / 1e6, 1)} MB")
@@ -1,20 +1,31 @@
 from typing import Dict
-import config
+from concurrent.futures import Future
+from calibration import TwoPointCalibration
 
 # This class is the parent of all sensors and provides a two point calibration function
+# Sensors compile their calibrations once with TwoPointCalibration.from_dict, see calibration.py
+# Every sensor resolves its ready future once its first valid sample arrived, main waits for it before sampling starts
 
 
 class SensorBase:
     def __init__(self):
-        pass
+        self.ready: Future = Future()
+
+    def _set_ready(self) -> None:
+        """Marks the sensor ready, called by the thread that got the first valid sample"""
+        if not self.ready.done():
+            self.ready.set_result(True)
+
+    def _set_failed(self, e: Exception) -> None:
+        """Marks the sensor as not coming up, it still runs and returns None"""
+        if not self.ready.done():
+            self.ready.set_exception(e)
 
     def _calibrate(self, raw: float, cali: Dict[str, int]) -> float:
         """
+        Compiles the calibration on every call, prefer a TwoPointCalibration created at startup
         :param raw: raw sensor value
         :param cali: calibration dict
         :return: calibrated sensor value
         """
-        raw_range = cali["raw_high"] - cali["raw_low"]
-        reference_range = cali["ref_high"] - cali["ref_low"]
-        ret = (((raw - cali["raw_low"]) * reference_range) / raw_range) + cali["ref_low"]
-        return round(ret, config.DIGIT_ACCURACY)
+        return TwoPointCalibration.from_dict(cali)(raw)
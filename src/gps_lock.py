@@ -0,0 +1,98 @@
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+from collections import deque
+import math
+import time
+import config
+import prt
+
+# Most nodes never move. Once the fixes of GPS_LOCK_WINDOW seconds scatter less than GPS_LOCK_MAX_SPREAD meters,
+# the averaged position is locked and GPS is only checked every GPS_LOCK_CHECK_INTERVAL seconds.
+# A check that finds the node moved or gets no fix within GPS_LOCK_CHECK_TIMEOUT goes back to tracking.
+
+STATE_TRACKING = 0  # GPS runs at GPS_POLL_INTERVAL until the position is stable
+STATE_LOCKED = 1  # position locked, GPS is idle or powered down
+STATE_CHECKING = 2  # GPS runs at GPS_POLL_INTERVAL to confirm the locked position
+
+METERS_PER_DEGREE = 111320
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Approximate distance in meters, accurate enough for the few hundred meters we compare"""
+    dy = (lat2 - lat1) * METERS_PER_DEGREE
+    dx = (lon2 - lon1) * METERS_PER_DEGREE * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(dx, dy)
+
+
+class PositionLock:
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.state = STATE_TRACKING
+        self.fixes: Deque[Tuple[float, float, float, float]] = deque()  # (time, lat, lon, alt) of the current window
+        self.position: Optional[Tuple[float, float, float]] = None  # locked (lat, lon, alt)
+        self.spread: Optional[float] = None  # standard deviation of the current window in meters
+        self.next_check = 0.
+        self.check_start = 0.
+        self.unlocks = 0
+
+    @property
+    def locked_position(self) -> Optional[Tuple[float, float, float]]:
+        """The locked (lat, lon, alt), None while tracking"""
+        return None if self.state == STATE_TRACKING else self.position
+
+    def gps_due(self) -> bool:
+        """True if GPS should run at GPS_POLL_INTERVAL now, starts a check of the locked position when it is time"""
+        if self.state == STATE_LOCKED and self.clock() >= self.next_check:
+            self.state = STATE_CHECKING
+            self.check_start = self.clock()
+        return self.state != STATE_LOCKED
+
+    def add_fix(self, lat: float, lon: float, alt: float) -> None:
+        if not config.GPS_LOCK_ENABLE:
+            return
+        now = self.clock()
+        if self.state == STATE_TRACKING:
+            self._track(now, lat, lon, alt)
+        elif distance(self.position[0], self.position[1], lat, lon) > config.GPS_LOCK_MOVE_DISTANCE:
+            prt.GLOBAL_ENTITY.info("Node moved, unlocking GPS position")
+            self._unlock()
+            self._track(now, lat, lon, alt)
+        elif self.state == STATE_CHECKING:
+            self.state = STATE_LOCKED
+            self.next_check = now + config.GPS_LOCK_CHECK_INTERVAL
+
+    def no_fix(self) -> None:
+        # while tracking, a missing fix only thins out the window
+        if self.state == STATE_CHECKING and self.clock() - self.check_start > config.GPS_LOCK_CHECK_TIMEOUT:
+            prt.GLOBAL_ENTITY.warning("No GPS fix while checking the locked position, unlocking GPS position")
+            self._unlock()
+
+    def _unlock(self) -> None:
+        self.state = STATE_TRACKING
+        self.position = None
+        self.fixes.clear()
+        self.spread = None
+        self.unlocks += 1
+
+    def _track(self, now: float, lat: float, lon: float, alt: float) -> None:
+        self.fixes.append((now, lat, lon, alt))
+        while now - self.fixes[0][0] > config.GPS_LOCK_WINDOW:
+            self.fixes.popleft()
+        count = len(self.fixes)
+        mean_lat = sum(fix[1] for fix in self.fixes) / count
+        mean_lon = sum(fix[2] for fix in self.fixes) / count
+        self.spread = math.sqrt(sum(distance(mean_lat, mean_lon, fix[1], fix[2]) ** 2 for fix in self.fixes) / count)
+        # the window has to be full, the oldest fix is dropped once it is older than GPS_LOCK_WINDOW
+        if now - self.fixes[0][0] >= 0.9 * config.GPS_LOCK_WINDOW and self.spread < config.GPS_LOCK_MAX_SPREAD:
+            mean_alt = sum(fix[3] for fix in self.fixes) / count
+            self.position = (round(mean_lat, 6), round(mean_lon, 6), round(mean_alt, 1))
+            self.state = STATE_LOCKED
+            self.next_check = now + config.GPS_LOCK_CHECK_INTERVAL
+            prt.GLOBAL_ENTITY.info(f"Locked GPS position at lat: {self.position[0]}, lon: {self.position[1]}, spread: {round(self.spread, 1)} m")
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        if not config.GPS_LOCK_ENABLE:
+            return {}
+        ret = {"gps_lock_state": self.state, "gps_unlocks": self.unlocks}
+        if self.spread is not None:
+            ret["gps_lock_spread"] = round(self.spread, config.DIGIT_ACCURACY)
+        return ret
@@ -0,0 +1,261 @@
+from typing import Dict, Any, List, Optional, Tuple
+from collections import deque
+import argparse
+import math
+import time
+import numpy as np
+import pandas as pd
+import config
+import prt
+from heating_controller import HeatingController
+from prt import EventLogger
+from pwm_backend import FakePWM
+
+# First order plus dead time (FOPDT) model of the heater and the OPC enclosure.
+# The model is fitted from logged heater_temp/heater columns and drives the real HeatingController and
+# PIDAutoTuner with a simulated clock, so tunings can be compared without waiting hours on a node.
+# Usage: python heater_simulator.py logs/*raw_every_second_data.log* --tuning "(20, 0.1, 0)" --autotune
+
+
+class SimulatedClock:
+    """Time source that only advances when told to, replaces time.monotonic/time.time"""
+    def __init__(self, start: float = 0.) -> None:
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, dt: float) -> None:
+        self.now += dt
+
+
+class FOPDTModel:
+    def __init__(self, gain: float, time_constant: float, dead_time: float, ambient: float = 20.,
+                 temperature: Optional[float] = None) -> None:
+        """
+        :gain: steady state temperature rise above ambient in °C per % heater power
+        :time_constant: in s, how fast the enclosure follows the heater
+        :dead_time: in s, until a heater power change shows up at the heater temperature sensor
+        :ambient: temperature in °C the enclosure settles at without heating
+        """
+        self.gain = gain
+        self.time_constant = time_constant
+        self.dead_time = dead_time
+        self.ambient = ambient
+        self.reset(temperature)
+
+    def reset(self, temperature: Optional[float] = None) -> None:
+        self.temperature = self.ambient if temperature is None else temperature
+        self.time = 0.
+        self.delayed_power = 0.
+        # (time the power reaches the sensor, power) of every step still within the dead time
+        self.pending = deque()
+
+    def step(self, power: float, dt: float) -> float:
+        """Applies heater power in % for dt seconds and returns the new heater temperature"""
+        self.pending.append((self.time + self.dead_time, power))
+        self.time += dt
+        while self.pending and self.pending[0][0] <= self.time:
+            self.delayed_power = self.pending.popleft()[1]
+        # exact solution for a constant input over dt, stable for any step size
+        target = self.ambient + self.gain * self.delayed_power
+        self.temperature = target + (self.temperature - target) * math.exp(-dt / self.time_constant)
+        return self.temperature
+
+    def __repr__(self) -> str:
+        return (f"FOPDTModel(gain={round(self.gain, 4)}, time_constant={round(self.time_constant, 1)}, "
+                f"dead_time={round(self.dead_time, 1)}, ambient={round(self.ambient, 2)})")
+
+
+def load_heater_log(paths: List[str], dt: float = 1.) -> pd.DataFrame:
+    """Reads raw logs into a frame with heater_temp, heater and sht_temp columns on a fixed dt grid, gaps are NaN"""
+    columns = ["timestamp", "heater_temp", "heater", "sht_temp"]
+    frames = [pd.read_csv(path, usecols=lambda column: column in columns) for path in paths]
+    frame = pd.concat(frames, ignore_index=True).sort_values("timestamp")
+    # missing sensor data is logged as 0, see remove_none_from() in main.py
+    frame = frame[frame["heater_temp"] != 0]
+    frame.index = pd.to_datetime(frame.pop("timestamp"), unit="s")
+    return frame.resample(pd.Timedelta(seconds=dt)).mean()
+
+
+def fit_fopdt(temperature: np.ndarray, power: np.ndarray, dt: float = 1., ambient: Optional[np.ndarray] = None,
+              max_dead_time: float = 120.) -> Tuple[FOPDTModel, float]:
+    """
+    Least squares fit of the discrete model T[k+1] = a*T[k] + b*u[k-d] + c for every dead time d,
+    the dead time with the smallest residual wins. Returns the model and its rms error in °C.
+    :ambient: optional ambient temperature series, the fit then uses T - ambient and c is dropped
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    power = np.asarray(power, dtype=np.float64)
+    offset = np.zeros_like(temperature) if ambient is None else np.asarray(ambient, dtype=np.float64)
+    rel = temperature - offset
+
+    best = None
+    for d in range(int(max_dead_time / dt) + 1):
+        y = rel[d + 1:]
+        x = rel[d:-1]
+        u = power[:len(power) - d - 1]
+        valid = np.isfinite(y) & np.isfinite(x) & np.isfinite(u)
+        if valid.sum() < 10:
+            break
+        columns = [x[valid], u[valid]]
+        if ambient is None:
+            columns.append(np.ones(valid.sum()))
+        a_matrix = np.column_stack(columns)
+        coefficients, _, _, _ = np.linalg.lstsq(a_matrix, y[valid], rcond=None)
+        a = coefficients[0]
+        if not 0 < a < 1:
+            # not a stable first order response
+            continue
+        rms = float(np.sqrt(np.mean((a_matrix @ coefficients - y[valid]) ** 2)))
+        if best is None or rms < best[0]:
+            best = (rms, d, coefficients)
+
+    if best is None:
+        raise ValueError("No stable FOPDT model fits the data, does the log contain heater power changes?")
+    rms, d, coefficients = best
+    a, b = coefficients[0], coefficients[1]
+    ambient_temp = coefficients[2] / (1 - a) if ambient is None else float(np.nanmean(offset))
+    model = FOPDTModel(gain=b / (1 - a), time_constant=-dt / math.log(a), dead_time=d * dt, ambient=ambient_temp)
+    return model, rms
+
+
+class SimulatedOneWire:
+    """Hands the model temperature to the controller like OneWireHandler.get_heater_temperature()"""
+    def __init__(self, model: FOPDTModel, clock: SimulatedClock) -> None:
+        self.model = model
+        self.clock = clock
+
+    def get_heater_temperature(self) -> Tuple[Optional[float], float]:
+        return round(self.model.temperature, config.DIGIT_ACCURACY), self.clock()
+
+
+class HeaterSimulation:
+    def __init__(self, model: FOPDTModel, control_rate: float = config.HEATER_CONTROL_RATE,
+                 outside_humidity: float = 80, opc_temp: Optional[float] = None) -> None:
+        """
+        :model: plant the controller heats, reset at the start of every run
+        :control_rate: in Hz, the controller is ticked at this rate in simulated time
+        :outside_humidity: in %, determines the dehumidification setpoint
+        :opc_temp: opc temperature passed to the controller, defaults to the model ambient temperature
+        """
+        self.model = model
+        self.control_rate = control_rate
+        self.outside_humidity = outside_humidity
+        self.opc_temp = model.ambient if opc_temp is None else opc_temp
+        if prt.GLOBAL_ENTITY is None:
+            prt.GLOBAL_ENTITY = EventLogger()
+
+    def _create_controller(self, clock: SimulatedClock, tuning: Optional[Tuple[float, float, float]],
+                           autotune: bool) -> HeatingController:
+        controller = HeatingController(one_wire_handler=SimulatedOneWire(self.model, clock), clock=clock,
+                                       start_loop=False, state_file=None, pwm=FakePWM(clock))
+        controller.period = 1 / self.control_rate
+        controller.pid_autotuning_enabled = autotune
+        if tuning is not None:
+            controller.pid_t.tunings = tuning
+        return controller
+
+    def _run(self, controller: HeatingController, clock: SimulatedClock, duration: float,
+             until_tuned: bool = False) -> np.ndarray:
+        """Returns an array of (time, heater_temp, target_temp, power) rows, one per control step"""
+        period = 1 / self.control_rate
+        steps = int(duration * self.control_rate)
+        history = np.empty((steps, 4))
+        next_update = 0.
+        count = 0
+        for count in range(steps):
+            # the 1 Hz pipeline feeds humidity and opc temperature once a second
+            if clock() >= next_update:
+                controller.update_heating({"sht_humid": self.outside_humidity, "opc_temp": self.opc_temp})
+                next_update += 1
+            controller._tick()
+            history[count] = (clock(), self.model.temperature, controller.target_temp, controller.heater_power)
+            self.model.step(controller.heater_power, period)
+            clock.advance(period)
+            if until_tuned and controller.pid_autotuner.tuning_completed:
+                break
+        return history[:count + 1]
+
+    def evaluate_tuning(self, tuning: Tuple[float, float, float], duration: float = 6 * 3600,
+                        band: float = 0.5) -> Dict[str, Any]:
+        """
+        Runs the PID from a cold start and reports how well it reaches the dehumidification setpoint.
+        :band: in °C, the temperature counts as settled once it stays within setpoint +- band
+        """
+        self.model.reset()
+        clock = SimulatedClock()
+        controller = self._create_controller(clock, tuning, autotune=False)
+        return self.summarize(self._run(controller, clock, duration), band)
+
+    def run_autotune(self, max_duration: float = 48 * 3600) -> Dict[str, Any]:
+        """Runs the PIDAutoTuner relay sequence, returns the tuned parameters and how long it took"""
+        self.model.reset()
+        clock = SimulatedClock()
+        controller = self._create_controller(clock, None, autotune=True)
+        history = self._run(controller, clock, max_duration, until_tuned=True)
+        return {"tuning": controller.pid_autotuner.tuned_parameters, "duration": float(history[-1, 0])}
+
+    def summarize(self, history: np.ndarray, band: float = 0.5) -> Dict[str, Any]:
+        times, temperature, target, power = history.T
+        setpoint = float(target[-1])
+        outside = np.nonzero(np.abs(temperature - setpoint) > band)[0]
+        if len(outside) == 0:
+            settling_time = 0.
+        elif outside[-1] == len(times) - 1:
+            settling_time = None  # never settled
+        else:
+            settling_time = float(times[outside[-1] + 1])
+        period = 1 / self.control_rate
+        return {
+            "setpoint": setpoint,
+            "settling_time": settling_time,
+            "overshoot": max(float(np.max(temperature) - setpoint), 0.),
+            # heater energy in hours at full power, multiply with the heater wattage to get Wh
+            "energy": float(np.sum(power) / 100 * period / 3600),
+            "iae": float(np.sum(np.abs(temperature - setpoint)) * period),
+            "final_temp": float(temperature[-1]),
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from ast import literal_eval
+    parser = argparse.ArgumentParser(description="Fit a heater model from raw logs and evaluate PID tunings offline")
+    parser.add_argument("files", nargs="+", help="*_raw_every_second_data.log files with heater_temp and heater columns")
+    parser.add_argument("--tuning", action="append", default=[], help='PID tuning to evaluate, e.g. "(20, 0.1, 0)"')
+    parser.add_argument("--autotune", action="store_true", help="run the PIDAutoTuner on the model and evaluate its result")
+    parser.add_argument("--humidity", type=float, default=80, help="outside humidity in %% that sets the setpoint")
+    parser.add_argument("--duration", type=float, default=6, help="simulated hours per tuning")
+    parser.add_argument("--rate", type=float, default=config.HEATER_CONTROL_RATE, help="control loop rate in Hz")
+    parser.add_argument("--heater-watts", type=float, default=None, help="heater power to report energy in Wh")
+    parser.add_argument("--max-dead-time", type=float, default=120, help="largest dead time in s the fit tries")
+    args = parser.parse_args(argv)
+
+    frame = load_heater_log(args.files)
+    ambient = frame["sht_temp"].to_numpy() if "sht_temp" in frame else None
+    model, rms = fit_fopdt(frame["heater_temp"].to_numpy(), frame["heater"].to_numpy(), ambient=ambient,
+                           max_dead_time=args.max_dead_time)
+    print(f"Fitted {model} from {len(frame)} s of data, rms error: {round(rms, 3)} °C")
+
+    simulation = HeaterSimulation(model, control_rate=args.rate, outside_humidity=args.humidity)
+    tunings = [literal_eval(tuning) for tuning in args.tuning] or [config.HEATER_PID_TEMP_TUNING]
+    if args.autotune:
+        start = time.time()
+        result = simulation.run_autotune()
+        print(f"Autotune took {round(result['duration'] / 3600, 2)} simulated h "
+              f"({round(time.time() - start, 2)} s), result: {result['tuning']}")
+        if result["tuning"] is not None:
+            tunings.append(result["tuning"])
+
+    for tuning in tunings:
+        start = time.time()
+        metrics = simulation.evaluate_tuning(tuning, duration=args.duration * 3600)
+        runtime = time.time() - start
+        if args.heater_watts is not None:
+            metrics["energy"] = metrics["energy"] * args.heater_watts
+        print(f"{tuning}: " + ", ".join(f"{key}={round(val, 2) if isinstance(val, float) else val}" for key, val in metrics.items())
+              + f" ({round(args.duration * 60 / runtime)} simulated h/min)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
-from typing import Dict
+from typing import Dict, Any, Optional, Callable
+import json
+import os
+import threading
 import time
-import RPi.GPIO
 from simple_pid import PID
 import config
 import prt
 import numpy as np
 from pid_autotuner import PIDAutoTuner
+from pwm_backend import PWMBackend, create_pwm_backend
 
 
 # define custom exceptions describing heater conditions
@@ -18,17 +21,22 @@ class OverheatingException(Exception):
 
 
 class HeatingController:
-    def __init__(self):
+    def __init__(self, one_wire_handler=None, clock: Callable[[], float] = time.monotonic, start_loop: bool = True,
+                 state_file: Optional[str] = config.HEATER_STATE_FILE, pwm: Optional[PWMBackend] = None):
+        """
+        :one_wire_handler: OneWireHandler the control loop reads the heater temperature from directly,
+        if None the heater temperature of the 1 Hz data passed to update_heating() is used
+        :clock: monotonic time source in seconds, replaced by a simulated clock in heater_simulator.py
+        :start_loop: start the control thread, the simulator calls _control_step() itself
+        :state_file: json file the autotune result and the PID integral are checkpointed to, None to disable
+        :pwm: heater output, defaults to the configured HEATER_PWM_BACKEND
+        """
         self.heater_power = 0
         self.target_temp = 0
-        self.GPIO = RPi.GPIO
-        self.GPIO.setmode(self.GPIO.BOARD)
-        self.GPIO.setwarnings(False)
-        self.GPIO.setup(config.HEATER_PIN, self.GPIO.OUT)
-        self.p = self.GPIO.PWM(config.HEATER_PIN, 50)
-        self.p.start(0)
+        self.clock = clock
+        self.pwm = create_pwm_backend() if pwm is None else pwm
         # Temperature PID
-        self.pid_t = PID(20, 0.1, 0, setpoint=-100, sample_time=None)
+        self.pid_t = PID(20, 0.1, 0, setpoint=-100, sample_time=None, time_fn=clock)
         self.pid_t.output_limits = (0, int(np.clip(config.HEATER_MAX_POWER, 5, 100)))  # allow 5% to 100% power limits
         self.pid_t.tunings = config.HEATER_PID_TEMP_TUNING
 
@@ -36,17 +44,161 @@ class HeatingController:
         self.pid_autotuner = PIDAutoTuner(
             calibration_temperature=config.HEATER_PID_AUTOTUNER_CALIBRATION_TEMPERATURE,
             relay_hysteresis_delta=config.HEATER_PID_AUTOTUNER_RELAY_HYSTERESIS_DELTA,
+            clock=clock,
         )
-        
+
+        # Inputs of the control loop as (value, monotonic timestamp), the slow ones are set by update_heating()
+        self.one_wire_handler = one_wire_handler
+        self.inputs = {
+            "heater_temp": (None, 0.),
+            "sht_humid": (None, 0.),
+            "opc_temp": (None, 0.),
+        }
+        # Serializes the control loop with stop(), the PWM must stay off once stopped
+        self.lock = threading.Lock()
+        self.running = True
+
+        # control loop timing statistics, reset every time they are reported
+        self.period = 1 / config.HEATER_CONTROL_RATE
+        self.last_tick = self.clock()
+        self.max_jitter = 0.
+        self.latency_sum = 0.
+        self.latency_count = 0
+
+        # Checkpointed state for warm restarts, see _load_state()
+        self.state_file = state_file
+        self.tuned_parameters = None
+        self.tuning_time = None
+        self.restored_integral = None
+        self.warm_start = False
+        self.last_state_save = self.clock()
+        if self.state_file:
+            self._load_state()
+
+        if start_loop:
+            self.thread = threading.Thread(target=self._control_worker)
+            self.thread.daemon = True
+            self.thread.start()
+
     def get_data(self) -> Dict[str, int]:
         return {"heater": self.heater_power, "heater_set": self.target_temp}
 
-    def update_heating(self, data: Dict[str, float]) -> None:
-        heater_temp = data['heater_temp']
-        outside_humidity = data['sht_humid']
-        opc_temp = data['opc_temp']
-        #outside_temperature = data['sht_temp']
-        #opc_humid = data['opc_humid']
+    def get_telemetry(self) -> Dict[str, Any]:
+        # jitter: largest deviation of the loop period from its nominal value, latency: mean age of the
+        # heater temperature when the PWM was updated, both in ms since the last report
+        latency = self.latency_sum / self.latency_count if self.latency_count else 0
+        ret = {
+            "heater_loop_jitter": round(self.max_jitter * 1000, config.DIGIT_ACCURACY),
+            "heater_latency": round(latency * 1000, config.DIGIT_ACCURACY),
+            "heater_warm_start": self.warm_start,
+        }
+        self.max_jitter = 0.
+        self.latency_sum = 0.
+        self.latency_count = 0
+        return ret
+
+    def update_heating(self, data: Dict[str, Any]) -> None:
+        """Feeds the 1 Hz sensor data to the control loop and checks that the loop is still alive"""
+        now = self.clock()
+        self.inputs["sht_humid"] = (data.get("sht_humid"), now)
+        self.inputs["opc_temp"] = (data.get("opc_temp"), now)
+        if self.one_wire_handler is None:
+            self.inputs["heater_temp"] = (data.get("heater_temp"), now)
+
+        # Hard safety watchdog: if the control loop stopped ticking, nothing else turns the heater off
+        if now - self.last_tick > config.HEATER_INPUT_MAX_AGE:
+            prt.GLOBAL_ENTITY.print_once("Heater control loop stalled, disabling heater", "Heater control loop running again")
+            with self.lock:
+                self._disable_heater()
+
+    def _control_worker(self) -> None:
+        next_tick = time.monotonic()
+        while self.running:
+            self._tick()
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
+
+    def _tick(self) -> None:
+        """One control loop iteration, called at HEATER_CONTROL_RATE"""
+        now = self.clock()
+        self.max_jitter = max(self.max_jitter, abs(now - self.last_tick - self.period))
+        self.last_tick = now
+        if self.one_wire_handler is not None:
+            self.inputs["heater_temp"] = self.one_wire_handler.get_heater_temperature()
+        with self.lock:
+            if self.running:
+                self._control_step(now)
+            # stop() and the autotuner save from other places, every save holds the lock so they never share the tmp file
+            if self.running and self.state_file and now - self.last_state_save >= config.HEATER_STATE_SAVE_INTERVAL:
+                self.last_state_save = now
+                self._save_state()
+
+    def _load_state(self) -> None:
+        # The autotune result is kept for HEATER_TUNING_MAX_AGE days, the PID integral only makes sense
+        # right after a restart, an old one would kick the heater with the output of a different day
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            prt.GLOBAL_ENTITY.warning(f"Failed to load heater state from: {self.state_file}, dump: {e}")
+            return
+        now = time.time()
+        tuning_max_age = config.HEATER_TUNING_MAX_AGE * 24 * 3600
+        if state.get("tuning") is not None and (tuning_max_age == 0 or now - state["tuning_time"] < tuning_max_age):
+            self.tuned_parameters = tuple(state["tuning"])
+            self.tuning_time = state["tuning_time"]
+            if config.HEATER_PID_USE_AUTOTUNED_TUNING:
+                self.pid_t.tunings = self.tuned_parameters
+                prt.GLOBAL_ENTITY.info(f"Using autotuned heater PID parameters: Kp, Ki, Kd={self.tuned_parameters}")
+        if state.get("integral") is not None and now - state["time"] < config.HEATER_STATE_MAX_AGE:
+            self.restored_integral = state["integral"]
+            prt.GLOBAL_ENTITY.info(f"Restored heater PID integral: {round(self.restored_integral, 2)}")
+
+    def _save_state(self) -> None:
+        # Called with self.lock held. The integral is only worth restoring while the PID is running
+        state = {
+            "time": time.time(),
+            "integral": self.pid_t.components[1] if self.pid_t.auto_mode else None,
+            "setpoint": self.target_temp,
+            "tuning": self.tuned_parameters,
+            "tuning_time": self.tuning_time,
+        }
+        # Write to a temporary file first, a power cut must not leave a truncated state file behind
+        tmp_file = self.state_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            prt.GLOBAL_ENTITY.print_once(f"Failed to save heater state, dump: {e}", "Heater state saved again")
+
+    def _get_input(self, name: str, now: float, max_age: float) -> Optional[float]:
+        value, timestamp = self.inputs[name]
+        # Stale inputs are treated like missing ones
+        if now - timestamp > max_age:
+            return None
+        return value
+
+    def _disable_heater(self) -> None:
+        self.target_temp = -100
+        self.heater_power = 0
+        self.pwm.set_duty_cycle(self.heater_power)
+        self.pid_autotuner.reset()
+        # reset pid to avoid integral windup
+        self.pid_t.auto_mode = False
+
+    def _control_step(self, now: float) -> None:
+        heater_temp = self._get_input("heater_temp", now, config.HEATER_TEMP_MAX_AGE)
+        outside_humidity = self._get_input("sht_humid", now, config.HEATER_INPUT_MAX_AGE)
+        opc_temp = self._get_input("opc_temp", now, config.HEATER_INPUT_MAX_AGE)
 
         try:
             # if ds temp sensor or sht has a fault, dont heat
@@ -62,21 +214,22 @@ class HeatingController:
                 prt.GLOBAL_ENTITY.print_once("OPC overheating, disabling heater", "OPC cooled down, Heater back online")
                 raise OverheatingException
         except (MissingDataException, OverheatingException):
-            self.target_temp = -100
-            self.heater_power = 0
-            self.p.ChangeDutyCycle(self.heater_power)
-            self.pid_autotuner.reset()
-            # reset pid to avoid integral windup
-            self.pid_t.auto_mode = False
+            self._disable_heater()
             return
 
         if config.HEATER_DEBUG:
-            print(f"temp:{heater_temp}, heater_target:{self.target_temp}, heater_power:{self.heater_power}, outside_humidity:{outside_humidity}")
-        
+            prt.GLOBAL_ENTITY.info(f"temp:{heater_temp}, heater_target:{self.target_temp}, heater_power:{self.heater_power}, outside_humidity:{outside_humidity}")
+
         try:
             if self.pid_autotuning_enabled:
                 self.target_temp = self.pid_autotuner.get_target_temp()
                 self.heater_power = self.pid_autotuner.run(current_temp=heater_temp)
+                tuned_parameters = self.pid_autotuner.tuned_parameters
+                if tuned_parameters is not None and tuned_parameters is not self.tuned_parameters:
+                    self.tuned_parameters = tuned_parameters
+                    self.tuning_time = time.time()
+                    if self.state_file:
+                        self._save_state()
             else:
                 self.target_temp = self._calculate_dehumidification_temperature(outside_humidity=outside_humidity)
                 self.heater_power = self._run_pid_control(current_temp=heater_temp, target_temp=self.target_temp)
@@ -84,7 +237,9 @@ class HeatingController:
             prt.GLOBAL_ENTITY.print_once(f"Heater fault, dump: {e}", "Heater fault stopped, dump: {e}")
             self.heater_power = 0
 
-        self.p.ChangeDutyCycle(self.heater_power)
+        self.pwm.set_duty_cycle(self.heater_power)
+        self.latency_sum += self.clock() - self.inputs["heater_temp"][1]
+        self.latency_count += 1
 
     def _calculate_dehumidification_temperature(self, outside_humidity: float) -> float:
         # constrain HEATER_MIN_TEMP to avoid too high temperatures
@@ -100,17 +255,24 @@ class HeatingController:
         power = 0
         # Only enable PID if temp not too high
         if current_temp < target_temp + 5:
-            self.pid_t.auto_mode = True
+            if not self.pid_t.auto_mode:
+                # Start from the checkpointed integral once after a restart instead of from zero
+                self.pid_t.set_auto_mode(True, last_output=self.restored_integral)
+                self.warm_start = self.warm_start or self.restored_integral is not None
+                self.restored_integral = None
             self.pid_t.setpoint = target_temp
             power = round(self.pid_t(current_temp), 2)
             if config.HEATER_DEBUG:
-                print("Temperature PID: ", [round(x, 2) for x in self.pid_t.components])
+                prt.GLOBAL_ENTITY.info(f"Temperature PID: {[round(x, 2) for x in self.pid_t.components]}")
         else:
             self.pid_t.auto_mode = False
         return power
 
 
     def stop(self) -> None:
-        self.p.ChangeDutyCycle(0)
-        self.p.stop()
-        self.GPIO.cleanup()
+        with self.lock:
+            self.running = False
+            # Checkpoint the current integral, a container restart should continue where it stopped
+            if self.state_file:
+                self._save_state()
+            self.pwm.stop()
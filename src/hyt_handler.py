@@ -1,35 +1,88 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import time
 import smbus
 import config
 import prt
 from generic_sensor import SensorBase
+from calibration import TwoPointCalibration
+from i2c_arbiter import SENSOR_BUS, get_arbiter
+
+# Status bits of the first data byte
+HYT_STALE_BIT = 0x40  # set if the data has already been read, i.e. no conversion finished since the last read
+# conversion time after a measurement request, the sample is taken somewhere within this window
+HYT_CONVERSION_TIME = 0.05
+# a sensor that did not deliver a new sample for this many seconds is considered disconnected
+HYT_MAX_SAMPLE_AGE = 5
 
 
 class HYTHandler(SensorBase):
     def __init__(self):
-        self.delay = 50.0 / 1000.0  # 50-60 ms delay. Without delay, it doesn't work.
-        self.bus = smbus.SMBus(1)  # use /dev/i2c1
+        super().__init__()
+        self.bus = smbus.SMBus(SENSOR_BUS)  # use /dev/i2c1
+        self.i2c = get_arbiter(SENSOR_BUS)
+        self.cali_humid = TwoPointCalibration.from_dict(config.HYT_CALI_HUMID)
+        self.cali_temp = TwoPointCalibration.from_dict(config.HYT_CALI_TEMP)
+        # Split phase measurement: every get_data call reads the conversion started by the previous call
+        # and immediately starts the next one, so nobody waits for the 50-60 ms conversion time
+        self.humidity: Optional[float] = None
+        self.temperature: Optional[float] = None
+        self.sample_time = 0.  # monotonic time of the latest conversion
+        self.request_time: Optional[float] = None
+        self.stale_reads = 0
+        self._request_measurement()
+        # drivers are started in their own threads, so waiting for the first conversion here delays nothing else
+        if self.request_time is not None:
+            time.sleep(2 * HYT_CONVERSION_TIME)
+            try:
+                self._read_measurement()
+            except OSError:
+                pass
+            self._request_measurement()
+
+    def _request_measurement(self) -> None:
+        try:
+            self.i2c.transaction("hyt", self.bus.write_byte, config.HYT_ADDRESS, 0x00)
+            self.request_time = time.monotonic()
+        except OSError:
+            self.request_time = None
+
+    def _read_measurement(self) -> None:
+        reading = self.i2c.transaction("hyt", self.bus.read_i2c_block_data, config.HYT_ADDRESS, 0x00, 4)
+        if reading[0] & HYT_STALE_BIT:
+            # the conversion we requested has not finished yet, keep the previous sample
+            self.stale_reads += 1
+            return
+        # Mask the first two bits
+        humidity = round(((reading[0] & 0x3F) * 0x100 + reading[1]) * (100.0 / 16383.0), config.DIGIT_ACCURACY)
+        # Mask the last two bits, shift 2 bits to the right
+        temperature = round(165.0 / 16383.0 * ((reading[2] * 0x100 + (reading[3] & 0xFC)) >> 2) - 40,
+                            config.DIGIT_ACCURACY)
+
+        # Apply two point calibration
+        self.humidity = self.cali_humid(humidity)
+        self.temperature = self.cali_temp(temperature)
+        self.sample_time = self.request_time + HYT_CONVERSION_TIME
+        self._set_ready()
 
     def get_data(self) -> Dict[str, Any]:
         try:
-            self.bus.write_byte(config.HYT_ADDRESS, 0x00)  # send some stuff
-            time.sleep(self.delay)  # wait a bit
-            reading = self.bus.read_i2c_block_data(config.HYT_ADDRESS, 0x00, 4)  # read the bytes
-            # Mask the first two bits
-            humidity = round(((reading[0] & 0x3F) * 0x100 + reading[1]) * (100.0 / 16383.0), config.DIGIT_ACCURACY)
-            # Mask the last two bits, shift 2 bits to the right
-            temperature = round(165.0 / 16383.0 * ((reading[2] * 0x100 + (reading[3] & 0xFC)) >> 2) - 40,
-                                config.DIGIT_ACCURACY)
-
-            # Apply two point calibration
-            humidity = self._calibrate(humidity, config.HYT_CALI_HUMID)
-            temperature = self._calibrate(temperature, config.HYT_CALI_TEMP)
-            return {"hyt_humid": humidity, "hyt_temp": temperature}
+            if self.request_time is not None:
+                self._read_measurement()
+            # start the conversion for the next call
+            self._request_measurement()
+
+            sample_age = time.monotonic() - self.sample_time
+            if self.humidity is None or sample_age > HYT_MAX_SAMPLE_AGE:
+                raise Exception  # no conversion finished within HYT_MAX_SAMPLE_AGE
+            return {"hyt_humid": self.humidity, "hyt_temp": self.temperature,
+                    "RAW_HYT_AGE": round(max(sample_age, 0), config.DIGIT_ACCURACY)}
 
         except Exception:
             prt.GLOBAL_ENTITY.print_once("HYT disconnected", "HYT back online")
-            return {"hyt_humid": None, "hyt_temp": None}
+            return {"hyt_humid": None, "hyt_temp": None, "RAW_HYT_AGE": None}
+
+    def get_telemetry(self) -> Dict[str, int]:
+        return {"hyt_stale_reads": self.stale_reads}
 
     def stop(self) -> None:
         self.bus.close()
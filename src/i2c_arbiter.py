@@ -0,0 +1,128 @@
+from typing import Dict, Any, Callable, List, Tuple
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+import time
+import config
+
+# SHT, HYT and both ADS1115 share /dev/i2c-1 and are read from different threads.
+# Every transaction goes through the arbiter of its bus, which runs one transaction at a time,
+# hands the bus to sensors before the display and keeps latency and error statistics per device.
+
+SENSOR_BUS = 1
+# lower values get the bus first
+PRIORITY_SENSOR = 0
+PRIORITY_DISPLAY = 10
+
+
+class PriorityLock:
+    """Non reentrant lock that is handed to the waiting thread with the lowest priority value, FIFO within a priority"""
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._waiting: List[Tuple[int, int]] = []
+        self._counter = itertools.count()
+        self._busy = False
+
+    def acquire(self, priority: int) -> None:
+        with self._cond:
+            ticket = (priority, next(self._counter))
+            heapq.heappush(self._waiting, ticket)
+            while self._busy or self._waiting[0] != ticket:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._busy = True
+
+    def release(self) -> None:
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+
+class DeviceStats:
+    __slots__ = ("transactions", "errors", "retries", "busy_time", "max_latency", "wait_time")
+
+    def __init__(self) -> None:
+        self.transactions = 0
+        self.errors = 0
+        self.retries = 0
+        self.busy_time = 0.
+        self.max_latency = 0.
+        self.wait_time = 0.
+
+
+class I2CBusArbiter:
+    def __init__(self, bus: int) -> None:
+        self.bus = bus
+        self.lock = PriorityLock()
+        self.stats: Dict[str, DeviceStats] = {}
+        self.stats_start = time.monotonic()
+
+    @contextmanager
+    def claim(self, device: str, priority: int = PRIORITY_SENSOR):
+        """Exclusive bus access for one transaction of device, use transaction() to get retries"""
+        stats = self.stats.setdefault(device, DeviceStats())
+        requested = time.monotonic()
+        self.lock.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            end = time.monotonic()
+            self.lock.release()
+            stats.transactions += 1
+            stats.wait_time += start - requested
+            stats.busy_time += end - start
+            stats.max_latency = max(stats.max_latency, end - requested)
+
+    def transaction(self, device: str, func: Callable, *args, priority: int = PRIORITY_SENSOR, **kwargs) -> Any:
+        """Runs func(*args, **kwargs) with exclusive bus access, retries bus errors with exponential backoff"""
+        for attempt in range(config.I2C_RETRIES + 1):
+            try:
+                with self.claim(device, priority):
+                    return func(*args, **kwargs)
+            except OSError:
+                if attempt == config.I2C_RETRIES:
+                    raise
+                self.stats.setdefault(device, DeviceStats()).retries += 1
+                # the bus is free for other devices while we back off
+                time.sleep(config.I2C_BACKOFF * 2 ** attempt)
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        """Bus usage and per device statistics since the last call, times in ms"""
+        now = time.monotonic()
+        elapsed = now - self.stats_start
+        stats, self.stats = self.stats, {}
+        self.stats_start = now
+        busy_time = sum(device.busy_time for device in stats.values())
+        ret = {f"i2c{self.bus}_usage": round(100 * busy_time / elapsed, config.DIGIT_ACCURACY) if elapsed > 0 else 0}
+        for name, device in stats.items():
+            count = max(device.transactions, 1)
+            ret[f"i2c_{name}_latency"] = round(1000 * (device.busy_time + device.wait_time) / count, config.DIGIT_ACCURACY)
+            ret[f"i2c_{name}_max_latency"] = round(1000 * device.max_latency, config.DIGIT_ACCURACY)
+            ret[f"i2c_{name}_wait"] = round(1000 * device.wait_time / count, config.DIGIT_ACCURACY)
+            ret[f"i2c_{name}_errors"] = device.errors
+            ret[f"i2c_{name}_retries"] = device.retries
+        return ret
+
+
+_arbiters: Dict[int, I2CBusArbiter] = {}
+_arbiters_lock = threading.Lock()
+
+
+def get_arbiter(bus: int = SENSOR_BUS) -> I2CBusArbiter:
+    """The single arbiter of an i2c bus, shared by every device on it"""
+    with _arbiters_lock:
+        if bus not in _arbiters:
+            _arbiters[bus] = I2CBusArbiter(bus)
+        return _arbiters[bus]
+
+
+def get_i2c_telemetry() -> Dict[str, Any]:
+    ret = {}
+    for arbiter in list(_arbiters.values()):
+        ret.update(arbiter.get_telemetry())
+    return ret
@@ -3,21 +3,48 @@ import time
 import threading
 import RPi.GPIO
 import config
-from typing import Type
+import prt
+from typing import Any, Dict, Optional, Type
 from modem_handler import ModemHandler
+from system_metrics import get_wwan_counters
 import subprocess
 
+# Escalation steps, each one is tried once the previous one did not bring the connection back within its backoff
+STEP_RECONNECT = "reconnect"  # re-enable the modem, ModemManager brings the data connection back up, mqtt reconnects by itself
+STEP_RESET = "reset"  # mmcli --reset
+STEP_POWER_CYCLE = "power_cycle"  # switch the modem power off and on with INTERNET_WATCHDOG_MODEM_POWER_PIN
+ESCALATION = (STEP_RECONNECT, STEP_RESET, STEP_POWER_CYCLE)
+MM_MODEM_STATE_CONNECTED = 11  # MMModemState of a modem with a connected data bearer
+
+
 class InternetWatchdog:
-    def __init__(self, interval: int = 60 * 60, modem_handler_instance: Type[ModemHandler] = None):
+    """
+    Keeps the internet connection alive. The connection counts as up while mqtt is connected, ModemManager reports
+    the modem connected or the modem interface receives data, an active probe is only made if none is the case. Once it is down for interval seconds, the
+    escalation steps are run one after another with exponential backoff until it is back.
+    """
+    def __init__(self, interval: int = 60 * 60, modem_handler_instance: Type[ModemHandler] = None, mqtt_instance=None):
         self.interval = interval
         self.modem_handler_instance = modem_handler_instance
+        self.mqtt_instance = mqtt_instance
         self.error_counter = 0
+        self.last_rx_bytes: Optional[int] = None
+        # outage statistics
+        self.outage_start: Optional[float] = None
+        self.next_step = 0.
+        self.step = 0
+        self.last_action: Optional[float] = None
+        self.outages = 0
+        self.outage_time = 0.
+        self.last_outage = 0.
+        self.last_recovery = 0.
+        self.probes = 0
         self.GPIO = RPi.GPIO
         self.GPIO.setmode(self.GPIO.BOARD)
         self.GPIO.setwarnings(False)
         self.GPIO.setup(config.INTERNET_WATCHDOG_MODEM_POWER_PIN, self.GPIO.OUT)
         self.GPIO.output(config.INTERNET_WATCHDOG_MODEM_POWER_PIN, False)
-        print(f"Internet watchdog enabled, checking connection every: {self.interval} seconds")
+        prt.GLOBAL_ENTITY.info(f"Internet watchdog enabled, escalating after: {self.interval} seconds without connection")
         self.thread = threading.Thread(target=self._watchdog_worker)
         self.thread.daemon = True
         self.thread.start()
@@ -25,50 +52,118 @@ class InternetWatchdog:
     def get_error_count(self) -> int:
         return self.error_counter
 
+    def get_telemetry(self) -> Dict[str, Any]:
+        """Outage statistics in seconds, probes since the last call"""
+        now = time.monotonic()
+        ret = {
+            "internet_outages": self.outages,
+            "internet_outage_time": round(self.outage_time + (0 if self.outage_start is None else now - self.outage_start)),
+            "internet_last_outage": round(self.last_outage),
+            "internet_last_recovery": round(self.last_recovery),
+            "internet_escalation": self.step,
+            "internet_probes": self.probes,
+        }
+        self.probes = 0
+        return ret
+
     def _watchdog_worker(self) -> None:
         while True:
-            time.sleep(self.interval)
-            # TODO: only check modem handler if gps poll is on to avoid modem restat loop
-            if self._internet_connected() and self.modem_handler_instance.get_mm_number() != -1:
-                self.error_counter = 0
-                continue
-            self.error_counter += 1
-            print(f"No Internet connection / Modem found, restarting Modem. Counter:{self.error_counter}")
-            if self._reset_modem():
+            time.sleep(config.INTERNET_WATCHDOG_CHECK_INTERVAL)
+            now = time.monotonic()
+            if self._internet_connected() and self._modem_present():
+                self._recovered(now)
                 continue
+            if self.outage_start is None:
+                self.outage_start = now
+                self.next_step = now + self.interval
+                prt.GLOBAL_ENTITY.warning("No Internet connection / Modem found")
+            if now >= self.next_step:
+                self._escalate(now)
+
+    def _recovered(self, now: float) -> None:
+        if self.outage_start is None:
+            return
+        self.last_outage = now - self.outage_start
+        self.last_recovery = 0. if self.last_action is None else now - self.last_action
+        self.outage_time += self.last_outage
+        self.outages += 1
+        prt.GLOBAL_ENTITY.info(f"Internet connection back after {round(self.last_outage)} seconds, recovery took {round(self.last_recovery)} seconds")
+        self.outage_start = None
+        self.last_action = None
+        self.step = 0
+        self.error_counter = 0
+
+    def _escalate(self, now: float) -> None:
+        step = ESCALATION[min(self.step, len(ESCALATION) - 1)]
+        self.error_counter += 1
+        prt.GLOBAL_ENTITY.warning(f"No Internet connection / Modem found, escalation step: {step}. Counter:{self.error_counter}")
+        if step == STEP_RECONNECT and not self._reconnect():
+            step = STEP_RESET
+        if step == STEP_RESET and not self._reset_modem():
+            step = STEP_POWER_CYCLE
+        if step == STEP_POWER_CYCLE:
             self._restart_modem()
+        self.last_action = time.monotonic()
+        # give every step more time than the previous one before trying the next
+        backoff = min(self.interval * 2 ** self.step, config.INTERNET_WATCHDOG_MAX_BACKOFF)
+        self.next_step = self.last_action + backoff
+        self.step += 1
+
+    def _modem_present(self) -> bool:
+        # the modem number is only known if the modem handler polls the modem
+        if self.modem_handler_instance is None or not config.GPS_POLL_ENABLE:
+            return True
+        return self.modem_handler_instance.get_mm_number() != -1
 
     def _restart_modem(self) -> None:
+        prt.GLOBAL_ENTITY.info("Power cycling modem")
         self.GPIO.output(config.INTERNET_WATCHDOG_MODEM_POWER_PIN, True)
         time.sleep(5)
         self.GPIO.output(config.INTERNET_WATCHDOG_MODEM_POWER_PIN, False)
 
-    def _reset_modem(self) -> bool:
+    def _mmcli(self, *args: str) -> bool:
+        modem_number = -1 if self.modem_handler_instance is None else self.modem_handler_instance.get_mm_number()
+        if modem_number == -1:
+            prt.GLOBAL_ENTITY.error(f"No Modem Found. cannot run mmcli {' '.join(args)}")
+            return False
         try:
-            modem_number = self.modem_handler_instance.get_mm_number()
-            if modem_number == -1:
-                print("No Modem Found. cannot reset")
-                return False
-            print(f"Resetting modem {modem_number}")
-            result = subprocess.run(
-                ["mmcli", "-m", str(modem_number), "--reset"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            print("Modem reset successful:", result.stdout)
+            subprocess.run(["mmcli", "-m", str(modem_number), *args], capture_output=True, text=True, check=True, timeout=60)
             return True
         except subprocess.CalledProcessError as e:
-            print("Error resetting modem:", e.stderr)
-            return False
+            prt.GLOBAL_ENTITY.error(f"Error running mmcli {' '.join(args)}: {e.stderr}")
+        except subprocess.TimeoutExpired:
+            prt.GLOBAL_ENTITY.error(f"Timeout running mmcli {' '.join(args)}")
+        return False
 
-    # Adopted from: https://stackoverflow.com/questions/3764291
-    def _internet_connected(self, host: str = "1.1.1.1", port: int = 53, timeout: int = 10) -> bool:
-        try:
-            socket.setdefaulttimeout(timeout)
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
+    def _reconnect(self) -> bool:
+        prt.GLOBAL_ENTITY.info("Re-enabling modem")
+        return self._mmcli("--disable") and self._mmcli("--enable")
+
+    def _reset_modem(self) -> bool:
+        prt.GLOBAL_ENTITY.info("Resetting modem")
+        return self._mmcli("--reset")
+
+    def _internet_connected(self) -> bool:
+        # passive signals first, they cost nothing
+        if self.mqtt_instance is not None and self.mqtt_instance.get_connected():
+            return True
+        if self.modem_handler_instance is not None and self.modem_handler_instance.get_modem_state() == MM_MODEM_STATE_CONNECTED:
+            return True
+        counters = get_wwan_counters()
+        rx_bytes = None if counters is None else counters[1]
+        received = rx_bytes is not None and self.last_rx_bytes is not None and rx_bytes > self.last_rx_bytes
+        self.last_rx_bytes = rx_bytes
+        if received:
             return True
-        except socket.error:
+        return self._probe()
+
+    def _probe(self, host: str = "1.1.1.1", port: int = 53, timeout: float = 10) -> bool:
+        self.probes += 1
+        try:
+            # the timeout applies to this socket only, the socket is closed when the block is left
+            with socket.create_connection((host, port), timeout=timeout):
+                return True
+        except OSError:
             return False
 
 
@@ -0,0 +1,128 @@
+from typing import Any, Dict, List, Optional, Union
+import multiprocessing
+import queue
+import signal
+import threading
+import config
+import prt
+from sample_ring import SharedSampleRing
+
+# With IO_PROCESS_ENABLE the acquisition process only samples, runs the heater and drives the display.
+# It writes every sample into a shared memory ring, see sample_ring.py. The io process reads the ring and does the
+# averaging, CSV logging and MQTT publishing, so pandas, json and paho never hold the GIL of the sampling process.
+# Once a minute the acquisition process sends what is not part of the samples through a queue:
+# the particle size distribution, its telemetry and the timestamps of the minute.
+# The other way round the io process shares the state of mqtt and logging through IOStatus, for the display and the
+# internet watchdog of the acquisition process.
+
+READ_INTERVAL = 0.2  # seconds between checks for new samples
+MINUTE_QUEUE_SIZE = 10  # minutes the io process may fall behind before minute data is dropped
+STOP_TIMEOUT = 10  # seconds the io process gets to flush its logs and disconnect
+LOGGER_STATE_SIZE = 32  # bytes of the logger state shared with the acquisition process
+
+
+class IOStatus:
+    """State of the io drivers in shared memory, written by the io process, stands in for mqtt and logging elsewhere"""
+    def __init__(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.mqtt_connected = context.Value("b", False)
+        self.logger_state = context.Array("c", LOGGER_STATE_SIZE)
+        self.logger_state.value = b"not running"
+
+    def update(self, plugins: Any) -> None:
+        """Called by the io process with its started drivers"""
+        self.mqtt_connected.value = "mqtt" in plugins and plugins["mqtt"].get_connected()
+        logger_state = plugins["logging"].get_logger_state() if "logging" in plugins else "not running"
+        self.logger_state.value = logger_state.encode()[:LOGGER_STATE_SIZE]
+
+    def get_connected(self) -> bool:
+        return bool(self.mqtt_connected.value)
+
+    def get_logger_state(self) -> str:
+        return self.logger_state.value.decode(errors="ignore")
+
+
+_status: Optional[IOStatus] = None
+_status_lock = threading.Lock()
+
+
+def get_io_status() -> IOStatus:
+    """The single shared status of the acquisition process, the io process gets it passed on start"""
+    global _status
+    with _status_lock:
+        if _status is None:
+            _status = IOStatus()
+        return _status
+
+
+class IOProcess:
+    """The acquisition side: owns the ring and the io process, restarts the io process if it died"""
+    def __init__(self, fields: List[str]) -> None:
+        self.ring = SharedSampleRing(fields=fields, slots=config.IO_PROCESS_RING_SLOTS)
+        # spawn instead of fork, the io process must not inherit the sensor threads, bus handles and locks
+        self.context = multiprocessing.get_context("spawn")
+        self.minute_queue = self.context.Queue(maxsize=MINUTE_QUEUE_SIZE)
+        self.status = get_io_status()
+        self.process: Optional[multiprocessing.Process] = None
+        self.restarts = 0
+        self._start()
+        prt.GLOBAL_ENTITY.info(f"Started io process with a ring of {config.IO_PROCESS_RING_SLOTS} samples of {len(fields)} values")
+
+    def _start(self) -> None:
+        self.process = self.context.Process(target=run, args=(self.ring.shm.name, self.minute_queue, self.status), name="io",
+                                            daemon=True)
+        self.process.start()
+
+    def write(self, timestamp: float, gps_timestamp: Union[float, str], data: Dict[str, Any]) -> None:
+        self.ring.write(timestamp, gps_timestamp, data)
+
+    def send_minute(self, psd_data: Dict[str, float], telemetry: Dict[str, Any], timestamp: float,
+                    gps_timestamp: Union[float, str]) -> None:
+        if not self.process.is_alive():
+            prt.GLOBAL_ENTITY.error(f"io process exited with code {self.process.exitcode}, restarting it")
+            self.restarts += 1
+            self._start()
+        try:
+            self.minute_queue.put_nowait({"psd": psd_data, "tele": telemetry, "timestamp": timestamp,
+                                          "gps_timestamp": gps_timestamp})
+        except queue.Full:
+            prt.GLOBAL_ENTITY.print_once("io process is not keeping up, dropping minute data", "io process caught up", 130)
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        return {"io_process_restarts": self.restarts}
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+        self.ring.close()
+
+
+def run(ring_name: str, minute_queue: multiprocessing.Queue, status: IOStatus) -> None:
+    """The io process: the second and minute handling of main.py with only the io drivers started"""
+    # main is imported here and not at the top, it imports this module
+    import main
+
+    prt.GLOBAL_ENTITY = prt.EventLogger()
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda _signum, _frame: stopping.set())
+    main.plugins.start_enabled(io=True)
+    ring = SharedSampleRing(name=ring_name)
+
+    while not stopping.is_set():
+        try:
+            message = minute_queue.get(timeout=READ_INTERVAL)
+        except queue.Empty:
+            message = None
+        for timestamp, gps_timestamp, data in ring.read_new():
+            main.process_second(data, timestamp, gps_timestamp)
+        status.update(main.plugins)
+        if message is not None:
+            main.remote_telemetry = dict(message["tele"], sample_ring_lost=ring.lost)
+            main.process_minute(message["psd"], message["timestamp"], message["gps_timestamp"])
+
+    main.plugins.stop()
+    ring.close()
+    prt.GLOBAL_ENTITY.flush()
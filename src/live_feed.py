@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional, Union
+import argparse
+import mmap
+import os
+import time
+from sample_ring import Sample, SampleRing, ring_size
+
+# Latest samples for other containers on the node, e.g. a local dashboard, without network or serialization.
+# The node keeps a sample ring (see sample_ring.py) in a memory mapped file on a shared tmpfs and writes every second
+# into it, readers map the same file and copy samples straight out of the page cache, the seqlock of every slot
+# makes sure they never get a half written one. This file only needs the standard library and sample_ring.py,
+# copy both into the other container to read the feed:
+#
+#   feed = LiveFeedReader("/dev/shm/live_feed.ring")
+#   timestamp, gps_timestamp, data = feed.latest()
+#   history = feed.history(60)
+
+
+class LiveFeedWriter:
+    """Lays out a new ring in a file at path and appends samples, the file is replaced atomically on every start"""
+    def __init__(self, path: str, fields: List[str], slots: int) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # readers that still have the previous file mapped keep reading it until they notice the new one
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w+b") as f:
+            f.truncate(ring_size(len(fields), slots))
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.ring = SampleRing(memoryview(self.map), fields, slots)
+        os.replace(tmp_path, path)
+
+    def write(self, timestamp: float, gps_timestamp: Union[float, str], data: Dict[str, Any]) -> None:
+        self.ring.write(timestamp, gps_timestamp, data)
+
+    def stop(self) -> None:
+        self.ring.release()
+        self.map.close()
+
+
+class LiveFeedReader:
+    """Reads the feed written by the node, follows the file if the node restarts and lays out a new one"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.inode: Optional[int] = None
+        self.map: Optional[mmap.mmap] = None
+        self.ring: Optional[SampleRing] = None
+
+    def _open(self) -> bool:
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+        if inode == self.inode:
+            return True
+        self.close()
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ring = SampleRing(memoryview(self.map))
+        self.inode = inode
+        return True
+
+    def get_fields(self) -> List[str]:
+        return self.ring.fields if self._open() else []
+
+    def latest(self) -> Optional[Sample]:
+        """(timestamp, gps timestamp, data) of the latest sample, None if there is none yet"""
+        samples = self.history(1)
+        return samples[0] if samples else None
+
+    def history(self, count: int) -> List[Sample]:
+        """Up to count of the latest samples, oldest first, at most as many as the ring has slots"""
+        if not self._open():
+            return []
+        return self.ring.read_latest(count)
+
+    def read_new(self) -> List[Sample]:
+        """The samples written since the last call, the first call returns nothing"""
+        if not self._open():
+            return []
+        return list(self.ring.read_new())
+
+    def close(self) -> None:
+        if self.ring is not None:
+            self.ring.release()
+            self.map.close()
+        self.ring = None
+        self.map = None
+        self.inode = None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Print the live feed of the node")
+    parser.add_argument("path", nargs="?", default="/dev/shm/live_feed.ring", help="ring file written by the node")
+    parser.add_argument("--history", type=int, default=0, help="print this many of the latest samples first")
+    args = parser.parse_args(argv)
+
+    feed = LiveFeedReader(args.path)
+    for sample in feed.history(args.history):
+        print(sample)
+    while True:
+        for sample in feed.read_new():
+            print(sample)
+        time.sleep(0.2)
+
+
+if __name__ == "__main__":
+    main()
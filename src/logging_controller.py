@@ -40,7 +40,7 @@ class LoggingController:
         if config.LOGGING_RAW_ENABLE or config.LOGGING_AVG_ENABLE:
             # save first start timestamp if rsync is enabled
             if config.LOGGING_RSYNC_ENABLE:
-                print(f"Rsync enabled, copying CSV files to USB every: {config.LOGGING_RSYNC_INTERVAL} seconds")
+                prt.GLOBAL_ENTITY.info(f"Rsync enabled, copying CSV files to USB every: {config.LOGGING_RSYNC_INTERVAL} seconds")
                 self.rsync_timestamp = time.time()
             # if any logging is enabled, make sure directory exists
             os.makedirs(config.LOGGING_DIRECTORY, exist_ok=True)
@@ -76,12 +76,12 @@ class LoggingController:
         try:
             output = run(cmd, stdout=PIPE, stderr=PIPE, timeout=60)
             if config.LOGGING_RSYNC_DEBUG:
-                print(output.stdout.decode())
-                print(output.stderr.decode())
+                prt.GLOBAL_ENTITY.info(output.stdout.decode())
+                prt.GLOBAL_ENTITY.info(output.stderr.decode())
             self.rsync_last_runtime = round(time.time() - start_timestamp, config.DIGIT_ACCURACY)
         except Exception as e:
             self.rsync_last_runtime = -1
-            print(f"Rsync failed to run, dump: {e}")
+            prt.GLOBAL_ENTITY.error(f"Rsync failed to run, dump: {e}")
         self.rsync_timestamp = time.time()
 
     def _logging_worker(self) -> None:
@@ -98,7 +98,7 @@ class LoggingController:
                     self._write_log_data(item)
                     self.logger_state = "working" if self.data_queue.empty() else "backlog"
                 except Exception as e:
-                    print(f"Failed to run {item[0]} logger, dump {e}")
+                    prt.GLOBAL_ENTITY.error(f"Failed to run {item[0]} logger, dump {e}")
                     self.logger_state = "error"
                     self._reset_loggers()
                     time.sleep(10)
@@ -148,7 +148,7 @@ class LoggingController:
         if logger_selector == "raw":
             file = config.LOGGING_DIRECTORY + config.NODE_ID + "_raw_every_second_data.log"
             if self.raw_logger is None:
-                print("Trying to generate raw logger")
+                prt.GLOBAL_ENTITY.info("Trying to generate raw logger")
                 self.raw_logger = self._setup_midnightlogger('raw_logger', file,
                                                              self._generate_csv_header_from_list(list(data.keys())))
             self.raw_logger.info(self._dict_to_csv(data))
@@ -156,20 +156,20 @@ class LoggingController:
         elif logger_selector == "avg":
             file = config.LOGGING_DIRECTORY + config.NODE_ID + "_avg_every_minute_data.log"
             if self.avg_logger is None:
-                print("Trying to generate avg logger")
+                prt.GLOBAL_ENTITY.info("Trying to generate avg logger")
                 self.avg_logger = self._setup_midnightlogger('avg_logger', file,
                                                              self._generate_csv_header_from_list(list(data.keys())))
             self.avg_logger.info(self._dict_to_csv(data))
 
         else:
-            print("wrong key:", logger_selector, "you cannot select a logger that does not exist")
+            prt.GLOBAL_ENTITY.error(f"wrong key: {logger_selector} you cannot select a logger that does not exist")
             raise KeyError
 
         # now check if we just wrote successfully
         last_write_time = self._get_time_since_last_write(file)
         # print("last write for", logger_selector, round(last_write_time, 2), "seconds ago")
         if last_write_time > 1 and self.data_queue.empty():
-            print(f"last {logger_selector} logger entry is too old, restarting loggers")
+            prt.GLOBAL_ENTITY.warning(f"last {logger_selector} logger entry is too old, restarting loggers")
             raise OSError
         timeout = 2 if logger_selector == "raw" else 65
         prt.GLOBAL_ENTITY.print_once(f"{logger_selector} logger started",
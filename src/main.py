@@ -3,12 +3,12 @@ import logging
 import sys
 import time
 from signal import signal, SIGINT, SIGTERM
-from typing import List, Dict, Any, Optional
+from typing import Dict, Any, Optional, Union
 from types import FrameType
-import pandas as pd
 from apscheduler.schedulers.blocking import BlockingScheduler
 import config
 import prt
+from averaging import calculate_mean_data
 from system_metrics import (
     get_cpu_temp,
     get_cpu_usage,
@@ -17,115 +17,67 @@ from system_metrics import (
     get_usb_drive_usage,
     get_total_data_usage,
     get_ram_usage,
+    get_process_age,
 )
-from adc_handler import ADCHandler
-from heating_controller import HeatingController
-from hyt_handler import HYTHandler
-from logging_controller import LoggingController
-from modem_handler import ModemHandler
-from modem_handler_dbus import ModemHandlerDBus
-from mqtt_controller import MQTTController
-from oled_controller import OLEDController
-from one_wire_handler import OneWireHandler
-from opc_handler import OPCHandler
-from prt import OncePrinter
-from sht_handler import SHTHandler
-from internet_watchdog import InternetWatchdog
+from drivers import Plugins
+from i2c_arbiter import get_i2c_telemetry
+from io_process import IOProcess
+from live_feed import LiveFeedWriter
+from prt import EventLogger, EventLogHandler
 
 
 ### GLOBAL VARS ###
 # List for storing and averaging sensor data dicts
 minute_data = []
+# Seconds from process start until sampling started, see main()
+startup_time = 0.
+# Telemetry of the acquisition process, received by the io process once a minute, see io_process.py
+remote_telemetry: Dict[str, Any] = {}
 
 ### GLOBAL INSTANCES ###
 # This scheduler calls the everySecond and everyMinute functions
 scheduler = BlockingScheduler()
-# This instantiates the single OncePrinter used across all modules
-prt.GLOBAL_ENTITY = OncePrinter()
-# This reads gps and signal strength data from the modem periodically
-if config.GPS_POLL_USE_DBUS:
-    modem = ModemHandlerDBus()
-else:
-    modem = ModemHandler()
-# This object will log average and raw data to a usb drive
-logg = LoggingController()
-# This instantiates a mqtt object and tries to connect if configured
-if config.MQTT_ENABLE:
-    mqtt = MQTTController()
-# Start measurement air heater controller if configured
-if config.HEATER_ENABLE:
-    heat = HeatingController()
-# Start oled display controller if configured
-if config.OLED_ENABLE:
-    oled = OLEDController()
-# This watchdog keeps the internet connection alive by restarting the modem
-if config.INTERNET_WATCHDOG_ENABLE:
-    watchdog = InternetWatchdog(interval=config.INTERNET_WATCHDOG_INTERVAL, modem_handler_instance=modem)
-
-
-### SENSOR INIT ###
-try:
-    if config.OPC_ENABLE:
-        opc = OPCHandler()
-    if config.SHT_ENABLE:
-        sht = SHTHandler()
-    if config.HYT_ENABLE:
-        hyt = HYTHandler()
-    if config.ADC_ENABLE:
-        adc = ADCHandler()
-    if config.ONE_WIRE_ENABLE:
-        one_wire = OneWireHandler()
-    print("Sensor startup successful")
-except Exception as e:
-    print(f"Sensor startup failed, dump: {e}")
-    sys.exit()
-
-time.sleep(10)  # Wait for all sensors to come online
+# The enabled sensors and actuators by name, started in main(), see drivers.py
+plugins = Plugins()
+# Averaging, logging and publishing process, only with IO_PROCESS_ENABLE
+io_process_instance: Optional[IOProcess] = None
+# Latest samples for other containers on the node, only with LIVE_FEED_ENABLE
+live_feed_instance: Optional[LiveFeedWriter] = None
 
 
 def get_all_data() -> Dict[str, float]:
-    ret = {}
-    # get sensor data
-    if config.OPC_ENABLE:
-        ret.update(opc.get_data())
-    if config.SHT_ENABLE:
-        ret.update(sht.get_data())
-    if config.HYT_ENABLE:
-        ret.update(hyt.get_data())
-    if config.ADC_ENABLE:
-        ret.update(adc.get_data())
-    if config.ONE_WIRE_ENABLE:
-        ret.update(one_wire.get_data())
-    # get telemetry
-    if config.HEATER_ENABLE:
-        ret.update(heat.get_data())
-    ret.update(modem.get_data())
+    # sensor data, heater power and modem data
+    return plugins.get_data()
+
+
+def get_all_telemetry() -> Dict[str, Any]:
+    ret = plugins.get_telemetry()
+    ret.update(get_i2c_telemetry())
+    ret.update(prt.GLOBAL_ENTITY.get_telemetry())
+    if io_process_instance is not None:
+        ret.update(io_process_instance.get_telemetry())
+    ret["startup_time"] = round(startup_time, 1)
+    if "mqtt" in plugins and plugins["mqtt"].get_first_publish_time() is not None:
+        ret["first_publish_time"] = round(plugins["mqtt"].get_first_publish_time(), 1)
     return ret
 
 
-def calculate_mean_data(collected_data: List[Dict[str, float]]) -> Optional[Dict[str, float]]:
-    try:
-        mean_df = pd.DataFrame(collected_data).mean()
-        ret = mean_df.fillna(0).to_dict()
-    except ValueError as e:
-        print(f"Averaging minute data failed, skipping this minute. Error dump: {e}")
-        return None
-    # Make sure lat/lon coordinates have 6 decimal digits while the rest has the configured amount
-    return {
-        key: round(val, config.DIGIT_ACCURACY if key not in ["lat", "lon"] else 6)
-        for key, val in ret.items()
-    }
+def get_gps_timestamp() -> Union[float, str]:
+    return plugins["modem"].get_gps_timestamp() if "modem" in plugins else "unknown"
 
 
-def append_timestamps_to(data: Dict[str, Any]) -> Dict[str, Any]:
+def append_timestamps_to(data: Dict[str, Any], timestamp: Optional[float] = None,
+                         gps_timestamp: Optional[Union[float, str]] = None) -> Dict[str, Any]:
+    """Adds the given timestamps, the current ones if they are left out"""
     ret = dict(data)
-    ret["timestamp"] = time.time()
-    ret["timestamp_hr"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ret["timestamp_gps"] = modem.get_gps_timestamp()
+    ret["timestamp"] = time.time() if timestamp is None else timestamp
+    ret["timestamp_hr"] = datetime.datetime.fromtimestamp(ret["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+    ret["timestamp_gps"] = get_gps_timestamp() if gps_timestamp is None else gps_timestamp
     return ret
 
 
-def generate_publishing_message(mean_data: Dict[str, float]) -> Dict[str, Any]:
+def generate_publishing_message(mean_data: Dict[str, float], timestamp: Optional[float] = None,
+                                gps_timestamp: Optional[Union[float, str]] = None) -> Dict[str, Any]:
     # move these 5 averaged telemetry entries from data to tele
     heater_buffer = mean_data.pop("heater", 0)
     lat_buffer = mean_data.pop("lat", 0)
@@ -149,13 +101,16 @@ def generate_publishing_message(mean_data: Dict[str, float]) -> Dict[str, Any]:
             "cpu_load": get_cpu_usage(),
             "cpu_temp": get_cpu_temp(),
             "uptime": get_uptime(),
-            "modem_num": modem.get_mm_number(),
-            "logger_state": logg.get_logger_state(),
-            "logger_queue": logg.get_logger_queue_size(),
-            "rsync_runtime": logg.get_last_rsync_runtime(),
+            "modem_num": plugins["modem"].get_mm_number() if "modem" in plugins else -1,
         },
     }
-    return append_timestamps_to(ret)
+    if "logging" in plugins:
+        ret["tele"]["logger_state"] = plugins["logging"].get_logger_state()
+        ret["tele"]["logger_queue"] = plugins["logging"].get_logger_queue_size()
+        ret["tele"]["rsync_runtime"] = plugins["logging"].get_last_rsync_runtime()
+    ret["tele"].update(get_all_telemetry())
+    ret["tele"].update(remote_telemetry)
+    return append_timestamps_to(ret, timestamp, gps_timestamp)
 
 
 def remove_raw_data_from(data: Dict[str, Any]) -> Dict[str, Any]:
@@ -168,75 +123,95 @@ def remove_none_from(data: Dict[str, Any]) -> Dict[str, Any]:
 
 def update_oled_display(data: Dict[str, Any]) -> None:
     data_clean = remove_raw_data_from(data)
-    mqtt_state = mqtt.get_connected() if config.MQTT_ENABLE else False
-    modem_mm = modem.get_mm_number()
-    log_state = logg.get_logger_state()
-    oled.update_view(data_clean, mqtt_state, modem_mm, log_state)
+    # with IO_PROCESS_ENABLE mqtt and logging run in the io process, it shares their state, see io_process.py
+    io_status = io_process_instance.status if io_process_instance is not None else None
+    mqtt = plugins.get("mqtt") or io_status
+    logger = plugins.get("logging") or io_status
+    mqtt_state = mqtt.get_connected() if mqtt is not None else False
+    modem_mm = plugins["modem"].get_mm_number() if "modem" in plugins else -1
+    log_state = logger.get_logger_state() if logger is not None else "not running"
+    plugins["oled"].update_view(data_clean, mqtt_state, modem_mm, log_state)
 
 
 def every_second() -> None:
     second_data = get_all_data()
-    minute_data.append(second_data)
-    if config.HEATER_ENABLE:
-        heat.update_heating(second_data)
-    if config.OLED_ENABLE and config.OLED_RAW:
+    if "heater" in plugins:
+        plugins["heater"].update_heating(second_data)
+    # the averages are only known to the io process, so the display shows the raw data if there is one
+    if "oled" in plugins and (config.OLED_RAW or io_process_instance is not None):
         update_oled_display(second_data)
-    if config.LOGGING_RAW_ENABLE:
+    timestamp = time.time()
+    gps_timestamp = get_gps_timestamp()
+    if live_feed_instance is not None:
+        try:
+            live_feed_instance.write(timestamp, gps_timestamp, second_data)
+        except Exception as e:
+            prt.GLOBAL_ENTITY.print_once(f"Failed to write the live feed, dump: {e}", "Live feed written again")
+    if io_process_instance is not None:
+        io_process_instance.write(timestamp, gps_timestamp, second_data)
+        return
+    process_second(second_data, timestamp, gps_timestamp)
+
+
+def process_second(second_data: Dict[str, Any], timestamp: Optional[float] = None,
+                   gps_timestamp: Optional[Union[float, str]] = None) -> None:
+    """Collects, logs and publishes the data of one second, called by the io process with the sample timestamps"""
+    minute_data.append(second_data)
+    if config.LOGGING_RAW_ENABLE and "logging" in plugins:
         # Remove None (missing sensor data) to get 0 entries in CSV Log
-        logg.log_data_to("raw", append_timestamps_to(remove_none_from(second_data)))
-    if not config.MQTT_PUBLISH_EVERY_SECOND:
+        plugins["logging"].log_data_to("raw", append_timestamps_to(remove_none_from(second_data), timestamp, gps_timestamp))
+    if not config.MQTT_PUBLISH_EVERY_SECOND or "mqtt" not in plugins:
         return
     if config.PUBLISH_RAW_OPC_AND_ADC:
-        mqtt.publish_data(generate_publishing_message(remove_none_from(second_data)))
+        plugins["mqtt"].publish_data(generate_publishing_message(remove_none_from(second_data), timestamp, gps_timestamp))
     else:
-        mqtt.publish_data(generate_publishing_message(remove_raw_data_from(second_data)))
+        plugins["mqtt"].publish_data(generate_publishing_message(remove_raw_data_from(second_data), timestamp, gps_timestamp))
 
 
 def every_minute() -> None:
+    psd_data = plugins["opc"].get_psd_data() if "opc" in plugins else {}
+    if io_process_instance is not None:
+        telemetry = get_all_telemetry()
+        telemetry["modem_num"] = plugins["modem"].get_mm_number() if "modem" in plugins else -1
+        io_process_instance.send_minute(psd_data, telemetry, time.time(), get_gps_timestamp())
+        return
+    process_minute(psd_data)
+
+
+def process_minute(psd_data: Dict[str, float], timestamp: Optional[float] = None,
+                   gps_timestamp: Optional[Union[float, str]] = None) -> None:
+    """Averages, logs and publishes the collected seconds, called by the io process with the minute timestamps"""
     avg_data = calculate_mean_data(minute_data)
     minute_data.clear()
     if avg_data is None:
         return
-    if config.OLED_ENABLE and not config.OLED_RAW:
+    avg_data.update(psd_data)
+    if "oled" in plugins and not config.OLED_RAW:
         update_oled_display(avg_data)
-    if config.LOGGING_AVG_ENABLE:
+    if config.LOGGING_AVG_ENABLE and "logging" in plugins:
         # Average data does not contain None, see calculate_mean_data()
-        logg.log_data_to("avg", append_timestamps_to(avg_data))
-    if not config.MQTT_ENABLE:
+        plugins["logging"].log_data_to("avg", append_timestamps_to(avg_data, timestamp, gps_timestamp))
+    if "mqtt" not in plugins:
         return
     if config.MQTT_PUBLISH_EVERY_SECOND:
         return
     if config.PUBLISH_RAW_OPC_AND_ADC:
-        mqtt.publish_data(generate_publishing_message(avg_data))
+        plugins["mqtt"].publish_data(generate_publishing_message(avg_data, timestamp, gps_timestamp))
     else:
-        mqtt.publish_data(generate_publishing_message(remove_raw_data_from(avg_data)))
+        plugins["mqtt"].publish_data(generate_publishing_message(remove_raw_data_from(avg_data), timestamp, gps_timestamp))
 
 
 def exit_handler(signum: int, _frame: Optional[FrameType]) -> None:
-    print("Received Signal: ", str(signum), "\nCleaning up")
-    # Stop heater with highest priority
-    if config.HEATER_ENABLE:
-        heat.stop()
-        print("Heater controller stopped")
+    prt.GLOBAL_ENTITY.info(f"Received Signal: {signum}, cleaning up")
     scheduler.shutdown(wait=False)
-    modem.stop()
-    logg.stop()
-    ### Sensor cleanup ###
-    if config.SHT_ENABLE:
-        sht.stop()
-    if config.OLED_ENABLE:
-        oled.stop()
-    if config.OPC_ENABLE:
-        opc.stop()
-    if config.HYT_ENABLE:
-        hyt.stop()
-    if config.ADC_ENABLE:
-        adc.stop()
-    if config.ONE_WIRE_ENABLE:
-        one_wire.stop()
-    if config.MQTT_ENABLE:
-        mqtt.stop()
-    print("Cleanup completed")
+    # Stops the heater with highest priority, then everything else in reverse start order
+    plugins.stop()
+    if io_process_instance is not None:
+        io_process_instance.stop()
+    if live_feed_instance is not None:
+        live_feed_instance.stop()
+    prt.GLOBAL_ENTITY.info("Cleanup completed")
+    prt.GLOBAL_ENTITY.flush()
     sys.exit(0)
 
 def get_next_full_minute():
@@ -244,6 +219,35 @@ def get_next_full_minute():
 
 
 def main() -> None:
+    # This instantiates the single EventLogger used across all modules, records of the logging module go to it as well
+    prt.GLOBAL_ENTITY = EventLogger()
+    logging.getLogger().addHandler(EventLogHandler())
+    logging.getLogger().setLevel(logging.INFO)
+
+    # Import and start the enabled sensors, actuators, modem, loggers and display concurrently, see drivers.py
+    # Drivers that fail to start are left out, sampling starts once every sensor delivered its first valid sample
+    global startup_time, io_process_instance, live_feed_instance
+    # With IO_PROCESS_ENABLE logging and mqtt are started by the io process instead
+    plugins.start_enabled(io=False if config.IO_PROCESS_ENABLE else None)
+    not_ready = plugins.wait_ready(config.STARTUP_READY_TIMEOUT)
+    if not_ready:
+        prt.GLOBAL_ENTITY.warning(f"Sensor startup incomplete, starting without a valid sample from: {', '.join(not_ready)}")
+    else:
+        prt.GLOBAL_ENTITY.info("Sensor startup successful")
+    plugins.print_report()
+    # the sample layout is fixed from here on, every sensor returns the same keys in every call
+    fields = list(get_all_data().keys())
+    if config.IO_PROCESS_ENABLE:
+        io_process_instance = IOProcess(fields)
+    if config.LIVE_FEED_ENABLE:
+        try:
+            live_feed_instance = LiveFeedWriter(config.LIVE_FEED_PATH, fields, config.LIVE_FEED_SLOTS)
+            prt.GLOBAL_ENTITY.info(f"Writing the live feed to: {config.LIVE_FEED_PATH}")
+        except OSError as e:
+            prt.GLOBAL_ENTITY.error(f"Failed to create the live feed at: {config.LIVE_FEED_PATH}, continuing without it, dump: {e}")
+    startup_time = get_process_age()
+    prt.GLOBAL_ENTITY.info(f"Sampling starts {round(startup_time, 1)} seconds after process start")
+
     # capture exit signals (from tini if running in docker container)
     signal(SIGINT, exit_handler)
     signal(SIGTERM, exit_handler)
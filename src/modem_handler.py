@@ -1,19 +1,57 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple, Union
 import time
-from subprocess import STDOUT, check_output
 import threading
+import dbus
 import prt
 import config
+from gps_lock import PositionLock
+from nmea import parse_cgpsinfo
+
+MM_SERVICE = "org.freedesktop.ModemManager1"
+MM_PATH = "/org/freedesktop/ModemManager1"
+MM_MODEM_INTERFACE = "org.freedesktop.ModemManager1.Modem"
+# DBus errors meaning the cached modem object is gone, e.g. after a modem reset or a ModemManager restart
+MM_GONE_ERRORS = (
+    "org.freedesktop.DBus.Error.UnknownObject",
+    "org.freedesktop.DBus.Error.UnknownMethod",
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NoReply",
+    "org.freedesktop.DBus.Error.Disconnected",
+)
+# DBus errors of a command that did not get an answer in time, they say nothing about the command itself
+MM_TIMEOUT_ERRORS = (
+    "org.freedesktop.ModemManager1.Error.Core.Timeout",
+    "org.freedesktop.DBus.Error.Timeout",
+)
+# GPS and signal strength in one round trip, the SIM7600 answers both in one response
+AT_BATCH_QUERY = "AT+CGPSINFO;+CSQ"
+# consecutive rejected batch queries until the modem is queried with one command per query
+BATCH_MAX_FAILURES = 3
+AT_TIMEOUT = 2  # seconds ModemManager waits for the modem to answer an AT command
+GPS_ENABLE_RETRY = 10  # seconds between attempts to enable the GPS while there is no fix
 
 
 class ModemHandler:
+    """
+    Reads GPS and signal strength of a SIM7600 with AT commands sent through ModemManager.
+    The DBus connection and the modem object are kept until the modem disappears, Modem.Command needs ModemManager in debug mode.
+    """
 
     def __init__(self):
         self.gps_timestamp = "unknown"
         self.current_gps_data = {"lat": None, "lon": None, "alt": None, "rssi": None}
         self.modem_num = -1
+        self.modem: Optional[dbus.Interface] = None
+        self.batch_supported = True
+        self.batch_failures = 0
+        self.last_gps_enable = 0.
+        self.gps_active = True  # GNSS engine running, it is only powered down while the position is locked
+        self.lock = PositionLock()
+        # query name -> (count, total latency, max latency) since the last get_telemetry call
+        self.query_stats: Dict[str, Tuple[int, float, float]] = {}
 
         if config.GPS_POLL_ENABLE:
+            self.bus = dbus.SystemBus()
             self.thread = threading.Thread(target=self._modem_worker)
             self.thread.daemon = True
             self.thread.start()
@@ -21,91 +59,177 @@ class ModemHandler:
     def get_data(self) -> Dict[str, Any]:
         return self.current_gps_data
 
-    def get_gps_timestamp(self) -> str:
+    def get_gps_timestamp(self) -> Union[float, str]:
         return self.gps_timestamp
 
     def get_mm_number(self) -> int:
         return self.modem_num
 
+    def get_modem_state(self) -> Optional[int]:
+        """MMModemState of the modem as ModemManager reports it, None without a modem"""
+        modem = self.modem
+        if modem is None:
+            return None
+        try:
+            properties = dbus.Interface(modem.proxy_object, "org.freedesktop.DBus.Properties")
+            return int(properties.Get(MM_MODEM_INTERFACE, "State"))
+        except dbus.DBusException:
+            return None
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        """Mean and max latency of every ModemManager query since the last call in ms"""
+        stats, self.query_stats = self.query_stats, {}
+        ret = {}
+        for name, (count, total, maximum) in stats.items():
+            ret[f"modem_{name}_latency"] = round(1000 * total / count, config.DIGIT_ACCURACY)
+            ret[f"modem_{name}_max_latency"] = round(1000 * maximum, config.DIGIT_ACCURACY)
+        ret.update(self.lock.get_telemetry())
+        return ret
+
     def _modem_worker(self) -> None:
-        time.sleep(20)
-        print("Started GPS polling thread")
+        # no startup delay, until ModemManager found the modem every poll reports the GPS as disconnected
+        prt.GLOBAL_ENTITY.info("Started GPS polling thread")
+        next_poll = time.monotonic()
         while True:
             ret = {"lat": None, "lon": None, "alt": None, "rssi": None}
-            self._update_modem_number()
-            time.sleep(1)  # Without these qmicli times out
-            if self.modem_num != -1:
-                ret.update(self._get_gps_location())
-                time.sleep(1)  # Without these qmicli times out
-                ret["rssi"] = self._get_rssi()
-            else:
-                prt.GLOBAL_ENTITY.print_once("GPS disconnected", "GPS back online", 10)
+            try:
+                if self._get_modem() is not None:
+                    gps_due = self.lock.gps_due()
+                    self._set_gps_active(gps_due or not config.GPS_LOCK_POWER_DOWN)
+                    ret.update(self._query(gps_due))
+                    if self.lock.locked_position is not None:
+                        ret["lat"], ret["lon"], ret["alt"] = self.lock.locked_position
+                else:
+                    self.gps_timestamp = "unknown"
+                    prt.GLOBAL_ENTITY.print_once("GPS disconnected", "GPS back online", 10)
+            except dbus.DBusException as e:
+                self.gps_timestamp = "unknown"
+                if e.get_dbus_name() in MM_GONE_ERRORS:
+                    self._forget_modem()
+                prt.GLOBAL_ENTITY.print_once(f"Failed to query modem, dump: {e}", f"Error stopped occuring: Failed to query modem, dump: {e}", 10)
+            except Exception as e:
+                self.gps_timestamp = "unknown"
+                prt.GLOBAL_ENTITY.print_once(f"Failed to poll modem, dump: {e}", f"Error stopped occuring: Failed to poll modem, dump: {e}", 10)
             self.current_gps_data = ret
-            time.sleep(3)
+            next_poll = max(next_poll + config.GPS_POLL_INTERVAL, time.monotonic())
+            # a poll can take longer than the interval, AT_TIMEOUT is longer than the default GPS_POLL_INTERVAL
+            time.sleep(max(0., next_poll - time.monotonic()))
+
+    def _record_latency(self, name: str, start: float) -> None:
+        latency = time.monotonic() - start
+        count, total, maximum = self.query_stats.get(name, (0, 0., 0.))
+        self.query_stats[name] = (count + 1, total + latency, max(maximum, latency))
+
+    def _get_modem(self) -> Optional[dbus.Interface]:
+        """The cached modem interface, looked up once and again only after the modem disappeared"""
+        if self.modem is not None:
+            return self.modem
+        start = time.monotonic()
+        manager = dbus.Interface(self.bus.get_object(MM_SERVICE, MM_PATH), "org.freedesktop.DBus.ObjectManager")
+        for path, interfaces in manager.GetManagedObjects().items():
+            modem_num = path.split("/")[-1]
+            if MM_MODEM_INTERFACE in interfaces and modem_num.isdecimal():
+                self.modem = dbus.Interface(self.bus.get_object(MM_SERVICE, path), MM_MODEM_INTERFACE)
+                self.modem_num = int(modem_num)
+                self.batch_supported = True
+                self.batch_failures = 0
+                break
+        self._record_latency("lookup", start)
+        return self.modem
 
-    def _update_modem_number(self) -> None:
-        cmd = "mmcli -L | grep Modem | sed -e 's/\//\ /g' | awk '{print $5}'"
+    def _forget_modem(self) -> None:
+        self.modem = None
+        self.modem_num = -1
+        self.gps_active = True
+
+    def _command(self, name: str, cmd: str) -> str:
+        start = time.monotonic()
+        try:
+            return str(self.modem.Command(cmd, dbus.UInt32(AT_TIMEOUT)))
+        finally:
+            self._record_latency(name, start)
+
+    def _query(self, gps: bool) -> Dict[str, Any]:
+        response = None
+        if not gps:
+            # position is locked, only signal strength is needed
+            self.gps_timestamp = "unknown"
+            response = self._command("rssi", "AT+CSQ")
+        elif self.batch_supported:
+            try:
+                response = self._command("query", AT_BATCH_QUERY)
+                self.batch_failures = 0
+            except dbus.DBusException as e:
+                if e.get_dbus_name() in MM_GONE_ERRORS + MM_TIMEOUT_ERRORS:
+                    raise
+                # the modem answered with an error, query separately this time and for good if it keeps rejecting it
+                self.batch_failures += 1
+                if self.batch_failures >= BATCH_MAX_FAILURES:
+                    prt.GLOBAL_ENTITY.warning(f"Modem does not accept {AT_BATCH_QUERY}, querying GPS and signal strength separately")
+                    self.batch_supported = False
+        if response is None:
+            response = self._command("gps", "AT+CGPSINFO") + "\n" + self._command("rssi", "AT+CSQ")
+
+        ret = {"lat": None, "lon": None, "alt": None, "rssi": None}
+        for line in response.splitlines():
+            line = line.strip()
+            if line.startswith("+CGPSINFO:"):
+                ret.update(self._parse_gps_location(line))
+            elif line.startswith("+CSQ:"):
+                ret["rssi"] = self._parse_rssi(line)
+        return ret
+
+    def _set_gps_active(self, active: bool) -> None:
+        if active == self.gps_active:
+            return
+        if active:
+            # a failed enable is retried by the polls without a fix, see _parse_gps_location()
+            self.gps_active = True
+            self.last_gps_enable = 0.
+            self._enable_gps()
+            return
         try:
-            ret = check_output(cmd, shell=True, stderr=STDOUT, timeout=1).decode("utf-8").strip()
-            if ret != "" and ret.isdigit():
-                self.modem_num = int(ret)
-            else:
-                self.modem_num = -1
-        except Exception:
-            self.modem_num = -1
-
-    def _enable_gps(self) -> bool:
-        cmd = "mmcli -m " + str(self.modem_num) + " --command=AT+CGPS=1,1"
+            self._command("gps_disable", "AT+CGPS=0")
+        except dbus.DBusException as e:
+            if e.get_dbus_name() in MM_GONE_ERRORS:
+                raise
+            # still active, the next poll tries again
+            prt.GLOBAL_ENTITY.print_once(f"Failed to power down GPS, dump: {e}", f"Error stopped occuring: Failed to power down GPS, dump: {e}", 10)
+            return
+        self.gps_active = False
+        prt.GLOBAL_ENTITY.info(f"Powered down GPS on modem number: {self.modem_num}")
+
+    def _enable_gps(self) -> None:
+        # Avoid spamming gps enable commands, the modem answers with an error if gps is already enabled
+        if time.monotonic() - self.last_gps_enable < GPS_ENABLE_RETRY:
+            return
+        self.last_gps_enable = time.monotonic()
         try:
-            ret = check_output(cmd, shell=True, stderr=STDOUT, timeout=1).decode("utf-8")
-            return """response: ''""" in ret
-        except Exception:
-            return False
+            self._command("gps_enable", "AT+CGPS=1,1")
+        except dbus.DBusException as e:
+            if e.get_dbus_name() in MM_GONE_ERRORS:
+                raise
 
-    def _get_gps_location(self) -> Dict[str, Any]:
+    def _parse_gps_location(self, line: str) -> Dict[str, Any]:
         ret = {"lat": None, "lon": None, "alt": None}
-        cmd = "mmcli -m " + str(self.modem_num) + " --command=AT+CGPSINFO"
-        nmea_data = ""
-        try:
-            nmea_data = check_output(cmd, shell=True, stderr=STDOUT, timeout=1).decode("utf-8").strip().split("'")[1]
-            if ",,,,,,,," in nmea_data:
-                # At this point we either have no fix or gps has not been enabled yet
-                self.gps_timestamp = "unknown"
-                time.sleep(2)
-                if not self._enable_gps():
-                    time.sleep(5)  # Sleep to avoid spamming qmicli gps enable messages if already enabled
-                    #prt.GLOBAL_ENTITY.print_once("no GPS fix", "Error stopped occuring: no GPS fix", 10)
-            elif "CGPSINFO" in nmea_data:
-                # Format: [lat],[N/S],[log],[E/W],[date],[UTC time],[alt],[speed],[course]
-                nmea_data = nmea_data[11:].split(',')  # remove CGPSINFO from the beginning
-                raw_lat = str(nmea_data[0])
-                raw_lon = str(nmea_data[2])
-                # The modem sometimes delivers wrong data, check and ignore this case.
-                if len(raw_lat) != 11 or len(raw_lon) != 12 or len(nmea_data[4]) != 6 or len(nmea_data[5]) != 8 or nmea_data[6] == '':
-                    self.gps_timestamp = "unknown"
-                    #print("received faulty lat/lon/time/alt data from modem")
-                    return ret
-                ret['lat'] = round((float(raw_lat[0:2]) + (float(raw_lat[2:11]) / 60)), 6)
-                ret['lon'] = round((float(raw_lon[0:3]) + (float(raw_lon[3:12]) / 60)), 6)
-                ret['alt'] = float(nmea_data[6])
-                ts = time.strptime(nmea_data[4] + ":" + nmea_data[5], "%d%m%y:%H%M%S.0")
-                self.gps_timestamp = time.mktime(ts)
-                # print(f"lat:{ret['lat']}, lon:{ret['lon']}, alt:{ret['alt']}, time:{self.gps_timestamp}")
-            else:
-                raise ValueError
-        except Exception as e:
+        fix = parse_cgpsinfo(line)
+        if fix is None or not fix.has_position:
+            # At this point we either have no fix, gps has not been enabled yet or the modem delivered wrong data
             self.gps_timestamp = "unknown"
-            prt.GLOBAL_ENTITY.print_once(f"Failed to get GPS data, dump: {e}, nmea_data: {nmea_data}", f"Error stopped occuring: Failed to get GPS data, dump: {e}", 10)
+            self.lock.no_fix()
+            if ",,,,,,,," in line:
+                self._enable_gps()
+            return ret
+        self.lock.add_fix(fix.lat, fix.lon, fix.alt)
+        ret["lat"], ret["lon"], ret["alt"] = fix.lat, fix.lon, fix.alt
+        self.gps_timestamp = fix.timestamp
         return ret
 
-    def _get_rssi(self) -> Optional[int]:
-        cmd = "mmcli -m " + str(self.modem_num) + " --command=AT+CSQ"
-        ret = ""
+    def _parse_rssi(self, line: str) -> Optional[int]:
         try:
-            ret = check_output(cmd, shell=True, stderr=STDOUT, timeout=1).decode("utf-8")
-            return self._convert_ss_to_rssi(int(ret.strip().split("response: '+CSQ: ")[1].split(",")[0]))
-        except Exception as e:
-            prt.GLOBAL_ENTITY.print_once(f"Failed to get signal strength data, dump: {e}, data: {ret}",
+            return self._convert_ss_to_rssi(int(line[len("+CSQ:"):].split(",")[0]))
+        except ValueError as e:
+            prt.GLOBAL_ENTITY.print_once(f"Failed to get signal strength data, dump: {e}, data: {line}",
                                         f"Error stopped occuring: Failed to get signal strength data, dump: {e}", 10)
             return None
 
@@ -1,135 +1,233 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Union
 import time
-from subprocess import STDOUT, check_output
 import threading
 import prt
 import config
 import dbus
-from pynmeagps import NMEAReader
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+from gps_lock import PositionLock
+from nmea import parse_nmea
+
+MM_SERVICE = "org.freedesktop.ModemManager1"
+MM_PATH = "/org/freedesktop/ModemManager1"
+MM_MODEM_INTERFACE = "org.freedesktop.ModemManager1.Modem"
+MM_LOCATION_INTERFACE = "org.freedesktop.ModemManager1.Modem.Location"
+MM_LOCATION_GPS_NMEA = 4
+# DBus errors meaning the cached modem object is gone, e.g. after a modem reset or a ModemManager restart
+MM_GONE_ERRORS = (
+    "org.freedesktop.DBus.Error.UnknownObject",
+    "org.freedesktop.DBus.Error.UnknownMethod",
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NoReply",
+    "org.freedesktop.DBus.Error.Disconnected",
+)
+GPS_CHECK_INTERVAL = 10  # seconds between checks that the modem is still there and delivers locations
+
+
+class ModemProxies:
+    """DBus proxies of one modem object, created once per modem path"""
+    def __init__(self, bus: dbus.Bus, path: str) -> None:
+        modem = bus.get_object(MM_SERVICE, path)
+        self.path = path
+        self.location = dbus.Interface(modem, MM_LOCATION_INTERFACE)
+        self.properties = dbus.Interface(modem, "org.freedesktop.DBus.Properties")
 
 
 class ModemHandlerDBus:
+    """
+    Event driven GPS and signal quality from the ModemManager location api.
+    ModemManager emits PropertiesChanged for new locations and signal qualities, they are handled in a GLib main loop thread.
+    """
 
     def __init__(self):
         self.gps_timestamp = "unknown"
-        self.current_gps_data = {"lat": None, "lon": None, "alt": None, "rssi": None}
+        self.location: Dict[str, Any] = {"lat": None, "lon": None, "alt": None}
+        self.location_time = 0.  # monotonic time of the latest location with a fix
+        self.rssi: Optional[int] = None
+        self.modem_state: Optional[int] = None  # MMModemState, updated by PropertiesChanged
         self.modem_num = -1
+        self.modem: Optional[ModemProxies] = None
+        self.proxies: Dict[str, ModemProxies] = {}
+        self.location_updates = 0
+        self.signal_updates = 0
+        # ModemManager emits locations every GPS_POLL_INTERVAL seconds, keep a missed update or two
+        self.max_location_age = max(10, 5 * config.GPS_POLL_INTERVAL)
+        self.lock = PositionLock()
+        self.gps_fast = True  # GPS tracking at GPS_POLL_INTERVAL, it is slowed down or disabled while the position is locked
 
         if config.GPS_POLL_ENABLE:
-            self.bus = dbus.SystemBus()
-            self.thread = threading.Thread(target=self._modem_worker)
+            self.bus = dbus.SystemBus(mainloop=DBusGMainLoop())
+            self.loop = GLib.MainLoop()
+            self.thread = threading.Thread(target=self._glib_worker)
             self.thread.daemon = True
             self.thread.start()
 
     def get_data(self) -> Dict[str, Any]:
-        return self.current_gps_data
+        ret = {"lat": None, "lon": None, "alt": None, "rssi": self.rssi if self.modem is not None else None}
+        locked_position = self.lock.locked_position
+        if locked_position is not None:
+            ret["lat"], ret["lon"], ret["alt"] = locked_position
+        elif time.monotonic() - self.location_time <= self.max_location_age:
+            ret.update(self.location)
+        return ret
 
-    def get_gps_timestamp(self) -> str:
+    def get_gps_timestamp(self) -> Union[float, str]:
+        if time.monotonic() - self.location_time > self.max_location_age:
+            return "unknown"
         return self.gps_timestamp
 
     def get_mm_number(self) -> int:
         return self.modem_num
 
-    def _modem_worker(self) -> None:
-        time.sleep(20)
-        print("Started GPS polling thread")
-        while True:
-            ret = {"lat": None, "lon": None, "alt": None, "rssi": None}
-            self._update_modem_number()
-            if self.modem_num != -1:
-                ret.update(self._get_gps_location())
-                ret["rssi"] = self._get_signal_quality()  # Only signal quality from 0 to 100% is available
-            else:
-                self.gps_timestamp = "unknown"
-                prt.GLOBAL_ENTITY.print_once("GPS disconnected", "GPS back online", 10)
-            self.current_gps_data = ret
-            time.sleep(1)
+    def get_modem_state(self) -> Optional[int]:
+        """MMModemState of the modem as ModemManager reports it, None without a modem"""
+        return self.modem_state if self.modem is not None else None
 
-    def _update_modem_number(self) -> None:
-        try:
-            modem_manager_proxy = self.bus.get_object("org.freedesktop.ModemManager1", "/org/freedesktop/ModemManager1")
-            object_manager_interface = dbus.Interface(modem_manager_proxy, "org.freedesktop.DBus.ObjectManager")
-            managed_objects = object_manager_interface.GetManagedObjects()
-
-            for path, interfaces in managed_objects.items():
-                if "org.freedesktop.ModemManager1.Modem" in interfaces:
-                    modem_num = path.split("/")[-1]
-                    if modem_num.isdecimal():
-                        self.modem_num = int(modem_num)
-                        return
-            self.modem_num = -1
+    def get_telemetry(self) -> Dict[str, Any]:
+        """Location and signal quality updates received since the last call"""
+        ret = {"gps_updates": self.location_updates, "modem_signal_updates": self.signal_updates}
+        self.location_updates = 0
+        self.signal_updates = 0
+        ret.update(self.lock.get_telemetry())
+        return ret
 
-        except Exception:
+    def _glib_worker(self) -> None:
+        prt.GLOBAL_ENTITY.info("Started GPS signal thread")
+        self.bus.add_signal_receiver(self._on_properties_changed, signal_name="PropertiesChanged",
+                                     dbus_interface="org.freedesktop.DBus.Properties", bus_name=MM_SERVICE,
+                                     path_keyword="path")
+        self.bus.add_signal_receiver(self._on_interfaces_added, signal_name="InterfacesAdded",
+                                     dbus_interface="org.freedesktop.DBus.ObjectManager", bus_name=MM_SERVICE)
+        self.bus.add_signal_receiver(self._on_interfaces_removed, signal_name="InterfacesRemoved",
+                                     dbus_interface="org.freedesktop.DBus.ObjectManager", bus_name=MM_SERVICE)
+        self._check_modem()
+        GLib.timeout_add_seconds(GPS_CHECK_INTERVAL, self._check_modem)
+        self.loop.run()
+
+    def _check_modem(self) -> bool:
+        """Attaches to a modem if there is none, re-enables GPS if no location arrived recently. Runs as GLib timeout"""
+        try:
+            if self.modem is None:
+                self._scan_modems()
+            else:
+                self._apply_gps_mode()
+                if self.gps_fast and time.monotonic() - self.location_time > self.max_location_age:
+                    # no fix or GPS tracking has not been enabled yet
+                    self.lock.no_fix()
+                    self._enable_gps()
+        except dbus.DBusException as e:
+            if e.get_dbus_name() in MM_GONE_ERRORS:
+                self._detach()
+            prt.GLOBAL_ENTITY.print_once(f"Failed to query modem, dump: {e}", f"Error stopped occuring: Failed to query modem, dump: {e}", 10)
+        if self.modem is None:
+            prt.GLOBAL_ENTITY.print_once("GPS disconnected", "GPS back online", 10)
+        return True  # keep the timeout running
+
+    def _scan_modems(self) -> None:
+        manager = dbus.Interface(self.bus.get_object(MM_SERVICE, MM_PATH), "org.freedesktop.DBus.ObjectManager")
+        for path, interfaces in manager.GetManagedObjects().items():
+            if MM_MODEM_INTERFACE in interfaces and self._attach(path):
+                return
+
+    def _attach(self, path: str) -> bool:
+        modem_num = str(path).split("/")[-1]
+        if not modem_num.isdecimal():
+            return False
+        if path not in self.proxies:
+            self.proxies[path] = ModemProxies(self.bus, path)
+        self.modem = self.proxies[path]
+        self.modem_num = int(modem_num)
+        self.gps_fast = True
+        self.rssi = self.modem.properties.Get(MM_MODEM_INTERFACE, "SignalQuality")[0]  # Only signal quality from 0 to 100% is available
+        self.modem_state = int(self.modem.properties.Get(MM_MODEM_INTERFACE, "State"))
+        self._enable_gps()
+        return True
+
+    def _detach(self, path: Optional[str] = None) -> None:
+        if self.modem is not None and path in (None, self.modem.path):
+            self.proxies.pop(self.modem.path, None)
+            self.modem = None
             self.modem_num = -1
+            self.rssi = None
+            self.modem_state = None
 
     def _enable_gps(self) -> None:
         try:
-            modem = self.bus.get_object('org.freedesktop.ModemManager1', f"/org/freedesktop/ModemManager1/Modem/{self.modem_num}")
-            location_interface = dbus.Interface(modem, 'org.freedesktop.ModemManager1.Modem.Location')
             # Enable GPS NMEA tracking
             # 0 none
             # 1 3gpp
             # 2 gps raw
             # 4 gps nmea <- we only want nmea as it contains both location and datetime
             # 6 raw and nmea
-            location_interface.Setup(4, False)  # (gps tracking mode, emit signals)
-            #location_interface.SetGpsRefreshRate(1)
-            #properties_interface = dbus.Interface(modem, "org.freedesktop.DBus.Properties")
-            #signals_location = properties_interface.Get("org.freedesktop.ModemManager1.Modem.Location", "Enabled")
-            #print("set gps tracking to:", signals_location)
-            print(f"Enabled GPS tracking on modem number: {self.modem_num}")
-
-        except Exception as e:
+            self.modem.location.Setup(dbus.UInt32(MM_LOCATION_GPS_NMEA), True)  # (gps tracking mode, emit signals)
+            # ModemManager takes the refresh rate in whole seconds, 0 would mean as fast as the modem reports
+            self.modem.location.SetGpsRefreshRate(dbus.UInt32(max(1, round(config.GPS_POLL_INTERVAL))))
+            prt.GLOBAL_ENTITY.info(f"Enabled GPS tracking on modem number: {self.modem_num}")
+        except dbus.DBusException as e:
+            if e.get_dbus_name() in MM_GONE_ERRORS:
+                raise
+            # the modem is probably not enabled yet, _check_modem tries again
             prt.GLOBAL_ENTITY.print_once(f"Failed to enable GPS tracking, dump: {e}",
                                         f"Error stopped occuring: Failed to enable GPS tracking, dump: {e}", 10)
 
-    def _get_gps_location(self) -> Dict[str, Any]:
-        ret = {"lat": None, "lon": None, "alt": None}
-        try:
-            modem = self.bus.get_object('org.freedesktop.ModemManager1', f"/org/freedesktop/ModemManager1/Modem/{self.modem_num}")
-            location_interface = dbus.Interface(modem, 'org.freedesktop.ModemManager1.Modem.Location')
-            location_data = location_interface.GetLocation()
-
-            if not location_data:  # if no data is returned the GPS tracking has not been enabled
-                self._enable_gps()
-                return ret
-            for key, value in location_data.items():
-                if key != 4:  # 4 corresponds to the NMEA data, if it is missing the GPS tracking has not been enabled
-                    self._enable_gps()
-                    continue
-                for line in value.splitlines():
-                    nmea = NMEAReader.parse(line)
-                    if nmea == None:
-                        continue
-                    if nmea.msgID == "GGA" and nmea.quality == 0:
-                        continue # no gps fix
-                    if nmea.msgID == "GGA" and nmea.lat != "" and nmea.lon != "" and nmea.alt != "":
-                        ret["lat"] = nmea.lat
-                        ret["lon"] = nmea.lon
-                        ret["alt"] = nmea.alt
-                        continue
-                    if nmea.msgID == "RMC" and nmea.date != "" and nmea.time != "":
-                        # nmea.time sometimes contains milliseconds, sometimes it does not
-                        time_str = nmea.time if "." in str(nmea.time) else f"{nmea.time}.000000"
-                        ts = time.strptime(f"{nmea.date}:{time_str}", "%Y-%m-%d:%H:%M:%S.%f")
-                        self.gps_timestamp = time.mktime(ts)
-                        continue
-            #print(f"lat:{ret['lat']}, lon:{ret['lon']}, alt:{ret['alt']}, time:{self.gps_timestamp}")
-        except Exception as e:
-            self.gps_timestamp = "unknown"
-            prt.GLOBAL_ENTITY.print_once(f"Failed to get GPS data, dump: {e}", f"Error stopped occuring: Failed to get GPS data, dump: {e}", 10)
-        return ret
-
-    def _get_signal_quality(self) -> Optional[int]:
+    def _apply_gps_mode(self) -> None:
+        """Slows GPS down or powers it off while the position is locked and speeds it up for checks"""
+        fast = self.lock.gps_due()
+        if fast == self.gps_fast:
+            return
+        # the mode only changes once ModemManager accepted it, a failed call is retried by the next check
+        if fast:
+            self._enable_gps()
+        elif config.GPS_LOCK_POWER_DOWN:
+            self.modem.location.Setup(dbus.UInt32(0), False)
+            prt.GLOBAL_ENTITY.info(f"Powered down GPS on modem number: {self.modem_num}")
+        else:
+            self.modem.location.SetGpsRefreshRate(dbus.UInt32(int(config.GPS_LOCK_CHECK_INTERVAL)))
+        self.gps_fast = fast
+
+    def _on_interfaces_added(self, path: str, interfaces: Dict[str, Any]) -> None:
+        if self.modem is None and MM_MODEM_INTERFACE in interfaces:
+            try:
+                self._attach(path)
+            except dbus.DBusException as e:
+                prt.GLOBAL_ENTITY.print_once(f"Failed to attach modem, dump: {e}", f"Error stopped occuring: Failed to attach modem, dump: {e}", 10)
+
+    def _on_interfaces_removed(self, path: str, interfaces: list) -> None:
+        if MM_MODEM_INTERFACE in interfaces:
+            self._detach(path)
+
+    def _on_properties_changed(self, interface: str, changed: Dict[str, Any], _invalidated: list, path: Optional[str] = None) -> None:
+        if self.modem is None or path != self.modem.path:
+            return
+        if interface == MM_LOCATION_INTERFACE and "Location" in changed:
+            self._parse_location(changed["Location"])
+        elif interface == MM_MODEM_INTERFACE:
+            if "SignalQuality" in changed:
+                self.rssi = changed["SignalQuality"][0]
+                self.signal_updates += 1
+            if "State" in changed:
+                self.modem_state = int(changed["State"])
+
+    def _parse_location(self, location_data: Dict[int, Any]) -> None:
+        value = location_data.get(MM_LOCATION_GPS_NMEA)
+        if not value:  # 4 corresponds to the NMEA data, it is missing if GPS tracking has not been enabled
+            return
+        fix = parse_nmea(str(value))
+        self.location_updates += 1
+        if fix.timestamp is not None:
+            self.gps_timestamp = fix.timestamp
+        if fix.has_position:
+            self.location = {"lat": fix.lat, "lon": fix.lon, "alt": fix.alt}
+            self.location_time = time.monotonic()
+            self.lock.add_fix(fix.lat, fix.lon, fix.alt)
+        else:
+            self.lock.no_fix()
         try:
-            modem = self.bus.get_object("org.freedesktop.ModemManager1", f"/org/freedesktop/ModemManager1/Modem/{self.modem_num}")
-            properties_interface = dbus.Interface(modem, "org.freedesktop.DBus.Properties")
-            signal_quality = properties_interface.Get("org.freedesktop.ModemManager1.Modem", "SignalQuality")[0] 
-            return signal_quality
-        except Exception as e:
-            prt.GLOBAL_ENTITY.print_once(f"Failed to get signal quality data, dump: {e}",
-                                        f"Error stopped occuring: Failed to get signal quality data, dump: {e}", 10)
-            return None
+            self._apply_gps_mode()
+        except dbus.DBusException as e:
+            prt.GLOBAL_ENTITY.print_once(f"Failed to set GPS mode, dump: {e}", f"Error stopped occuring: Failed to set GPS mode, dump: {e}", 10)
 
     def stop(self) -> None:
-        pass
+        if config.GPS_POLL_ENABLE:
+            self.loop.quit()
@@ -1,7 +1,9 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import json
 import paho.mqtt.client as mqtt
 import config
+import prt
+from system_metrics import get_process_age
 
 
 class MQTTController:
@@ -11,22 +13,24 @@ class MQTTController:
         self.client = mqtt.Client(client_id=config.NODE_ID)
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
         self.packet_counter = 0
+        self.first_publish_time: Optional[float] = None  # seconds from process start to the first delivered message
 
         try:
-            print("Authenticating with user:", config.MQTT_USER, "on MQTT connection")
+            prt.GLOBAL_ENTITY.info(f"Authenticating with user: {config.MQTT_USER} on MQTT connection")
             self.client.username_pw_set(config.MQTT_USER, config.MQTT_PASS)
         except AttributeError:
-            print("Using no authentication on MQTT connection")
+            prt.GLOBAL_ENTITY.info("Using no authentication on MQTT connection")
 
         if config.MQTT_USE_TLS:
-            print("using TLS for MQTT Connection")
+            prt.GLOBAL_ENTITY.info("using TLS for MQTT Connection")
             self.client.tls_set()
 
         try:
             self.client.connect(config.MQTT_SERVER, config.MQTT_PORT)
         except Exception as e:
-            print(f"Can't connect to MQTT Broker:{config.MQTT_SERVER} at port:{config.MQTT_PORT}, dump: {e}")
+            prt.GLOBAL_ENTITY.error(f"Can't connect to MQTT Broker:{config.MQTT_SERVER} at port:{config.MQTT_PORT}, dump: {e}")
 
         self.client.loop_start()  # Start MQTT handling in a new thread
 
@@ -38,13 +42,21 @@ class MQTTController:
         return self.mqtt_connected
 
     def _on_connect(self, _client, _userdata, _flags, _rc) -> None:
-        print("Connected to MQTT Broker:", config.MQTT_SERVER, "at port:", config.MQTT_PORT)
+        prt.GLOBAL_ENTITY.info(f"Connected to MQTT Broker: {config.MQTT_SERVER} at port: {config.MQTT_PORT}")
         self.mqtt_connected = True
 
     def _on_disconnect(self, _client, _userdata, _rc) -> None:
-        print("Disconnected from MQTT Broker:", config.MQTT_SERVER, "at port:", config.MQTT_PORT)
+        prt.GLOBAL_ENTITY.warning(f"Disconnected from MQTT Broker: {config.MQTT_SERVER} at port: {config.MQTT_PORT}")
         self.mqtt_connected = False
 
+    def get_first_publish_time(self) -> Optional[float]:
+        return self.first_publish_time
+
+    def _on_publish(self, _client, _userdata, _mid) -> None:
+        if self.first_publish_time is None:
+            self.first_publish_time = get_process_age()
+            prt.GLOBAL_ENTITY.info(f"First MQTT message delivered {round(self.first_publish_time, 1)} seconds after process start")
+
     def publish_data(self, data: Dict[str, Any]) -> None:
         data["tele"]["packet_count"] = self._get_next_packet_count()
         json_data = json.dumps(data, indent=4)
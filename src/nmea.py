@@ -0,0 +1,186 @@
+from typing import Iterable, List, Optional
+import argparse
+import calendar
+import os
+import time
+
+# Minimal parser for the sentences the modem handlers need. ModemManager hands over a block of NMEA lines per update,
+# most of them GSV/GSA, which are skipped by their sentence type before any other work is done.
+
+NMEA_TYPES = ("GGA", "RMC")
+CGPSINFO_PREFIX = "+CGPSINFO:"
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nmea_corpus.txt")
+
+
+class GPSFix:
+    """Position and UTC unix timestamp, every field is None if the sentences did not contain it"""
+    __slots__ = ("lat", "lon", "alt", "timestamp")
+
+    def __init__(self) -> None:
+        self.lat: Optional[float] = None
+        self.lon: Optional[float] = None
+        self.alt: Optional[float] = None
+        self.timestamp: Optional[float] = None
+
+    @property
+    def has_position(self) -> bool:
+        return self.lat is not None and self.lon is not None and self.alt is not None
+
+    def __repr__(self) -> str:
+        return f"GPSFix(lat={self.lat}, lon={self.lon}, alt={self.alt}, timestamp={self.timestamp})"
+
+
+def checksum_ok(sentence: str) -> bool:
+    """Checks the XOR checksum between '$' and '*' against the two hex digits after '*'"""
+    star = sentence.rfind("*")
+    if star < 1 or len(sentence) < star + 3:
+        return False
+    checksum = 0
+    for byte in sentence[1:star].encode("ascii", "replace"):
+        checksum ^= byte
+    try:
+        return checksum == int(sentence[star + 1:star + 3], 16)
+    except ValueError:
+        return False
+
+
+def _coordinate(value: str, hemisphere: str, max_degrees: int) -> Optional[float]:
+    # [d]ddmm.mmmm with the degrees in front of the minutes, south and west are negative
+    if value == "" or hemisphere not in ("N", "S", "E", "W"):
+        return None
+    raw = float(value)
+    degrees = int(raw // 100)
+    minutes = raw - degrees * 100
+    if degrees > max_degrees or minutes >= 60:
+        return None
+    ret = round(degrees + minutes / 60, 6)
+    return -ret if hemisphere in ("S", "W") else ret
+
+
+def _timestamp(date: str, utc_time: str) -> Optional[float]:
+    # ddmmyy and hhmmss[.ss]
+    if len(date) != 6 or len(utc_time) < 6:
+        return None
+    return float(calendar.timegm((2000 + int(date[4:6]), int(date[2:4]), int(date[0:2]),
+                                  int(utc_time[0:2]), int(utc_time[2:4]), int(utc_time[4:6]))))
+
+
+def _parse_gga(fields: List[str], fix: GPSFix) -> None:
+    # $--GGA,time,lat,N/S,lon,E/W,quality,satellites,hdop,alt,M,...
+    if len(fields) < 10 or fields[6] in ("", "0"):
+        return  # no gps fix
+    lat = _coordinate(fields[2], fields[3], 90)
+    lon = _coordinate(fields[4], fields[5], 180)
+    if lat is None or lon is None or fields[9] == "":
+        return
+    fix.lat, fix.lon, fix.alt = lat, lon, float(fields[9])
+
+
+def _parse_rmc(fields: List[str], fix: GPSFix) -> None:
+    # $--RMC,time,status,lat,N/S,lon,E/W,speed,course,date,...
+    if len(fields) < 10:
+        return
+    timestamp = _timestamp(fields[9], fields[1])
+    if timestamp is not None:
+        fix.timestamp = timestamp
+
+
+def parse_nmea(lines: Iterable[str], fix: Optional[GPSFix] = None) -> GPSFix:
+    """
+    Parses GGA position and RMC time from NMEA lines into fix, sentences with an invalid checksum are ignored.
+    lines may be a single string with one sentence per line.
+    """
+    if fix is None:
+        fix = GPSFix()
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    for line in lines:
+        line = line.strip()
+        # $ + two character talker id + sentence type, skip everything we do not parse before validating
+        if line[3:6] not in NMEA_TYPES or not line.startswith("$") or not checksum_ok(line):
+            continue
+        fields = line[:line.rfind("*")].split(",")
+        try:
+            if line[3:6] == "GGA":
+                _parse_gga(fields, fix)
+            else:
+                _parse_rmc(fields, fix)
+        except ValueError:
+            continue
+    return fix
+
+
+def parse_cgpsinfo(line: str) -> Optional[GPSFix]:
+    """
+    Parses a SIM7600 AT+CGPSINFO response, returns None if it is no CGPSINFO line.
+    Without a fix the modem answers with empty fields and the returned GPSFix has no position.
+    """
+    line = line.strip()
+    if not line.startswith(CGPSINFO_PREFIX):
+        return None
+    fix = GPSFix()
+    # [lat],[N/S],[lon],[E/W],[date],[UTC time],[alt],[speed],[course]
+    fields = line[len(CGPSINFO_PREFIX):].strip().split(",")
+    if len(fields) < 7:
+        return fix
+    try:
+        lat = _coordinate(fields[0], fields[1], 90)
+        lon = _coordinate(fields[2], fields[3], 180)
+        timestamp = _timestamp(fields[4], fields[5])
+        # The modem sometimes delivers wrong data, only take complete fixes
+        if lat is None or lon is None or timestamp is None or fields[6] == "":
+            return fix
+        fix.lat, fix.lon, fix.alt, fix.timestamp = lat, lon, float(fields[6]), timestamp
+    except ValueError:
+        pass
+    return fix
+
+
+def load_corpus(path: str = DEFAULT_CORPUS) -> List[str]:
+    """Recorded modem output, one line per line, lines starting with # are comments"""
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f if not line.startswith("#") and line.strip() != ""]
+
+
+def benchmark(lines: List[str], rounds: int = 200) -> None:
+    """Prints the time per line of this parser and, if installed, of pynmeagps as used before"""
+    nmea_lines = [line for line in lines if line.startswith("$")]
+    cgpsinfo_lines = [line for line in lines if line.startswith(CGPSINFO_PREFIX)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse_nmea(nmea_lines)
+        for line in cgpsinfo_lines:
+            parse_cgpsinfo(line)
+    elapsed = time.perf_counter() - start
+    print(f"nmea: {1e6 * elapsed / (rounds * len(lines)):.2f} us per line, {len(lines)} lines")
+    try:
+        from pynmeagps import NMEAReader
+    except ImportError:
+        print("pynmeagps: not installed")
+        return
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for line in nmea_lines:
+            try:
+                NMEAReader.parse(line)
+            except Exception:
+                pass
+    elapsed = time.perf_counter() - start
+    print(f"pynmeagps: {1e6 * elapsed / (rounds * len(nmea_lines)):.2f} us per line, {len(nmea_lines)} nmea lines")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Parse recorded modem output and measure the parser speed")
+    parser.add_argument("corpus", nargs="?", default=DEFAULT_CORPUS, help="file with recorded NMEA and +CGPSINFO lines")
+    parser.add_argument("--rounds", type=int, default=200, help="passes over the corpus for the benchmark")
+    args = parser.parse_args(argv)
+
+    lines = load_corpus(args.corpus)
+    for line in lines:
+        fix = parse_cgpsinfo(line) if line.startswith(CGPSINFO_PREFIX) else parse_nmea([line])
+        print(f"{fix!r} <- {line}")
+    benchmark(lines, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,46 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 import threading
 import time
 import datetime
 import socket
+import numpy as np
+from PIL import Image, ImageDraw
 from luma.core.interface.serial import i2c
-from luma.core.render import canvas
-from luma.core.virtual import viewport
 from luma.oled.device import ssd1306
 import config
 import prt
+from i2c_arbiter import PRIORITY_DISPLAY, get_arbiter
+
+WIDTH = 128
+HEIGHT = 64
+ROW_HEIGHT = 12
+ROWS_PER_PAGE = HEIGHT // ROW_HEIGHT
+# SSD1306 memory is organized in 8 pages of 8 pixel rows, one byte per column and page
+SSD1306_PAGES = HEIGHT // 8
+SSD1306_SET_COLUMN_ADDRESS = 0x21
+SSD1306_SET_PAGE_ADDRESS = 0x22
+# rendered rows to keep, values change every second so old ones are dropped regularly
+ROW_CACHE_SIZE = 256
+
+
+class ArbitratedI2C(i2c):
+    """
+    luma i2c interface that sends every command and every 32 byte data chunk through the bus arbiter,
+    so a frame redraw never blocks sensors on the same bus for longer than one chunk
+    """
+    def __init__(self, port: int, address: int) -> None:
+        super().__init__(port=port, address=address)
+        self.arbiter = get_arbiter(port)
+        self.bytes_sent = 0
+
+    def command(self, *cmd: int) -> None:
+        self.arbiter.transaction("oled", super().command, *cmd, priority=PRIORITY_DISPLAY)
+        self.bytes_sent += len(cmd)
+
+    def data(self, data) -> None:
+        for i in range(0, len(data), 32):
+            self.arbiter.transaction("oled", super().data, data[i:i + 32], priority=PRIORITY_DISPLAY)
+        self.bytes_sent += len(data)
 
 
 class OLEDController:
@@ -19,40 +51,87 @@ class OLEDController:
             except Exception:
                 hostname = "unknown"
 
-            try:
-                self.startup_phase = True
-                self.list_entry_amount = 20
+            # Text lines to show, set by update_view() and rendered page by page by the worker
+            self.lines = ["IFK AIR SENSOR", "version 0.1", "hostname:" + hostname, "startup phase"]
+            self.lines_lock = threading.Lock()
+            self.page = 0
+            self.last_page_change = time.monotonic()
+            # rendered rows by text, so unchanged lines are never rendered twice
+            self.row_cache: Dict[str, np.ndarray] = {}
+            # what the display currently shows in SSD1306 page layout, None forces a full redraw
+            self.shown: Optional[np.ndarray] = None
+            self.bytes_start = time.monotonic()
+            self.serial: Optional[ArbitratedI2C] = None
 
-                self.serial = i2c(port=config.OLED_PORT, address=config.OLED_ADDRESS)
-                self.device = ssd1306(self.serial, height=64, rotate=0)
-                self.virtual = viewport(self.device, width=128, height=768)
+            try:
+                self.serial = ArbitratedI2C(port=config.OLED_PORT, address=config.OLED_ADDRESS)
+                self.device = ssd1306(self.serial, height=HEIGHT, rotate=0)
+                self.device.clear()
+                self.shown = np.zeros((SSD1306_PAGES, WIDTH), dtype=np.uint8)
 
                 self.thread = threading.Thread(target=self._oled_worker)
                 self.thread.daemon = True
                 self.thread.start()
-                with canvas(self.virtual) as draw:
-                    draw.text((20, 5), text="IFK AIR SENSOR", fill="white")
-                    draw.text((28, 20), text="version 0.1", fill="white")
-                    draw.text((15, 35), text="hostname:" + hostname, fill="white")
-                    draw.text((23, 50), text="startup phase", fill="white")
-                print(f"OLED connected to i2c port: {config.OLED_PORT} on address: {hex(config.OLED_ADDRESS)}")
+                prt.GLOBAL_ENTITY.info(f"OLED connected to i2c port: {config.OLED_PORT} on address: {hex(config.OLED_ADDRESS)}")
             except Exception:
-                print(f"No OLED display found on i2c port: {config.OLED_PORT} on address: {hex(config.OLED_ADDRESS)}")
+                prt.GLOBAL_ENTITY.warning(f"No OLED display found on i2c port: {config.OLED_PORT} on address: {hex(config.OLED_ADDRESS)}")
 
     def _oled_worker(self) -> None:
+        # Only changed parts of the display are sent, at most OLED_MAX_FPS times per second
         while True:
-            # How far we have to scroll to show all entries with a 9 pixel high text
-            skroll_len = 9 * self.list_entry_amount
-            # This list will scroll up and down and wait for some iterations at the top and bottom
-            skroll_list = [0] * 60 + list(range(skroll_len)) + [skroll_len] * 30 + list(reversed(range(skroll_len)))
-            for y_pos in skroll_list:
-                time.sleep(0.01)
-                if self.startup_phase:
-                    break
-                try:
-                    self.virtual.set_position((0, y_pos))
-                except Exception:
-                    self.startup_phase = True
+            time.sleep(1 / config.OLED_MAX_FPS)
+            with self.lines_lock:
+                lines = list(self.lines)
+            page_count = max(1, -(-len(lines) // ROWS_PER_PAGE))
+            # Paged scrolling, show every page for OLED_PAGE_INTERVAL seconds
+            if time.monotonic() - self.last_page_change >= config.OLED_PAGE_INTERVAL:
+                self.page += 1
+                self.last_page_change = time.monotonic()
+            self.page %= page_count
+            visible = lines[self.page * ROWS_PER_PAGE:(self.page + 1) * ROWS_PER_PAGE]
+            try:
+                self._show(self._to_pages(self._compose(visible)))
+            except Exception:
+                prt.GLOBAL_ENTITY.print_once("OLED disconnected", "OLED back online", 62)
+                # we don't know what the display shows after an error
+                self.shown = None
+
+    def _render_row(self, text: str) -> np.ndarray:
+        row = self.row_cache.get(text)
+        if row is None:
+            image = Image.new("1", (WIDTH, ROW_HEIGHT))
+            ImageDraw.Draw(image).text((0, 0), text, fill="white")
+            row = np.array(image, dtype=bool)
+            if len(self.row_cache) >= ROW_CACHE_SIZE:
+                self.row_cache.clear()
+            self.row_cache[text] = row
+        return row
+
+    def _compose(self, lines: List[str]) -> np.ndarray:
+        frame = np.zeros((HEIGHT, WIDTH), dtype=bool)
+        for i, line in enumerate(lines):
+            frame[i * ROW_HEIGHT:(i + 1) * ROW_HEIGHT] = self._render_row(line)
+        return frame
+
+    @staticmethod
+    def _to_pages(frame: np.ndarray) -> np.ndarray:
+        # (page, pixel row in page, column) -> one byte per page and column, the top pixel row is the lowest bit
+        return np.packbits(frame.reshape(SSD1306_PAGES, 8, WIDTH), axis=1, bitorder="little").reshape(SSD1306_PAGES, WIDTH)
+
+    def _show(self, pages: np.ndarray) -> None:
+        """Sends the columns that differ from what the display shows, page by page"""
+        for page in range(SSD1306_PAGES):
+            if self.shown is None:
+                start, end = 0, WIDTH - 1
+            else:
+                changed = np.nonzero(pages[page] != self.shown[page])[0]
+                if len(changed) == 0:
+                    continue
+                start, end = int(changed[0]), int(changed[-1])
+            self.device.command(SSD1306_SET_COLUMN_ADDRESS, start, end)
+            self.device.command(SSD1306_SET_PAGE_ADDRESS, page, page)
+            self.device.data(pages[page, start:end + 1].tolist())
+        self.shown = pages
 
     def _get_unit(self, key: str) -> str:
         lookup = {
@@ -80,21 +159,24 @@ class OLEDController:
         return unit if unit is not None else ""
 
     def update_view(self, data: Dict[str, Any], mqtt_connected: bool, modem_num: int, logger_state: str) -> None:
-        data_string = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + "\n"
+        lines = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
         for key, value in data.items():
-            data_string += f"{key}: {value} {self._get_unit(key)}\n"
-        data_string += f"server_connect: {mqtt_connected}\n"
-        data_string += f"modem_num: {modem_num}\n"
-        data_string += f"logger_state: {logger_state}\n"
-
-        try:
-            with canvas(self.virtual) as draw:
-                for i, line in enumerate(data_string.split("\n")):
-                    draw.text((0, (i * 12)), text=line, fill="white")
-            self.list_entry_amount = i + 1  # We need this to know how far to scroll
-            self.startup_phase = False
-        except Exception:
-            prt.GLOBAL_ENTITY.print_once("OLED disconnected", "OLED back online", 62)
+            lines.append(f"{key}: {value} {self._get_unit(key)}")
+        lines.append(f"server_connect: {mqtt_connected}")
+        lines.append(f"modem_num: {modem_num}")
+        lines.append(f"logger_state: {logger_state}")
+        with self.lines_lock:
+            self.lines = lines
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        """I2C bytes per second sent to the display since the last call"""
+        now = time.monotonic()
+        elapsed = now - self.bytes_start
+        bytes_sent = 0
+        if self.serial is not None:
+            bytes_sent, self.serial.bytes_sent = self.serial.bytes_sent, 0
+        self.bytes_start = now
+        return {"oled_bytes_per_s": round(bytes_sent / elapsed, config.DIGIT_ACCURACY) if elapsed > 0 else 0}
 
     def stop(self) -> None:
         self.device.cleanup()
@@ -1,4 +1,6 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+import glob
+import os
 import threading
 import time
 from w1thermsensor import W1ThermSensor
@@ -7,106 +9,183 @@ from w1thermsensor.errors import (
     ResetValueError,
     SensorNotReadyError,
     W1ThermSensorError,
-    UnsupportedSensorError,
 )
 import config
 import prt
 from generic_sensor import SensorBase
+from calibration import TwoPointCalibration
+
+W1_DEVICES = "/sys/bus/w1/devices"
+# power on value of the DS18B20 scratchpad, read if a conversion did not happen
+DS18B20_RESET_VALUE = 85.0
+
+
+class OneWireBus:
+    """
+    Reads all sensors with one simultaneous conversion through the w1_therm therm_bulk_read interface.
+    After the trigger every temperature file returns the result of that conversion, the kernel waits for the
+    conversion time on the first read only. So the read time stays the same for any number of sensors.
+    Falls back to converting one sensor after the other with w1thermsensor on kernels without bulk read.
+    """
+    def __init__(self, sensors: List[W1ThermSensor]) -> None:
+        self.sensors = sensors
+        self.bulk_read_paths = [path for path in glob.glob(f"{W1_DEVICES}/w1_bus_master*/therm_bulk_read")
+                                if os.access(path, os.W_OK)]
+        self.temperature_paths = {}
+        for sensor in sensors:
+            paths = glob.glob(f"{W1_DEVICES}/*-{sensor.id}/temperature")
+            if paths:
+                self.temperature_paths[sensor.id] = paths[0]
+        self.bulk = len(self.bulk_read_paths) > 0 and len(self.temperature_paths) == len(sensors)
+        self.bulk_failures = 0
+
+    def read_all(self) -> Dict[str, Optional[float]]:
+        """Converts and reads every sensor, returns the temperature by sensor id, None if the read failed"""
+        if not self.bulk:
+            return {sensor.id: self._read_sequential(sensor) for sensor in self.sensors}
+        try:
+            for path in self.bulk_read_paths:
+                with open(path, "w") as f:
+                    f.write("trigger")
+        except OSError:
+            # bus glitch or bus master briefly gone, convert one sensor after the other this round
+            self.bulk_failures += 1
+            return {sensor.id: self._read_sequential(sensor) for sensor in self.sensors}
+        return {sensor_id: self._read_bulk(path) for sensor_id, path in self.temperature_paths.items()}
+
+    @staticmethod
+    def _read_bulk(path: str) -> Optional[float]:
+        try:
+            with open(path) as f:
+                temperature = int(f.read()) / 1000
+        except (OSError, ValueError):
+            return None
+        return None if temperature == DS18B20_RESET_VALUE else temperature
+
+    @staticmethod
+    def _read_sequential(sensor: W1ThermSensor) -> Optional[float]:
+        try:
+            return sensor.get_temperature()
+        except (NoSensorFoundError, SensorNotReadyError, ResetValueError):
+            return None
 
 
 class OneWireHandler(SensorBase):
     def __init__(self):
-        self.temperature = None
-        self.thermocouple_temperature = None
-        self.last_temperature_reading = time.time()
-        self.request_data = threading.Event()
-        self.request_data.set()  # set it for inital measurement
-        self.get_data_called = False
+        super().__init__()
+        self.last_read_time = 0.
+        self.cali = TwoPointCalibration.from_dict(config.ONE_WIRE_DS_CALI)
+        self.bus: Optional[OneWireBus] = None
+        self.running = True
 
         self.available_sensors = W1ThermSensor.get_available_sensors()
         self.sensor_count = len(self.available_sensors)
-        print(f"Detected: {self.sensor_count} Sensor/s on the 1-Wire Bus")
-
-        # TODO: remove this for production
-        self.enable_thermocouple = self.sensor_count > 1
+        prt.GLOBAL_ENTITY.info(f"Detected: {self.sensor_count} Sensor/s on the 1-Wire Bus")
 
-        # Wait for the sensor/s to come online
-        time.sleep(5)
+        # data key -> sensor id, e.g. {"heater_temp": "01145c262cc5", "air_temp": "0d4c0f496ba6"}
+        self.roles: Dict[str, str] = self._assign_roles()
+        # "auto" roles without a spare sensor are left out of the data, the heater temperature is always reported
+        reported = [role for role, sensor_id in config.ONE_WIRE_ROLES.items()
+                    if role in self.roles or role == "heater_temp" or "auto" not in sensor_id]
+        self.temperatures: Dict[str, Optional[float]] = {role: None for role in reported}
+        # monotonic timestamp of the last successful conversion of every role
+        self.last_readings: Dict[str, float] = {role: time.monotonic() for role in reported}
 
         if self.sensor_count == 0:
             # no need to continue if there is no sensor connected
-            print("No heater temperature sensor detected, please check the connection")
+            prt.GLOBAL_ENTITY.warning("No heater temperature sensor detected, please check the connection")
+            self._set_failed(RuntimeError("no 1-Wire sensor detected"))
             return
-        
+
         for sensor in self.available_sensors:
             try:
-                print(f"1-Wire Sensor with address: {sensor.id} has temperature: {sensor.get_temperature()}")
+                prt.GLOBAL_ENTITY.info(f"1-Wire Sensor with address: {sensor.id} has temperature: {sensor.get_temperature()}")
             except Exception:
-                print(f"1-Wire Sensor with address: {sensor.id}, offline")
+                prt.GLOBAL_ENTITY.warning(f"1-Wire Sensor with address: {sensor.id}, offline")
 
-        # Set heater sensor id
-        if "auto" in config.ONE_WIRE_DS_ID:
-            # Autodetect id
-            self.sensor = W1ThermSensor()
-        else:
-            # Use configured id
-            # TODO: check if configured id is actually connected an in available_sensors
-            self.sensor = W1ThermSensor(sensor_id=config.ONE_WIRE_DS_ID)
+        sensors = {sensor.id: sensor for sensor in self.available_sensors if sensor.id in self.roles.values()}
 
         # Set Resolution
         if config.ONE_WIRE_DS_RESOLUTION != 0:
-            try:
-                self.sensor.set_resolution(config.ONE_WIRE_DS_RESOLUTION)
-            except W1ThermSensorError:
-                print(f"Failed to change resolution to: {config.ONE_WIRE_DS_RESOLUTION} for sensor: {self.sensor.id}")
+            for sensor in sensors.values():
+                try:
+                    sensor.set_resolution(config.ONE_WIRE_DS_RESOLUTION)
+                except W1ThermSensorError:
+                    prt.GLOBAL_ENTITY.warning(f"Failed to change resolution to: {config.ONE_WIRE_DS_RESOLUTION} for sensor: {sensor.id}")
+
+        for role, sensor_id in self.roles.items():
+            prt.GLOBAL_ENTITY.info(f"Using 1-Wire Sensor with ID: {sensor_id} and resolution: {sensors[sensor_id].get_resolution()} bit for {role}")
 
-        print(f"Using 1-Wire Sensor with ID: {self.sensor.id} and resolution: {self.sensor.get_resolution()} bit for heater control")
-        
-        if self.enable_thermocouple:
-            self.thermocouple_sensor = W1ThermSensor(sensor_id="0d4c0f496ba6")
-            print("Using thermocouple temperature sensor")
+        self.bus = OneWireBus(list(sensors.values()))
+        if not self.bus.bulk:
+            prt.GLOBAL_ENTITY.info("1-Wire bulk read not available, converting sensors one after the other")
 
         self.thread = threading.Thread(target=self._one_wire_worker)
         self.thread.daemon = True
         self.thread.start()
 
+    def _assign_roles(self) -> Dict[str, str]:
+        """Maps every configured role to a connected sensor id, "auto" roles get the sensors nobody else uses"""
+        available = [sensor.id for sensor in self.available_sensors]
+        roles = {}
+        for role, sensor_id in config.ONE_WIRE_ROLES.items():
+            if "auto" in sensor_id:
+                continue
+            if sensor_id not in available:
+                prt.GLOBAL_ENTITY.warning(f"Configured 1-Wire Sensor with ID: {sensor_id} for {role} is not connected")
+                continue
+            roles[role] = sensor_id
+        unused = [sensor_id for sensor_id in available if sensor_id not in roles.values()]
+        for role, sensor_id in config.ONE_WIRE_ROLES.items():
+            if "auto" in sensor_id and unused:
+                roles[role] = unused.pop(0)
+        return roles
+
     def _one_wire_worker(self) -> None:
-        while True:
-            if self.request_data.wait(timeout=0.01):
-                try:
-                    self.temperature = self.sensor.get_temperature()
-                    self.last_temperature_reading = time.time()
-                    if self.enable_thermocouple:
-                        self.thermocouple_temperature = self.thermocouple_sensor.get_temperature()
-                    self.request_data.clear()
-                except (NoSensorFoundError, SensorNotReadyError, ResetValueError):
+        # Convert continuously, the heater control loop reads the heater temperature at its own rate,
+        # see get_heater_temperature()
+        while self.running:
+            try:
+                start = time.monotonic()
+                temperatures = self.bus.read_all()
+                now = time.monotonic()
+                self.last_read_time = now - start
+                for role, sensor_id in self.roles.items():
+                    temperature = temperatures.get(sensor_id)
+                    if temperature is not None:
+                        self.temperatures[role] = temperature
+                        self.last_readings[role] = now
+                        self._set_ready()
+                if all(temperature is None for temperature in temperatures.values()):
                     time.sleep(0.5)
+            except Exception as e:
+                prt.GLOBAL_ENTITY.print_once(f"1-Wire read failed, dump: {e}", "1-Wire read recovered")
+                time.sleep(0.5)
+
+    def get_heater_temperature(self) -> Tuple[Optional[float], float]:
+        """Latest calibrated heater temperature and the monotonic time it was converted at"""
+        temperature = self.temperatures.get("heater_temp")
+        last_reading = self.last_readings.get("heater_temp", 0.)
+        if temperature is None:
+            return None, last_reading
+        return self.cali(temperature), last_reading
 
     def get_data(self) -> Dict[str, Any]:
-        try:
-            # if the sensor has not been read in the last 3 seconds consider it to be disconnected
-            if time.time() - self.last_temperature_reading > 6 and self.get_data_called:
-                self.request_data.set()
-                raise Exception  # DS18B20 did not finish temperature measurement in time.
-            self.get_data_called = True
-
-            temperature = self.temperature
-            if self.enable_thermocouple:
-                thermocouple_temperature = self.thermocouple_temperature
-            self.request_data.set()
-
+        ret = {}
+        now = time.monotonic()
+        for role, temperature in self.temperatures.items():
+            # if the sensor has not been read in the last 6 seconds consider it to be disconnected
+            if temperature is None or now - self.last_readings[role] > 6:
+                prt.GLOBAL_ENTITY.print_once(f"1-Wire Sensor for {role} disconnected", f"1-Wire Sensor for {role} back online")
+                ret[role] = None
+                continue
             # Apply two point calibration
-            temperature = self._calibrate(temperature, config.ONE_WIRE_DS_CALI)
-            if self.enable_thermocouple:
-                thermocouple_temperature = self._calibrate(thermocouple_temperature, config.ONE_WIRE_DS_CALI)
-                return {"heater_temp": temperature, "air_temp": thermocouple_temperature}
-            return {"heater_temp": temperature}
-
-        except Exception as e:
-            prt.GLOBAL_ENTITY.print_once(f"Heater Temperature Sensor disconnected, dump: {e}", f"Heater Temperature Sensor back online, dump: {e}")
-            if self.enable_thermocouple:
-                return {"heater_temp": None, "air_temp": None}
-            return {"heater_temp": None}
+            ret[role] = self.cali(temperature)
+        return ret
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        return {"one_wire_read_time": round(self.last_read_time * 1000, config.DIGIT_ACCURACY),
+                "one_wire_bulk_failures": self.bus.bulk_failures if self.bus is not None else 0}
 
     def stop(self) -> None:
-        pass
+        self.running = False
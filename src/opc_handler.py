@@ -6,15 +6,26 @@ import config
 import prt
 import pyopcn3
 from generic_sensor import SensorBase
+from calibration import TwoPointCalibration
+from opc_psd import ParticleSizeDistribution, BIN_COUNT
+
+
+# States of the OPC connection state machine
+# disconnected -> connecting -> running -> resetting -> running
+#                      ^                       |
+#                      +-----------------------+ (SPI reset did not help, full re-init with backoff)
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_RUNNING = "running"
+STATE_RESETTING = "resetting"
 
 
 class OPCHandler(SensorBase):
     def __init__(self):
+        super().__init__()
         self.spi = spidev.SpiDev()
-        self.spi.open(0, 0)
-        self.spi.mode = 1
-        self.spi.max_speed_hz = 500000
-        self.connected = False
+        self._open_spi()
+        self.state = STATE_DISCONNECTED
 
         # holds the pyopcn instance
         self.alphasense = None
@@ -24,24 +35,160 @@ class OPCHandler(SensorBase):
         self.data_ready = threading.Event()
         # used to pass data from runner thread to get_data
         self.data = None
+        self.cali_humid = TwoPointCalibration.from_dict(config.OPC_CALI_HUMID)
+        self.cali_temp = TwoPointCalibration.from_dict(config.OPC_CALI_TEMP)
+        # accumulates raw histograms and sample volume over the averaging period
+        self.psd = ParticleSizeDistribution(density=config.OPC_PSD_DENSITY) if config.OPC_PSD_ENABLE else None
+
+        # reconnection state
+        self.backoff = config.OPC_RECONNECT_BACKOFF_MIN
+        self.failed_resets = 0
+        self.failure_timestamp = None
+        # recovery metrics
+        self.recovery_count = 0
+        self.spi_reset_count = 0
+        self.last_recovery_time = 0
+
+        # duty cycle state, sampling_valid is only True if fan and laser are on and warmed up
+        self.sampling_active = False
+        self.sampling_valid = False
+        self.warmup_until = 0
+        self.cycle_start = time.monotonic()
+        self.duty_timestamp = self.cycle_start
+        self.on_seconds = 0
+        self.off_seconds = 0
+        # last valid opc_temp and opc_humid, kept while idle so the heater can still check the OPC temperature
+        self.last_climate = {"opc_humid": None, "opc_temp": None}
 
         self.thread = threading.Thread(target=self._opc_worker)
         self.thread.daemon = True
         self.thread.start()
-        # Give the thread some time to connect to the opc
-        time.sleep(3)
+
+    def _open_spi(self) -> None:
+        self.spi.open(0, 0)
+        self.spi.mode = 1
+        self.spi.max_speed_hz = 500000
 
     def _opc_worker(self) -> None:
         while True:
-            if not self.connected:
-                self.alphasense = pyopcn3.OPCN3(self.spi)
+            if self.state == STATE_DISCONNECTED:
+                self._connect()
+            elif self.state == STATE_RESETTING:
+                self._reset_spi()
+            else:
+                if config.OPC_DUTY_CYCLE_ENABLE:
+                    self._handle_duty_cycle()
+                if self.request_data.wait(timeout=0.01):
+                    self.request_data.clear()
+                    self.data = self._read_histogram() if self.sampling_valid else None
+                    self.data_ready.set()
+
+    def _handle_duty_cycle(self) -> None:
+        """Switch fan and laser on for OPC_DUTY_CYCLE_ON_TIME out of every OPC_DUTY_CYCLE_PERIOD seconds"""
+        now = time.monotonic()
+        if self.sampling_active:
+            self.on_seconds += now - self.duty_timestamp
+        else:
+            self.off_seconds += now - self.duty_timestamp
+        self.duty_timestamp = now
+        in_window = (now - self.cycle_start) % config.OPC_DUTY_CYCLE_PERIOD < config.OPC_DUTY_CYCLE_ON_TIME
+        try:
+            if in_window and not self.sampling_active:
                 self.alphasense.on()
-                time.sleep(1)
-                self.connected = True
-            elif self.request_data.wait(timeout=0.01):
-                self.data = self.alphasense.histogram(number_concentration=False)
-                self.request_data.clear()
-                self.data_ready.set()
+                self.sampling_active = True
+                self.warmup_until = time.monotonic() + config.OPC_DUTY_CYCLE_WARMUP
+            elif not in_window and self.sampling_active:
+                self.sampling_valid = False
+                self.alphasense.off()
+                self.sampling_active = False
+            elif self.sampling_active and not self.sampling_valid and time.monotonic() >= self.warmup_until:
+                # Discard the histogram accumulated while the fan was spinning up
+                self.alphasense.histogram(number_concentration=False)
+                self.sampling_valid = True
+        except (pyopcn3.OPCTimeoutError, OSError) as e:
+            prt.GLOBAL_ENTITY.print_once(f"OPC duty cycle switching failed, dump: {e}", "OPC duty cycle switching recovered")
+            self.sampling_active = False
+            self.sampling_valid = False
+            self.state = STATE_DISCONNECTED
+
+    def _connect(self) -> None:
+        """Full re-init: recreate the pyopcn3 instance and power on fan and laser"""
+        self.state = STATE_CONNECTING
+        try:
+            self.alphasense = pyopcn3.OPCN3(
+                self.spi,
+                command_timeout=config.OPC_COMMAND_TIMEOUT,
+                backoff_max=config.OPC_RECONNECT_BACKOFF_MAX,
+                init_delay=0,
+            )
+            self.alphasense.on()
+            time.sleep(1)
+            self.sampling_active = True
+            # In duty cycle mode the first seconds after switching on are discarded
+            self.sampling_valid = not config.OPC_DUTY_CYCLE_ENABLE
+            self.warmup_until = time.monotonic() + config.OPC_DUTY_CYCLE_WARMUP
+            self.state = STATE_RUNNING
+            self.failed_resets = 0
+            # fan and laser answered, the next histogram request gets a valid sample
+            self._set_ready()
+        except (pyopcn3.OPCTimeoutError, OSError) as e:
+            prt.GLOBAL_ENTITY.print_once(f"OPC connection failed, dump: {e}", "OPC connection established", self.backoff + 2)
+            self.state = STATE_DISCONNECTED
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, config.OPC_RECONNECT_BACKOFF_MAX)
+
+    def _reset_spi(self) -> None:
+        """Partial re-init: reopen the SPI device and check if the OPC answers without a power cycle"""
+        self.spi_reset_count += 1
+        try:
+            self.spi.close()
+            self._open_spi()
+            if self.alphasense.histogram(number_concentration=False) is not None:
+                self.state = STATE_RUNNING
+                self.failed_resets = 0
+                return
+        except (pyopcn3.OPCTimeoutError, OSError):
+            pass
+        self.failed_resets += 1
+        if self.failed_resets >= config.OPC_SPI_RESET_ATTEMPTS:
+            # SPI reset did not help, power cycle fan and laser
+            self.state = STATE_DISCONNECTED
+        else:
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, config.OPC_RECONNECT_BACKOFF_MAX)
+
+    def _read_histogram(self) -> Optional[Dict[str, Any]]:
+        try:
+            data = self.alphasense.histogram(number_concentration=False)
+        except (pyopcn3.OPCTimeoutError, OSError):
+            data = None
+        if data is None:
+            # Checksum mismatch or no answer, try to recover with an SPI reset first
+            if self.failure_timestamp is None:
+                self.failure_timestamp = time.time()
+            self.state = STATE_RESETTING
+            return None
+        if self.failure_timestamp is not None:
+            self.recovery_count += 1
+            self.last_recovery_time = round(time.time() - self.failure_timestamp, config.DIGIT_ACCURACY)
+            self.failure_timestamp = None
+        self.backoff = config.OPC_RECONNECT_BACKOFF_MIN
+        return data
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        ret = {
+            "opc_state": self.state,
+            "opc_recoveries": self.recovery_count,
+            "opc_spi_resets": self.spi_reset_count,
+            "opc_recovery_time": self.last_recovery_time,
+            "opc_duty_cycle": 100,
+            "opc_energy_saved": 0,
+        }
+        if config.OPC_DUTY_CYCLE_ENABLE and self.on_seconds + self.off_seconds > 0:
+            # measured share of time fan and laser were on in %, saved energy since start in Wh
+            ret["opc_duty_cycle"] = round(100 * self.on_seconds / (self.on_seconds + self.off_seconds), config.DIGIT_ACCURACY)
+            ret["opc_energy_saved"] = round(self.off_seconds * config.OPC_DUTY_CYCLE_SAVED_POWER / 3600, config.DIGIT_ACCURACY)
+        return ret
 
     def get_data(self) -> Dict[str, Optional[float]]:
         ret = {
@@ -95,17 +242,18 @@ class OPCHandler(SensorBase):
             "RAW_OPC_Checksum": None,
         }
 
-        if self.connected:
+        if self.state == STATE_RUNNING and self.sampling_valid:
             self.data_ready.clear()
             self.request_data.set()
-            if self.data_ready.wait(timeout=0.5):
+            if self.data_ready.wait(timeout=0.5) and self.data is not None:
                 ret["pm1"] = round(self.data["PM1"], config.DIGIT_ACCURACY)
                 ret["pm25"] = round(self.data["PM2.5"], config.DIGIT_ACCURACY)
                 ret["pm10"] = round(self.data["PM10"], config.DIGIT_ACCURACY)
                 ret["opc_flow"] = round(self.data["SFR"], config.DIGIT_ACCURACY)
                 # Apply two point calibration
-                ret["opc_humid"] = self._calibrate(self.data["Relative humidity"], config.OPC_CALI_HUMID)
-                ret["opc_temp"] = self._calibrate(self.data["Temperature"], config.OPC_CALI_TEMP)
+                ret["opc_humid"] = self.cali_humid(self.data["Relative humidity"])
+                ret["opc_temp"] = self.cali_temp(self.data["Temperature"])
+                self.last_climate = {"opc_humid": ret["opc_humid"], "opc_temp": ret["opc_temp"]}
 
                 prefix = "RAW_OPC_"
                 prefixed_data = {
@@ -114,12 +262,27 @@ class OPCHandler(SensorBase):
                 }
                 ret.update(prefixed_data)
 
-            else:
-                self.connected = False
+                if self.psd is not None:
+                    counts = [self.data[f"Bin {i}"] for i in range(BIN_COUNT)]
+                    self.psd.add(counts, self.data["SFR"], self.data["Sampling Period"])
+        elif self.state == STATE_RUNNING:
+            # Idle duty cycle window, the enclosure climate changes slowly so keep reporting the last reading
+            ret.update(self.last_climate)
         else:
             prt.GLOBAL_ENTITY.print_once("OPC disconnected", "OPC back online")
+        # Outside of valid duty cycle windows None is returned, so only valid seconds are averaged
         self.data = None
         return ret
 
+    def get_psd_data(self) -> Dict[str, float]:
+        """Particle size distribution since the last call, derived from summed counts and sample volume"""
+        if self.psd is None:
+            return {}
+        return self.psd.get_data()
+
     def stop(self) -> None:
-        self.alphasense.off()
+        if self.alphasense is not None:
+            try:
+                self.alphasense.off()
+            except (pyopcn3.OPCTimeoutError, OSError) as e:
+                prt.GLOBAL_ENTITY.error(f"Failed to turn off OPC, dump: {e}")
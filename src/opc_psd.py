@@ -0,0 +1,92 @@
+from typing import Dict, Sequence
+import threading
+import numpy as np
+import config
+
+# OPC-N3 default bin boundaries in µm, 25 boundaries for the 24 histogram bins
+OPC_N3_BIN_BOUNDARIES = (
+    0.35, 0.46, 0.66, 1.0, 1.3, 1.7, 2.3, 3.0, 4.0, 5.2, 6.5, 8.0, 10.0,
+    12.0, 14.0, 16.0, 18.0, 20.0, 22.0, 25.0, 28.0, 31.0, 34.0, 37.0, 40.0,
+)
+BIN_COUNT = len(OPC_N3_BIN_BOUNDARIES) - 1
+
+
+class ParticleSizeDistribution:
+    """
+    Accumulates raw OPC histograms and their sample volume and derives the particle size distribution.
+    Averaging raw bin counts is wrong if the sampling period or flow rate changes between histograms,
+    the correct concentration is the summed count divided by the summed sample volume.
+    """
+
+    def __init__(self, bin_boundaries: Sequence[float] = OPC_N3_BIN_BOUNDARIES, density: float = 1.65) -> None:
+        """
+        :bin_boundaries: in µm, one more entry than there are bins
+        :density: particle density in g/cm³ used for the mass estimation
+        """
+        boundaries = np.asarray(bin_boundaries, dtype=np.float64)
+        # Everything that only depends on the bin geometry is calculated once
+        self.dlogdp = np.diff(np.log10(boundaries))
+        self.midpoints = np.sqrt(boundaries[:-1] * boundaries[1:])  # geometric mean diameter in µm
+        # mass of one particle per cm³ expressed in µg/m³: pi/6 * d³[µm³] * rho[g/cm³] * 1e-12 * 1e6 * 1e6
+        self.particle_mass = np.pi / 6 * self.midpoints ** 3 * density
+        self.lock = threading.Lock()
+        self.counts = np.zeros(len(self.midpoints), dtype=np.float64)
+        self.sample_volume = 0.
+        self.samples = 0
+
+    def add(self, counts: Sequence[float], sfr: float, sampling_period: float) -> bool:
+        """
+        :counts: raw histogram bin counts
+        :sfr: sample flow rate in ml/s
+        :sampling_period: histogram sampling period in s
+        :return: False if the histogram has no valid sample volume and was skipped
+        """
+        volume = sfr * sampling_period  # in ml = cm³
+        if not volume > 0:
+            return False
+        with self.lock:
+            self.counts += np.asarray(counts, dtype=np.float64)
+            self.sample_volume += volume
+            self.samples += 1
+        return True
+
+    def compute(self, counts: np.ndarray, sample_volume: float) -> Dict[str, np.ndarray]:
+        """Derive number concentration in #/cm³, dN/dlogDp in #/cm³ and mass in µg/m³ per bin"""
+        concentration = counts / sample_volume
+        return {
+            "concentration": concentration,
+            "dndlogdp": concentration / self.dlogdp,
+            "mass": concentration * self.particle_mass,
+        }
+
+    def get_data(self) -> Dict[str, float]:
+        """
+        Returns the distribution accumulated since the last call and starts a new accumulation period.
+        Like the averaged data, missing values are reported as 0 instead of None.
+        """
+        with self.lock:
+            counts, sample_volume, samples = self.counts, self.sample_volume, self.samples
+            self.counts = np.zeros(len(self.midpoints), dtype=np.float64)
+            self.sample_volume = 0.
+            self.samples = 0
+
+        if samples == 0:
+            ret = {"opc_nc": 0, "opc_mass": 0, "RAW_PSD_Samples": 0, "RAW_PSD_Sample volume": 0}
+            for i in range(len(self.midpoints)):
+                ret[f"RAW_PSD_Conc {i}"] = 0
+                ret[f"RAW_PSD_dNdlogDp {i}"] = 0
+                ret[f"RAW_PSD_Mass {i}"] = 0
+            return ret
+
+        psd = self.compute(counts, sample_volume)
+        ret = {
+            "opc_nc": round(float(psd["concentration"].sum()), config.DIGIT_ACCURACY),
+            "opc_mass": round(float(psd["mass"].sum()), config.DIGIT_ACCURACY),
+            "RAW_PSD_Samples": samples,
+            "RAW_PSD_Sample volume": round(sample_volume, config.DIGIT_ACCURACY),
+        }
+        for i in range(len(self.midpoints)):
+            ret[f"RAW_PSD_Conc {i}"] = round(float(psd["concentration"][i]), config.DIGIT_ACCURACY)
+            ret[f"RAW_PSD_dNdlogDp {i}"] = round(float(psd["dndlogdp"][i]), config.DIGIT_ACCURACY)
+            ret[f"RAW_PSD_Mass {i}"] = round(float(psd["mass"][i]), config.DIGIT_ACCURACY)
+        return ret
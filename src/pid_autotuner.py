@@ -1,18 +1,23 @@
+from typing import Callable, Optional, Tuple
 import time
 import math
+import prt
 
 
 class PIDAutoTuner:
     # Heavily inspired by the klipper PID_CALIBRATE command implementation
-    def __init__(self, calibration_temperature: float = 42, relay_hysteresis_delta: float = 3.5) -> None:
+    def __init__(self, calibration_temperature: float = 42, relay_hysteresis_delta: float = 3.5,
+                 clock: Callable[[], float] = time.time) -> None:
         """
         :calibration_temperature: in °C, around which temperature the relay oscillation occurs
         This temperature should be where the controller will be run at most of the time
         :relay_hysteresis_delta: in °C, when the relay turns on and off -> oscillation amplitude
         Lower relay_hysteresis_deltas yield more aggressive less robust control parameters
+        :clock: time source in seconds, replaced by a simulated clock in heater_simulator.py
         """
         self.calibration_temperature = calibration_temperature
         self.relay_hysteresis_delta = relay_hysteresis_delta
+        self.clock = clock
         self._param_init()
 
     def _param_init(self):
@@ -26,6 +31,7 @@ class PIDAutoTuner:
         self.temp_samples = []
         self.last_power = 0
         self.tuning_completed = False
+        self.tuned_parameters: Optional[Tuple[float, float, float]] = None
     
     def get_target_temp(self) -> int:
         return self.target_temp
@@ -35,7 +41,7 @@ class PIDAutoTuner:
         if self.tuning_completed:
             return power
         
-        now = time.time()
+        now = self.clock()
         self.temp_samples.append((now, current_temp))
         if self.heating and current_temp >= self.target_temp:
             self.heating = False
@@ -64,7 +70,8 @@ class PIDAutoTuner:
 
         if not self.heating and len(self.peaks) >= 12:
             Kp, Ki, Kd = self._calc_final_pid()
-            print(f"Heater PID autotuning is done, final parameters: Kp={Kp} Ki={Ki} Kd={Kd}")
+            prt.GLOBAL_ENTITY.info(f"Heater PID autotuning is done, final parameters: Kp={Kp} Ki={Ki} Kd={Kd}")
+            self.tuned_parameters = (Kp, Ki, Kd)
             self.tuning_completed = True
             self.target_temp = 0
 
@@ -72,8 +79,8 @@ class PIDAutoTuner:
     
     def _check_peaks(self):
         if len(self.peaks) == 0:
-            print(f"Starting Heater PID Autotuning at calibration temperature:{self.calibration_temperature}")
-        print(f"detected peak at:{self.peak}, peak:{len(self.peaks) + 1}/12")
+            prt.GLOBAL_ENTITY.info(f"Starting Heater PID Autotuning at calibration temperature:{self.calibration_temperature}")
+        prt.GLOBAL_ENTITY.info(f"detected peak at:{self.peak}, peak:{len(self.peaks) + 1}/12")
         self.peaks.append((self.peak, self.peak_time))
         if self.heating:
             self.peak = 9999999.
@@ -102,7 +109,7 @@ class PIDAutoTuner:
         Kp = 0.4 * Ku
         Ki = Kp / Ti
         Kd = 0
-        print(f"Autotune PID: raw={temp_diff}/{100} Ku={Ku} Tu={Tu}  Kp={Kp} Ki={Ki} Kd={Kd}")
+        prt.GLOBAL_ENTITY.info(f"Autotune PID: raw={temp_diff}/{100} Ku={Ku} Tu={Tu}  Kp={Kp} Ki={Ki} Kd={Kd}")
         return Kp, Ki, Kd
     
     def _calc_final_pid(self):
@@ -1,15 +1,36 @@
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from collections import deque
+import logging
+import queue
+import sys
 import time
 import threading
+import config
 
-# This variable is used to share the same instance of OncePrinter across all modules.
-# This way only one msg list and only one thread are created
+# This variable is used to share the same instance of EventLogger across all modules.
+# This way only one event buffer and only one writer thread are created
 GLOBAL_ENTITY = None
 
+# Severity levels, the same values as the logging module so log records map onto them directly
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+SEVERITY_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+# events below this severity are only counted, e.g. the pyopcn3 debug output
+WRITE_SEVERITY = INFO
+# lines waiting for the writer thread, more are dropped and counted instead of blocking the caller
+WRITE_QUEUE_SIZE = 1000
+# keys with counters, the oldest key is forgotten when a new one exceeds this, messages often contain dumps
+MAX_KEYS = 1000
+# active faults are reported in telemetry with their message cut to this length
+FAULT_TELEMETRY_LENGTH = 64
 
-# The purpose of this thread is to turn frequently occuring identical print statements into
-# a start message printed at the first time calling the printOnce method
+
+# The purpose of print_once is to turn frequently occuring identical print statements into
+# a start message printed at the first time calling the print_once method
 # and an end message printed if the last time
-# a printOnce message was called is farther in the past then the timeout.
+# a print_once message was called is farther in the past then the timeout.
 # This keeps the log files readable
 # this: print("modem error")
 # modem error
@@ -17,31 +38,155 @@ GLOBAL_ENTITY = None
 # modem error
 # modem error
 # ...
-# gets turned into :prt.global_entity.printOnce("modem error started", "modem error ended")
+# gets turned into :prt.GLOBAL_ENTITY.print_once("modem error started", "modem error ended")
 # modem error started
 # modem error ended
+# Messages of print_once are active faults until their end message is printed, they are reported in telemetry.
+
+
+class Fault:
+    __slots__ = ("last_seen", "end_msg", "timeout")
 
+    def __init__(self, last_seen: float, end_msg: str, timeout: float) -> None:
+        self.last_seen = last_seen
+        self.end_msg = end_msg
+        self.timeout = timeout
 
-class OncePrinter:
-    def __init__(self):
-        self.msgs = {}
-        self.thread = threading.Thread(target=self._handle_prints)
+
+class EventLogger:
+    """
+    Thread safe event log. Events are kept in a bounded ring buffer and counted per key,
+    repeated events of a key are rate limited and a writer thread prints them, so logging never blocks the caller.
+    """
+    def __init__(self, buffer_size: int = config.EVENT_BUFFER_SIZE, rate_limit: float = config.EVENT_RATE_LIMIT) -> None:
+        self.lock = threading.Lock()
+        self.rate_limit = rate_limit
+        self.events: Deque[Tuple[float, int, str, str]] = deque(maxlen=buffer_size)  # (time, severity, key, msg)
+        self.counters: Dict[str, int] = {}
+        self.last_written: Dict[str, float] = {}
+        self.suppressed: Dict[str, int] = {}
+        self.faults: Dict[str, Fault] = {}
+        self.dropped = 0
+        self.write_queue: "queue.Queue[str]" = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._writer)
         self.thread.daemon = True
         self.thread.start()
 
-    def _handle_prints(self) -> None:
-        # Every second this checks if errors stopped occurring and prints the end message
-        while True:
-            for msg in list(self.msgs.keys()):
-                if time.time() - self.msgs[msg]["time"] > int(
-                    self.msgs[msg]["timeout"]
-                ):
-                    if self.msgs[msg]["end"] is not False:
-                        print(self.msgs[msg]["end"])
-                    del self.msgs[msg]
-            time.sleep(1)
+    def log(self, severity: int, msg: str, key: Optional[str] = None) -> None:
+        """Records msg, events with the same key (default msg) are written at most once per rate_limit seconds"""
+        key = msg if key is None else key
+        now = time.time()
+        with self.lock:
+            self._count(key)
+            if severity < WRITE_SEVERITY:
+                return
+            self.events.append((now, severity, key, msg))
+            if now - self.last_written.get(key, -self.rate_limit) < self.rate_limit:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return
+            self.last_written[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            msg = f"{msg} (repeated {suppressed} times)"
+        self._write(msg if severity == INFO else f"{SEVERITY_NAMES.get(severity, severity)}: {msg}")
+
+    def debug(self, msg: str, key: Optional[str] = None) -> None:
+        self.log(DEBUG, msg, key)
+
+    def info(self, msg: str, key: Optional[str] = None) -> None:
+        self.log(INFO, msg, key)
+
+    def warning(self, msg: str, key: Optional[str] = None) -> None:
+        self.log(WARNING, msg, key)
+
+    def error(self, msg: str, key: Optional[str] = None) -> None:
+        self.log(ERROR, msg, key)
 
     def print_once(self, msg: str, end_msg: str, timeout: int = 2) -> None:
-        if msg not in self.msgs:
-            print(msg)
-        self.msgs[msg] = {"time": time.time(), "end": end_msg, "timeout": timeout}
+        now = time.time()
+        with self.lock:
+            new = msg not in self.faults
+            self.faults[msg] = Fault(now, end_msg, timeout)
+            self._count(msg)
+            if new:
+                self.events.append((now, WARNING, msg, msg))
+        if new:
+            self._write(msg)
+
+    def get_events(self, min_severity: int = WRITE_SEVERITY) -> List[Tuple[float, int, str, str]]:
+        """The buffered (time, severity, key, msg) events, oldest first"""
+        with self.lock:
+            return [event for event in self.events if event[1] >= min_severity]
+
+    def get_counters(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def get_active_faults(self) -> List[str]:
+        with self.lock:
+            return sorted(self.faults)
+
+    def get_telemetry(self) -> Dict[str, Any]:
+        faults = self.get_active_faults()
+        return {
+            "active_faults": [fault[:FAULT_TELEMETRY_LENGTH] for fault in faults],
+            "active_fault_count": len(faults),
+            "log_dropped": self.dropped,
+        }
+
+    def _count(self, key: str) -> None:
+        if key not in self.counters and len(self.counters) >= MAX_KEYS:
+            oldest = next(iter(self.counters))
+            del self.counters[oldest]
+            self.last_written.pop(oldest, None)
+            self.suppressed.pop(oldest, None)
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    def _write(self, line: str) -> None:
+        try:
+            self.write_queue.put_nowait(line)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def flush(self, timeout: float = 1.) -> None:
+        """Waits up to timeout seconds for the writer thread to print the queued lines, e.g. before exiting"""
+        deadline = time.monotonic() + timeout
+        while self.write_queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _expire_faults(self) -> None:
+        # Checks if errors stopped occurring and prints the end message
+        now = time.time()
+        with self.lock:
+            ended = [msg for msg, fault in self.faults.items() if now - fault.last_seen > fault.timeout]
+            end_msgs = [self.faults.pop(msg).end_msg for msg in ended]
+        for end_msg in end_msgs:
+            if end_msg is not False:
+                self._write(end_msg)
+
+    def _writer(self) -> None:
+        next_expiry = time.monotonic() + 1
+        while True:
+            try:
+                line = self.write_queue.get(timeout=max(next_expiry - time.monotonic(), 0))
+                sys.stdout.write(line + "\n")
+                if self.write_queue.empty():
+                    sys.stdout.flush()
+                self.write_queue.task_done()
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_expiry:
+                self._expire_faults()
+                next_expiry = time.monotonic() + 1
+
+
+class EventLogHandler(logging.Handler):
+    """Passes records of the logging module, e.g. from pyopcn3, to the event logger"""
+    def emit(self, record: logging.LogRecord) -> None:
+        if GLOBAL_ENTITY is None:
+            return
+        try:
+            GLOBAL_ENTITY.log(record.levelno, f"{record.name}: {record.getMessage()}", key=f"{record.name}:{record.msg}")
+        except Exception:
+            self.handleError(record)
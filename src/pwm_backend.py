@@ -0,0 +1,201 @@
+from typing import Dict, Any, List, Optional, Callable, Tuple
+from abc import ABC, abstractmethod
+import argparse
+import os
+import time
+import config
+
+# Heater PWM outputs. RPi.GPIO generates the PWM in software with a background thread,
+# the sysfs backend uses the hardware PWM of the SoC which needs no CPU and does not jitter.
+# HEATER_PIN 12 (GPIO18) is PWM0 channel 0 on the Raspberry Pi, enable it with the device tree overlay
+# dtoverlay=pwm,pin=18,func=2 (balena: BALENA_HOST_CONFIG_dtoverlay="pwm,pin=18,func=2")
+
+
+class PWMBackend(ABC):
+    """Common interface of all heater PWM outputs, duty cycles are in % like RPi.GPIO uses them"""
+    name = "none"
+
+    @abstractmethod
+    def set_duty_cycle(self, duty_cycle: float) -> None:
+        pass
+
+    def measure_duty_cycle(self, duration: float = 1.) -> Optional[float]:
+        """Duty cycle in % the output actually produces, None if the backend can't measure it"""
+        return None
+
+    @abstractmethod
+    def stop(self) -> None:
+        pass
+
+
+class RPiGPIOPWM(PWMBackend):
+    name = "rpi_gpio"
+
+    def __init__(self, pin: int = config.HEATER_PIN, frequency: float = config.HEATER_PWM_FREQUENCY) -> None:
+        import RPi.GPIO
+        self.GPIO = RPi.GPIO
+        self.pin = pin
+        self.GPIO.setmode(self.GPIO.BOARD)
+        self.GPIO.setwarnings(False)
+        self.GPIO.setup(pin, self.GPIO.OUT)
+        self.p = self.GPIO.PWM(pin, frequency)
+        self.p.start(0)
+
+    def set_duty_cycle(self, duty_cycle: float) -> None:
+        self.p.ChangeDutyCycle(duty_cycle)
+
+    def measure_duty_cycle(self, duration: float = 1.) -> Optional[float]:
+        # Sample the output pin level as fast as possible, the share of high samples is the duty cycle
+        high = 0
+        total = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            high += self.GPIO.input(self.pin)
+            total += 1
+        return 100 * high / total if total else None
+
+    def stop(self) -> None:
+        self.p.ChangeDutyCycle(0)
+        self.p.stop()
+        self.GPIO.cleanup()
+
+
+class SysfsPWM(PWMBackend):
+    name = "sysfs"
+
+    def __init__(self, chip: int = config.HEATER_PWM_CHIP, channel: int = config.HEATER_PWM_CHANNEL,
+                 frequency: float = config.HEATER_PWM_FREQUENCY) -> None:
+        self.chip_path = f"/sys/class/pwm/pwmchip{chip}"
+        self.channel = channel
+        self.path = f"{self.chip_path}/pwm{channel}"
+        if not os.path.exists(self.path):
+            self._write(f"{self.chip_path}/export", channel)
+        # udev needs a moment to set the permissions of the exported channel
+        for _ in range(50):
+            if os.access(f"{self.path}/enable", os.W_OK):
+                break
+            time.sleep(0.02)
+        self.period = int(1e9 / frequency)
+        # duty_cycle must never be larger than period, so zero it before changing the period
+        self._write(f"{self.path}/duty_cycle", 0)
+        self._write(f"{self.path}/period", self.period)
+        self._write(f"{self.path}/enable", 1)
+        # keep duty_cycle open, every update is then a single write syscall
+        self.duty_fd = os.open(f"{self.path}/duty_cycle", os.O_WRONLY)
+        self.duty_ns = 0
+
+    @staticmethod
+    def _write(path: str, value: int) -> None:
+        with open(path, "w") as f:
+            f.write(str(value))
+
+    @staticmethod
+    def _read(path: str) -> int:
+        with open(path) as f:
+            return int(f.read())
+
+    def set_duty_cycle(self, duty_cycle: float) -> None:
+        duty_ns = int(self.period * min(max(duty_cycle, 0), 100) / 100)
+        if duty_ns != self.duty_ns:
+            os.pwrite(self.duty_fd, str(duty_ns).encode(), 0)
+            self.duty_ns = duty_ns
+
+    def measure_duty_cycle(self, duration: float = 1.) -> Optional[float]:
+        # The hardware generates exactly what is programmed, read it back to include the quantization
+        return 100 * self._read(f"{self.path}/duty_cycle") / self._read(f"{self.path}/period")
+
+    def stop(self) -> None:
+        self.set_duty_cycle(0)
+        os.close(self.duty_fd)
+        self._write(f"{self.path}/enable", 0)
+        self._write(f"{self.chip_path}/unexport", self.channel)
+
+
+class FakePWM(PWMBackend):
+    """In memory PWM for the heater simulator and tests"""
+    name = "fake"
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, keep_history: bool = False) -> None:
+        """
+        :clock: time source for the history timestamps
+        :keep_history: record every (time, duty_cycle) change in history
+        """
+        self.clock = clock
+        self.duty_cycle = 0.
+        self.changes = 0
+        self.stopped = False
+        self.history: Optional[List[Tuple[float, float]]] = [] if keep_history else None
+
+    def set_duty_cycle(self, duty_cycle: float) -> None:
+        if duty_cycle != self.duty_cycle:
+            self.changes += 1
+            if self.history is not None:
+                self.history.append((self.clock(), duty_cycle))
+        self.duty_cycle = duty_cycle
+
+    def measure_duty_cycle(self, duration: float = 1.) -> Optional[float]:
+        return self.duty_cycle
+
+    def stop(self) -> None:
+        self.duty_cycle = 0.
+        self.stopped = True
+
+
+BACKENDS = {
+    RPiGPIOPWM.name: RPiGPIOPWM,
+    SysfsPWM.name: SysfsPWM,
+    FakePWM.name: FakePWM,
+}
+
+
+def create_pwm_backend(name: str = config.HEATER_PWM_BACKEND) -> PWMBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown heater pwm backend: {name}, use one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+def benchmark(backend: PWMBackend, duty_cycles: Tuple[float, ...] = (10, 50, 90), duration: float = 5.) -> List[Dict[str, Any]]:
+    """
+    Measures the CPU time this process spends per second of PWM output and the duty cycle error of a backend.
+    The CPU time includes the RPi.GPIO PWM thread, which runs inside this process.
+    """
+    ret = []
+    for duty_cycle in duty_cycles:
+        backend.set_duty_cycle(duty_cycle)
+        time.sleep(0.5)
+        cpu_start = time.process_time()
+        time.sleep(duration)
+        cpu_usage = (time.process_time() - cpu_start) / duration * 100
+        measured = backend.measure_duty_cycle()
+        ret.append({
+            "duty_cycle": duty_cycle,
+            "cpu_usage": round(cpu_usage, 2),
+            "measured": None if measured is None else round(measured, 2),
+            "error": None if measured is None else round(measured - duty_cycle, 2),
+        })
+    backend.set_duty_cycle(0)
+    return ret
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure CPU usage and duty cycle accuracy of the heater pwm backends, "
+                                                 "stop the node first, this drives the heater")
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS), help="backends to measure, default all")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per duty cycle")
+    args = parser.parse_args(argv)
+
+    for name in args.backend or list(BACKENDS):
+        try:
+            backend = create_pwm_backend(name)
+        except Exception as e:
+            print(f"{name}: not available, dump: {e}")
+            continue
+        try:
+            for result in benchmark(backend, duration=args.duration):
+                print(f"{name}: " + ", ".join(f"{key}={val}" for key, val in result.items()))
+        finally:
+            backend.stop()
+
+
+if __name__ == "__main__":
+    main()
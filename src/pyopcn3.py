@@ -1,14 +1,19 @@
+import bisect
 import logging
 import re
 import struct
-from time import sleep
+from time import sleep, monotonic
 import sys
 
-# set up a default logger
-logging.basicConfig(level=logging.INFO)
+# records go to the handlers of the application, prt.EventLogHandler on the node
 logger = logging.getLogger(__name__)
 
 
+class OPCTimeoutError(IOError):
+    """Raised if the OPC does not acknowledge a command within the configured timeout"""
+    pass
+
+
 class _OPC(object):
     """Generic class for any Alphasense OPC. Provides the common methods and calculations for each OPC. This class is designed to be the base class, and should not be used alone unless during development.
     :param spi_connection: spidev.SpiDev or usbiss.spi.SPI connection
@@ -17,6 +22,11 @@ class _OPC(object):
     :param firmware: You can manually set the firmware version as a tuple. Ex. (18,2)
     :param max_cnxn_retries: Maximum number of times a connection will try to be made.
     :param retry_interval_ms: The sleep interval for the device between retrying to connect to the OPC. Units are in ms.
+    :param command_timeout: Seconds a command handshake may take before OPCTimeoutError is raised.
+    :param histogram_timeout: Seconds a histogram request may take before OPCTimeoutError is raised.
+    :param backoff_min: First sleep interval in seconds between handshake polls, doubled on every retry.
+    :param backoff_max: Upper bound in seconds for the handshake poll interval.
+    :param init_delay: Seconds to sleep after initialization if wait is not requested.
     :raises: opc.exceptions.SpiConnectionError
     :type spi_connection: spidev.SpiDev or usbiss.spi.SPI
     :type debug: boolean
@@ -30,6 +40,10 @@ class _OPC(object):
         self.cnxn = spi_connection
         self.debug = kwargs.get('debug', False)
         self.model = kwargs.get('model', 'N2')
+        self.command_timeout = kwargs.get('command_timeout', 10.)
+        self.histogram_timeout = kwargs.get('histogram_timeout', 0.4)
+        self.backoff_min = kwargs.get('backoff_min', 0.1)
+        self.backoff_max = kwargs.get('backoff_max', 3.)
 
         if firmware is not None:
             major, minor = firmware[0], firmware[1]
@@ -63,7 +77,7 @@ class _OPC(object):
                 # store the info_string
                 infostring = self.read_info_string()
 
-                print(infostring)
+                logger.info(infostring)
 
                 try:
                     self.firmware['version'] = int(re.findall("\d{3}", infostring)[-1])
@@ -91,7 +105,7 @@ class _OPC(object):
             self.wait(**kwargs)
 
         else:  # Sleep for a bit to alleviate issues
-            sleep(1)
+            sleep(kwargs.get('init_delay', 1))
 
     def _16bit_unsigned(self, LSB, MSB):
         """Returns the combined LSB and MSB
@@ -129,7 +143,7 @@ class _OPC(object):
         :type vals: array
         :rtype: float
         """
-        print("temp: ", vals)
+        logger.debug("temp: %s", vals)
         if len(vals) < 4:
             return None
         return ((vals[3] << 24) | (vals[2] << 16) | (vals[1] << 8) | vals[0])
@@ -250,7 +264,14 @@ class _OPC(object):
             :rtype: int
         """
 
-        return min(enumerate(OPC_LOOKUP), key=lambda x: abs(x[1] - bb))[0]
+        # OPC_LOOKUP is monotonically increasing, bisect instead of scanning all 4096 entries
+        pos = bisect.bisect_left(OPC_LOOKUP, bb)
+        if pos == 0:
+            return 0
+        if pos == len(OPC_LOOKUP):
+            return len(OPC_LOOKUP) - 1
+        # on a tie the lower adc value wins, like the previous linear scan
+        return pos if OPC_LOOKUP[pos] - bb < bb - OPC_LOOKUP[pos - 1] else pos - 1
 
     def read_info_string(self):
         """Reads the information string for the OPC
@@ -312,173 +333,79 @@ class OPCN3(_OPC):
 
     ## raise FirmwareVersionError("Your firmware is not yet supported. Only versions 14-18 ...")
 
-    def fan_on(self):
-
+    def _wait_for_ready(self, cmd, timeout=None):
+        """Poll the OPC with a command byte until it answers 0x31, backing off exponentially between polls.
+        :param cmd: command byte to poll with
+        :param timeout: seconds until OPCTimeoutError is raised, defaults to the command_timeout of the instance
+        :raises: OPCTimeoutError
+        """
+        timeout = self.command_timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        backoff = self.backoff_min
+        a = self.cnxn.xfer([cmd])[0]
+        while a != 0x31:
+            if monotonic() + backoff > deadline:
+                raise OPCTimeoutError("OPC did not acknowledge command {} within {} s, last response: {}".format(
+                    hex(cmd), timeout, hex(a)))
+            sleep(backoff)
+            backoff = min(backoff * 2, self.backoff_max)
+            a = self.cnxn.xfer([cmd])[0]
+            logger.debug("CMD: %s %s", hex(a), a)
+
+    def _set_peripheral(self, option):
+        """Run the 0x03 handshake and send the peripheral option byte
+        (0x02 fan off, 0x03 fan on, 0x06 laser off, 0x07 laser on)
+        :rtype: boolean
+        :raises: OPCTimeoutError
+        """
         # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            print("CMD: ", hex(a), a)
+        self._wait_for_ready(0x03)
         sleep(0.02)  # >10ms <100ms
         a = self.cnxn.xfer([0x03])[0]
         sleep(0.02)
 
-        # SEND 0x03 TO SET FAN ON
-        a = int('0x03', 16)
-        print("sending ", "{0:08b}".format(a))
-        a = self.cnxn.xfer([0x03])[0]
-        print("FAN_ON: ", hex(a), a)
-
-    def fan_off(self):
+        # SEND OPTION BYTE
+        b = self.cnxn.xfer([option])[0]
+        logger.debug("OPTION %s: %s %s", hex(option), hex(b), b)
+        return a == 0xF3 and b == 0x03
 
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
+    def fan_on(self):
+        return self._set_peripheral(0x03)
 
-        # SEND 0x02 TO SET FAN OFF
-        a = int('0x02', 16)
-        print("sending ", "{0:08b}".format(a))
-        a = self.cnxn.xfer([0x02])[0]
-        print("FAN_OFF: ", hex(a), a)
+    def fan_off(self):
+        return self._set_peripheral(0x02)
 
     def laser_on(self):
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x07 TO SET FAN ON
-        a = int('0x07', 16)
-        print("sending ", "{0:08b}".format(a))
-        a = self.cnxn.xfer([0x07])[0]
-        print("LASER_ON: ", hex(a), a)
+        return self._set_peripheral(0x07)
 
     def laser_off(self):
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x06 TO SET LASER OFF
-        a = int('0x06', 16)
-        print("sending ", "{0:08b}".format(a))
-        a = self.cnxn.xfer([0x06])[0]
-        print("LASER_OFF: ", hex(a), a)
+        return self._set_peripheral(0x06)
 
     def on(self):
         """Turn ON the OPC (fan and laser)
         :rtype: boolean
+        :raises: OPCTimeoutError
         :Example:
         >>> alpha.on()
         True
         """
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        # print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            # print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a1 = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x03 TO SET FAN ON
-        a = int('0x03', 16)
-        # print("sending ", "{0:08b}".format(a))
-        b1 = self.cnxn.xfer([0x03])[0]
-        # print("FAN_ON: ", hex(b1), b1)
-
+        fan = self.fan_on()
         sleep(1)
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        # print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            # print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a2 = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x07 TO SET FAN ON
-        a = int('0x07', 16)
-        # print("sending ", "{0:08b}".format(a))
-        b2 = self.cnxn.xfer([0x07])[0]
-        # print("LASER_ON: ", hex(b2), b2)
-
-        return True if a1 == 0xF3 and b1 == 0x03 and a2 == 0xF3 and b2 == 0x03 else False
+        laser = self.laser_on()
+        return fan and laser
 
     def off(self):
         """Turn OFF the OPC (fan and laser)
         :rtype: boolean
+        :raises: OPCTimeoutError
         :Example:
         >>> alpha.off()
         True
         """
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        # print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            # print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a1 = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x06 TO SET LASER OFF
-        a = int('0x06', 16)
-        # print("sending ", "{0:08b}".format(a))
-        b1 = self.cnxn.xfer([0x06])[0]
-        # print("LASER_OFF: ", hex(b1), b1)
-
+        laser = self.laser_off()
         sleep(1)
-
-        # SEND COMMAND BYTE 0x03
-        a = self.cnxn.xfer([0x03])[0]
-        # print("CMD: ", hex(a), a)
-        while a is not int('0x31', 16):  # [0xf3]: #49
-            sleep(3)
-            a = self.cnxn.xfer([0x03])[0]
-            print("CMD: ", hex(a), a)
-        sleep(0.02)  # >10ms <100ms
-        a2 = self.cnxn.xfer([0x03])[0]
-        sleep(0.02)
-
-        # SEND 0x02 TO SET FAN OFF
-        a = int('0x02', 16)
-        # print("sending ", "{0:08b}".format(a))
-        b2 = self.cnxn.xfer([0x02])[0]
-        # print("FAN_OFF: ", hex(b2), b2)
-
-        return True if a1 == 0xF3 and b1 == 0x03 and a2 == 0xF3 and b2 == 0x03 else False
+        fan = self.fan_off()
+        return laser and fan
 
     def read_pot_status(self):
         """Read the status of the digital pot. Firmware v18+ only.
@@ -531,17 +458,17 @@ class OPCN3(_OPC):
         resp = []
         data = {}
 
-        # Send the command byte
-        a = 0
-        b = 0
-        arep = int('0x31', 16)
-        brep = int('0xf3', 16)
-        while a is not arep or b is not brep:
+        # Send the command byte, give up after histogram_timeout
+        deadline = monotonic() + self.histogram_timeout
+        a = self.cnxn.xfer([0x30])[0]
+        sleep(0.01)
+        b = self.cnxn.xfer([0x30])[0]
+        while a != 0x31 or b != 0xF3:
+            if monotonic() > deadline:
+                raise OPCTimeoutError("OPC did not answer histogram request, last response: {} {}".format(hex(a), hex(b)))
             a = self.cnxn.xfer([0x30])[0]
-            # print(hex(a), a)
             sleep(0.01)
             b = self.cnxn.xfer([0x30])[0]
-            # print(hex(b), b)
 
         # Wait 20 ms
         sleep(20e-3)
@@ -597,7 +524,7 @@ class OPCN3(_OPC):
 
         # The OPCN3 sometimes gives nan as PM values, most likely a power issue
         if data['PM1'] != data['PM1']:
-            print("Received faulty PM values check OPCN3 power supply")
+            logger.warning("Received faulty PM values check OPCN3 power supply")
 
         data['Reject count Glitch'] = self._16bit_unsigned(resp[72], resp[73])
         data['Reject count LongTOF'] = self._16bit_unsigned(resp[74], resp[75])
@@ -611,8 +538,7 @@ class OPCN3(_OPC):
 
         # Check that calculated checksum and sent checksum are identical
         if calculated_checksum != data['Checksum']:
-            print("CHECKSUM: ", calculated_checksum, data['Checksum'])
-            logger.warning("Data transfer was incomplete")
+            logger.warning("Data transfer was incomplete, checksum: %s received: %s", calculated_checksum, data['Checksum'])
             return None
 
         # If histogram is true, convert histogram values to number concentration
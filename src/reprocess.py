@@ -0,0 +1,232 @@
+from typing import Dict, Any, List, Optional, Tuple
+from types import ModuleType
+import argparse
+import datetime
+import importlib.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import prt
+from averaging import calculate_mean_frame
+from calibration import TwoPointCalibration, compile_calibrations, gas_n_factors
+from opc_psd import ParticleSizeDistribution, BIN_COUNT
+
+# Offline reprocessing of archived *_raw_every_second_data.log files with new calibration parameters.
+# Raw logs are read in chunks and averaged per minute with the same code as the node,
+# so memory use only depends on the chunk size and not on the size of the file.
+# Usage: python reprocess.py --new-config new_config.py --old-config old_config.py -o out_dir logs/*raw*.log*
+
+TIMESTAMP_COLUMNS = ["timestamp", "timestamp_hr", "timestamp_gps"]
+GASES = ["CO", "NO", "NO2", "O3"]
+# columns that are calibrated by the node itself and can only be re-calibrated by inverting the old calibration
+RECALIBRATED_COLUMNS = {
+    "sht_temp": "SHT_CALI_TEMP",
+    "sht_humid": "SHT_CALI_HUMID",
+    "hyt_temp": "HYT_CALI_TEMP",
+    "hyt_humid": "HYT_CALI_HUMID",
+    "heater_temp": "ONE_WIRE_DS_CALI",
+    "air_temp": "ONE_WIRE_DS_CALI",
+}
+# calibrated OPC columns and the raw columns they are derived from
+OPC_CLIMATE_COLUMNS = {
+    "opc_temp": ("RAW_OPC_Temperature", "OPC_CALI_TEMP"),
+    "opc_humid": ("RAW_OPC_Relative humidity", "OPC_CALI_HUMID"),
+}
+# Raw logs store missing values as 0 (see remove_none_from in main.py) while the node skips them when averaging.
+# A sensor is missing in a row if all of its detection columns are 0, then its columns and those starting with
+# its prefix are set to NaN before anything is re-calibrated or averaged.
+# Sensors with a single column can't tell a reading of exactly 0 from a missing one, such readings are dropped as well.
+# (detection columns, columns, prefix)
+MISSING_GROUPS: List[Tuple[List[str], List[str], Optional[str]]] = [
+    # an idle duty cycle window has no histogram but keeps opc_temp and opc_humid, they are checked on their own
+    (["RAW_OPC_Sampling Period", "RAW_OPC_SFR"], ["pm1", "pm25", "pm10", "opc_flow"], "RAW_OPC_"),
+    (["opc_temp", "opc_humid"], [], None),
+    ([f"RAW_ADC_{gas}_{electrode}" for gas in GASES for electrode in ("W", "A")], GASES, "RAW_ADC_"),
+    (["sht_temp", "sht_humid"], [], None),
+    (["hyt_temp", "hyt_humid"], ["RAW_HYT_AGE"], None),
+    (["heater_temp"], [], None),
+    (["air_temp"], [], None),
+    (["lat", "lon"], ["alt"], None),
+    (["rssi"], [], None),
+]
+
+
+def load_config(path: str) -> ModuleType:
+    """Loads a config file with the same variables as config_cloudless.py"""
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Reprocessor:
+    def __init__(self, new_config: ModuleType, old_config: Optional[ModuleType] = None, gas_temp: float = 20) -> None:
+        """
+        :new_config: config module with the corrected calibration parameters
+        :old_config: config module the raw log was recorded with, needed to re-calibrate SHT, HYT and 1-Wire values
+        :gas_temp: temperature used for the gas sensor n factors, the node uses 20 °C
+        """
+        self.digits = new_config.DIGIT_ACCURACY
+        self.cali = compile_calibrations(new_config)
+        self.old_cali = compile_calibrations(old_config) if old_config is not None else None
+        self.n_factors = gas_n_factors(gas_temp)
+        psd_enabled = getattr(new_config, "OPC_PSD_ENABLE", False)
+        self.psd = ParticleSizeDistribution(density=new_config.OPC_PSD_DENSITY) if psd_enabled else None
+
+    @staticmethod
+    def mark_missing(frame: pd.DataFrame) -> pd.DataFrame:
+        """Replaces the 0 the node logs for missing sensor values with NaN, see MISSING_GROUPS"""
+        frame = frame.copy()
+        for detection, columns, prefix in MISSING_GROUPS:
+            if any(column not in frame for column in detection):
+                continue
+            missing = (frame[detection] == 0).all(axis=1)
+            if not missing.any():
+                continue
+            group = detection + [column for column in columns if column in frame]
+            if prefix is not None:
+                group += [column for column in frame.columns if column.startswith(prefix) and column not in group]
+            frame.loc[missing, group] = np.nan
+        return frame
+
+    def _recalibrate_calibrated(self, values: pd.Series, cali_name: str) -> np.ndarray:
+        """Inverts the old calibration of already calibrated values and applies the new one"""
+        old: TwoPointCalibration = self.old_cali[cali_name]
+        # skip rounding to not lose precision between the two steps
+        raw = values.to_numpy(dtype=np.float64) * (1 / old.slope) - old.offset / old.slope
+        return self.cali[cali_name].apply_batch(raw)
+
+    def recalibrate(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """Re-derives every calibrated column that can be derived from the logged raw values"""
+        frame = self.mark_missing(frame)
+        for gas in GASES:
+            w_column, a_column = f"RAW_ADC_{gas}_W", f"RAW_ADC_{gas}_A"
+            if w_column in frame and a_column in frame:
+                frame[gas] = self.cali[f"ADC_CALI_{gas}"].apply_batch(frame[w_column], frame[a_column], self.n_factors[gas])
+        for column, (raw_column, cali_name) in OPC_CLIMATE_COLUMNS.items():
+            if raw_column not in frame or column not in frame:
+                continue
+            # idle duty cycle windows have no raw value, the node logged its last reading there
+            held = frame[column] if self.old_cali is None else self._recalibrate_calibrated(frame[column], cali_name)
+            recalibrated = pd.Series(self.cali[cali_name].apply_batch(frame[raw_column]), index=frame.index)
+            frame[column] = recalibrated.where(frame[raw_column].notna(), held)
+        if self.old_cali is not None:
+            for column, cali_name in RECALIBRATED_COLUMNS.items():
+                if column in frame:
+                    frame[column] = self._recalibrate_calibrated(frame[column], cali_name)
+        return frame
+
+    def psd_data(self, frame: pd.DataFrame) -> Dict[str, float]:
+        """Particle size distribution of one minute from summed bin counts and sample volume, like the node"""
+        bin_columns = [f"RAW_OPC_Bin {i}" for i in range(BIN_COUNT)]
+        if self.psd is None or any(column not in frame for column in bin_columns + ["RAW_OPC_SFR", "RAW_OPC_Sampling Period"]):
+            return {}
+        valid = frame[(frame["RAW_OPC_SFR"] * frame["RAW_OPC_Sampling Period"]) > 0]
+        for counts, sfr, period in zip(valid[bin_columns].to_numpy(), valid["RAW_OPC_SFR"], valid["RAW_OPC_Sampling Period"]):
+            self.psd.add(counts, sfr, period)
+        return self.psd.get_data()
+
+    def average_minute(self, minute: int, frame: pd.DataFrame) -> Optional[Dict[str, Any]]:
+        """The averaged minute like the node would have logged it, None if it could not be averaged"""
+        avg_data = calculate_mean_frame(frame.drop(columns=TIMESTAMP_COLUMNS, errors="ignore"), self.digits)
+        if avg_data is None:
+            return None
+        avg_data.update(self.psd_data(frame))
+        # every_minute runs on the full minute after the averaged seconds were collected
+        avg_data["timestamp"] = minute + 60
+        avg_data["timestamp_hr"] = datetime.datetime.fromtimestamp(minute + 60).strftime("%Y-%m-%d %H:%M:%S")
+        avg_data["timestamp_gps"] = frame["timestamp_gps"].iloc[-1] if "timestamp_gps" in frame else "unknown"
+        return avg_data
+
+    def process_file(self, input_path: str, output_path: str, chunk_size: int = 10000) -> Tuple[str, int, int]:
+        """Streams a raw log file and writes the re-calibrated minute averages, returns (file, rows, minutes)"""
+        rows = 0
+        minutes = 0
+        header_written = False
+        carry = None
+        with open(output_path, "w", newline="") as output:
+            for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+                rows += len(chunk)
+                chunk = self.recalibrate(chunk)
+                if carry is not None:
+                    chunk = pd.concat([carry, chunk], ignore_index=True)
+                minute_keys = (chunk["timestamp"] // 60 * 60).astype(np.int64)
+                # the last minute of a chunk may continue in the next chunk
+                last_minute = minute_keys.iloc[-1]
+                carry = chunk[minute_keys == last_minute]
+                complete = chunk[minute_keys != last_minute]
+                written = self._write_minutes(complete, output, header_written)
+                header_written = header_written or written > 0
+                minutes += written
+            if carry is not None:
+                minutes += self._write_minutes(carry, output, header_written)
+        return input_path, rows, minutes
+
+    def _write_minutes(self, frame: pd.DataFrame, output, header_written: bool) -> int:
+        """Writes the minute averages of frame, returns the number of minutes written, minutes that failed are left out"""
+        if len(frame) == 0:
+            return 0
+        minute_keys = (frame["timestamp"] // 60 * 60).astype(np.int64)
+        averaged = [self.average_minute(minute, group) for minute, group in frame.groupby(minute_keys, sort=True)]
+        averaged = [avg_data for avg_data in averaged if avg_data is not None]
+        if not averaged:
+            return 0
+        pd.DataFrame(averaged).to_csv(output, header=not header_written, index=False)
+        return len(averaged)
+
+
+def output_path_for(input_path: str, output_dir: str) -> str:
+    name = os.path.basename(input_path).replace("_raw_every_second_data.log", "_avg_every_minute_data.log")
+    if name == os.path.basename(input_path):
+        name = "reprocessed_" + name
+    return os.path.join(output_dir, name)
+
+
+def _init_worker() -> None:
+    # averaging reports through the event logger, every worker process needs its own writer thread
+    prt.GLOBAL_ENTITY = prt.EventLogger()
+
+
+def _process_file_job(input_path: str, output_path: str, new_config_path: str, old_config_path: Optional[str],
+                      gas_temp: float, chunk_size: int) -> Tuple[str, int, int]:
+    # runs in a worker process, every worker compiles its own calibrations
+    old_config = load_config(old_config_path) if old_config_path else None
+    reprocessor = Reprocessor(load_config(new_config_path), old_config, gas_temp)
+    try:
+        return reprocessor.process_file(input_path, output_path, chunk_size)
+    finally:
+        prt.GLOBAL_ENTITY.flush()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Re-derive calibrated minute averages from archived raw logs")
+    parser.add_argument("files", nargs="+", help="*_raw_every_second_data.log files")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory for the new avg files")
+    parser.add_argument("--new-config", required=True, help="config file with the corrected calibrations")
+    parser.add_argument("--old-config", help="config file the logs were recorded with, required to re-calibrate SHT/HYT/1-Wire")
+    parser.add_argument("--gas-temp", type=float, default=20, help="temperature for the gas sensor n factors in °C")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows read at once, bounds memory use")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="parallel worker processes")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker) as executor:
+        futures = [
+            executor.submit(_process_file_job, path, output_path_for(path, args.output_dir), args.new_config,
+                            args.old_config, args.gas_temp, args.chunk_size)
+            for path in args.files
+        ]
+        for future in as_completed(futures):
+            try:
+                path, rows, minutes = future.result()
+                print(f"{path}: {rows} rows -> {minutes} minutes")
+            except Exception as e:
+                print(f"Reprocessing failed, dump: {e}")
+    print(f"Reprocessed {len(args.files)} files in {round(time.time() - start, 2)} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import math
+import struct
+from multiprocessing import shared_memory
+
+# Ring of fixed layout per second samples. The acquisition process writes it, the io process reads it, see io_process.py.
+# There is one writer and any number of readers, nobody locks:
+# every slot carries a sequence number that is odd while the writer is inside the slot (a seqlock),
+# a reader copies the slot and only keeps the copy if the sequence number was even and unchanged before and after.
+#
+# header: magic, field count, slot count, samples written so far
+# names:  field names, utf-8, newline separated, NAMES_SIZE bytes
+# slots:  sequence, timestamp, gps timestamp, one float64 per field, None is stored as NaN,
+#         one bit per field set if the value was an int, so the reader gets back the types the sensors returned
+# The modem handlers report the gps timestamp as a float, or the string GPS_UNKNOWN without a fix, that is stored as NaN.
+
+MAGIC = b"AIRRING3"
+HEADER = struct.Struct("<8sIIQ")
+WRITTEN_OFFSET = 16  # offset of the samples written counter in the header
+WRITTEN = struct.Struct("<Q")
+NAMES_SIZE = 4096
+SEQUENCE = struct.Struct("<Q")
+SLOT_HEADER = struct.Struct("<Qdd")  # sequence, timestamp, gps timestamp
+DATA_OFFSET = HEADER.size + NAMES_SIZE
+GPS_UNKNOWN = "unknown"
+
+# (timestamp, gps timestamp, data) of one sample
+Sample = Tuple[float, Union[float, str], Dict[str, Optional[Union[int, float]]]]
+
+
+def int_mask_size(field_count: int) -> int:
+    return (field_count + 7) // 8
+
+
+def ring_size(field_count: int, slots: int) -> int:
+    """Bytes needed for a ring of slots samples with field_count values each"""
+    return DATA_OFFSET + slots * (SLOT_HEADER.size + 8 * field_count + int_mask_size(field_count))
+
+
+class SampleRing:
+    """
+    Sample ring on top of any writable buffer, shared memory here and a memory mapped file for other containers.
+    Pass fields and slots to lay out a new ring, leave them out to read the layout of an existing one.
+    """
+    def __init__(self, buf: memoryview, fields: Optional[List[str]] = None, slots: int = 0) -> None:
+        self.buf = buf
+        if fields is not None:
+            names = "\n".join(fields).encode()
+            if len(names) > NAMES_SIZE:
+                raise ValueError(f"Field names need {len(names)} bytes, the ring has room for {NAMES_SIZE}")
+            HEADER.pack_into(buf, 0, MAGIC, len(fields), slots, 0)
+            struct.pack_into(f"{NAMES_SIZE}s", buf, HEADER.size, names)
+        magic, field_count, self.slots, self.written = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Buffer does not contain a sample ring")
+        names = struct.unpack_from(f"{NAMES_SIZE}s", buf, HEADER.size)[0].rstrip(b"\0").decode()
+        self.fields = names.split("\n") if field_count else []
+        self.values = struct.Struct(f"<{field_count}d")
+        self.int_mask = struct.Struct(f"<{int_mask_size(field_count)}s")
+        self.slot_size = SLOT_HEADER.size + self.values.size + self.int_mask.size
+        self.next = self.written  # next sample to read, readers start at the latest one
+        self.lost = 0  # samples overwritten or being written before they were read
+
+    def _slot_offset(self, number: int) -> int:
+        return DATA_OFFSET + (number % self.slots) * self.slot_size
+
+    def get_written(self) -> int:
+        return WRITTEN.unpack_from(self.buf, WRITTEN_OFFSET)[0]
+
+    def write(self, timestamp: float, gps_timestamp: Union[float, str], data: Dict[str, Any]) -> None:
+        """Appends a sample, values of keys that are not in the layout are dropped"""
+        values = []
+        int_mask = bytearray(self.int_mask.size)
+        for index, field in enumerate(self.fields):
+            value = data.get(field)
+            values.append(math.nan if value is None else float(value))
+            if isinstance(value, int):
+                int_mask[index // 8] |= 1 << index % 8
+        gps_value = float(gps_timestamp) if isinstance(gps_timestamp, (int, float)) else math.nan
+        offset = self._slot_offset(self.written)
+        sequence = 2 * self.written + 1
+        SEQUENCE.pack_into(self.buf, offset, sequence)  # odd, readers skip the slot until it is complete
+        SLOT_HEADER.pack_into(self.buf, offset, sequence, timestamp, gps_value)
+        self.values.pack_into(self.buf, offset + SLOT_HEADER.size, *values)
+        self.int_mask.pack_into(self.buf, offset + SLOT_HEADER.size + self.values.size, bytes(int_mask))
+        SEQUENCE.pack_into(self.buf, offset, sequence + 1)
+        self.written += 1
+        WRITTEN.pack_into(self.buf, WRITTEN_OFFSET, self.written)
+
+    def read(self, number: int) -> Optional[Sample]:
+        """The sample with the given number, None if it is not written yet, being written or already overwritten"""
+        offset = self._slot_offset(number)
+        sequence = 2 * number + 2
+        header = SLOT_HEADER.unpack_from(self.buf, offset)
+        if header[0] != sequence:
+            return None
+        values = self.values.unpack_from(self.buf, offset + SLOT_HEADER.size)
+        int_mask = self.int_mask.unpack_from(self.buf, offset + SLOT_HEADER.size + self.values.size)[0]
+        if SEQUENCE.unpack_from(self.buf, offset)[0] != sequence:
+            return None
+        data = {}
+        for index, (field, value) in enumerate(zip(self.fields, values)):
+            if math.isnan(value):
+                data[field] = None
+            elif int_mask[index // 8] >> index % 8 & 1:
+                data[field] = int(value)
+            else:
+                data[field] = value
+        return header[1], GPS_UNKNOWN if math.isnan(header[2]) else header[2], data
+
+    def read_new(self) -> Iterator[Sample]:
+        """The samples written since the last call, oldest first, counts those it was too slow for in lost"""
+        written = self.get_written()
+        if written - self.next > self.slots:
+            self.lost += written - self.slots - self.next
+            self.next = written - self.slots
+        while self.next < written:
+            sample = self.read(self.next)
+            self.next += 1
+            if sample is None:
+                self.lost += 1
+                continue
+            yield sample
+
+    def read_latest(self, count: int = 1) -> List[Sample]:
+        """Up to count of the latest samples, oldest first"""
+        written = self.get_written()
+        samples = (self.read(number) for number in range(max(written - min(count, self.slots), 0), written))
+        return [sample for sample in samples if sample is not None]
+
+    def release(self) -> None:
+        self.buf.release()
+
+
+class SharedSampleRing(SampleRing):
+    """Sample ring in a multiprocessing shared memory block, created by the writer and attached to by name"""
+    def __init__(self, name: Optional[str] = None, fields: Optional[List[str]] = None, slots: int = 0) -> None:
+        if fields is not None:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=ring_size(len(fields), slots))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = fields is not None
+        super().__init__(self.shm.buf, fields, slots)
+
+    def close(self) -> None:
+        self.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -1,43 +1,86 @@
-from typing import Dict, Optional
+from typing import Dict, Any, List, Optional, Tuple
+import threading
 import time
 from Adafruit_SHT31 import SHT31
+from smbus2 import SMBus, i2c_msg
 import prt
 import config
 from generic_sensor import SensorBase
+from calibration import TwoPointCalibration
+from i2c_arbiter import SENSOR_BUS, get_arbiter
+
+# SHT3x commands used by the periodic mode
+SHT_CMD_BREAK = 0x3093  # stops the periodic mode, only fetch, ART, break and soft reset are accepted while it runs
+SHT_CMD_FETCH = 0xE000
+SHT_CMD_HEATER_ON = 0x306D
+SHT_CMD_HEATER_OFF = 0x3066
+SHT_CMD_ART = 0x2B32  # accelerated response time, 4 measurements per second
+# single shot measurement with high repeatability and without clock stretching, so the SHT does not hold the bus
+# while it converts, reading before the conversion finished is NACKed
+SHT_CMD_SINGLE_SHOT = 0x2400
+SHT_SINGLE_SHOT_TIME = 0.016  # max conversion time of a high repeatability measurement
+# periodic measurement commands with high repeatability by measurements per second
+SHT_CMD_PERIODIC = {
+    0.5: 0x2032,
+    1: 0x2130,
+    2: 0x2236,
+    4: 0x2334,
+    10: 0x2737,
+}
 
 
 class SHTHandler(SensorBase):
     def __init__(self):
         super().__init__()
-        self.sensor = SHT31(address=config.SHT_ADDRESS)
+        self.i2c = get_arbiter()
         self.counter = 0
+        self.cali_humid = TwoPointCalibration.from_dict(config.SHT_CALI_HUMID)
+        self.cali_temp = TwoPointCalibration.from_dict(config.SHT_CALI_TEMP)
+        self.periodic = config.SHT_MODE == "periodic"
+        if self.periodic:
+            self._init_periodic()
+        else:
+            self.bus = SMBus(SENSOR_BUS)
+            self.sensor = SHT31(address=config.SHT_ADDRESS)
+            # single shot measurements are taken by get_data itself, the sensor answered if the constructor did not fail
+            self._set_ready()
 
     def _handle_heater(self) -> None:
         if self.counter == 0:
             # Turn off heater if it was enabled on the last call of getData()
-            self.sensor.set_heater(False)
+            self.i2c.transaction("sht", self.sensor.set_heater, False)
 
         self.counter += 1
 
         # Heat every 20 seconds for 1 second to remove condensation from the sensor
         if self.counter >= 20:
             # print("Heating SHT for 1 second")
-            self.sensor.set_heater(True)
+            self.i2c.transaction("sht", self.sensor.set_heater, True)
             self.counter = 0
 
     def get_data(self) -> Dict[str, Optional[float]]:
+        if self.periodic:
+            return self._get_periodic_data()
         try:
             if config.SHT_HEATER_ENABLE:
                 self._handle_heater()
             else:
-                self.sensor.set_heater(False)
-            time.sleep(0.01)  # If we don't wait here, i2c fails for some reason
+                self.i2c.transaction("sht", self.sensor.set_heater, False)
+            time.sleep(0.01)  # The SHT needs a pause between commands, the bus is free for other devices meanwhile
 
-            (temp, humid) = self.sensor.read_temperature_humidity()
+            # Command and read are separate transactions, the bus is free for other devices during the conversion
+            self._command(SHT_CMD_SINGLE_SHOT)
+            time.sleep(SHT_SINGLE_SHOT_TIME)
+            read = i2c_msg.read(config.SHT_ADDRESS, 6)
+            self.i2c.transaction("sht", self.bus.i2c_rdwr, read)
+            measurement = self._decode(list(read))
+            if measurement is None:
+                raise OSError("SHT checksum mismatch")
+            (temp, humid) = measurement
 
             # Apply two point calibration
-            humid = self._calibrate(humid, config.SHT_CALI_HUMID)
-            temp = self._calibrate(temp, config.SHT_CALI_TEMP)
+            humid = self.cali_humid(humid)
+            temp = self.cali_temp(temp)
 
             return {"sht_humid": humid, "sht_temp": temp}
 
@@ -45,5 +88,147 @@ class SHTHandler(SensorBase):
             prt.GLOBAL_ENTITY.print_once("SHT disconnected", "SHT back online")
             return {"sht_humid": None, "sht_temp": None}
 
+    ### Periodic mode ###
+    # The SHT measures on its own at SHT_PERIODIC_MPS and a worker fetches the results with one transaction each.
+    # The heater runs in scheduled cycles, samples taken while heating or cooling down are discarded and flagged.
+
+    def _init_periodic(self) -> None:
+        self.bus = SMBus(SENSOR_BUS)
+        if str(config.SHT_PERIODIC_MPS).lower() == "art":
+            self.measure_command = SHT_CMD_ART
+            self.interval = 0.25
+        else:
+            mps = float(config.SHT_PERIODIC_MPS)
+            self.measure_command = SHT_CMD_PERIODIC[mps]
+            self.interval = 1 / mps
+        self.humidity: Optional[float] = None
+        self.temperature: Optional[float] = None
+        self.sample_time = time.monotonic()
+        self.heated = False
+        self.heating_until = 0.
+        self.settle_until = 0.
+        self.next_heating = time.monotonic() + config.SHT_HEATER_INTERVAL
+        self.fetch_misses = 0
+        self.running = True
+        # samples are held through a heater cycle, so the latest one may be this old without the sensor failing
+        self.max_sample_age = max(5 * self.interval, 5)
+        if config.SHT_HEATER_ENABLE:
+            self.max_sample_age += config.SHT_HEATER_DURATION + config.SHT_HEATER_SETTLE
+
+        self._restart_periodic(heater=False)
+        self.thread = threading.Thread(target=self._sht_worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _command(self, command: int) -> None:
+        self.i2c.transaction("sht", self.bus.i2c_rdwr, i2c_msg.write(config.SHT_ADDRESS, [command >> 8, command & 0xFF]))
+
+    def _restart_periodic(self, heater: bool) -> None:
+        # Heater commands are not accepted in periodic mode, so stop it, switch the heater and start it again
+        self._command(SHT_CMD_BREAK)
+        time.sleep(0.001)
+        self._command(SHT_CMD_HEATER_ON if heater else SHT_CMD_HEATER_OFF)
+        time.sleep(0.001)
+        self._command(self.measure_command)
+
+    @staticmethod
+    def _crc8(data: List[int]) -> int:
+        crc = 0xFF
+        for byte in data:
+            crc ^= byte
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        return crc
+
+    def _decode(self, data: List[int]) -> Optional[Tuple[float, float]]:
+        """(temperature, humidity) of a 6 byte measurement, None if a checksum does not match"""
+        if self._crc8(data[0:2]) != data[2] or self._crc8(data[3:5]) != data[5]:
+            return None
+        temp = -45 + (175 * (data[0] << 8 | data[1]) / 65535)
+        humid = 100 * (data[3] << 8 | data[4]) / 65535
+        return temp, humid
+
+    def _fetch(self) -> bool:
+        """Reads the latest measurement, returns False if the sensor had no new one"""
+        write = i2c_msg.write(config.SHT_ADDRESS, [SHT_CMD_FETCH >> 8, SHT_CMD_FETCH & 0xFF])
+        read = i2c_msg.read(config.SHT_ADDRESS, 6)
+        try:
+            # no retries, the SHT NACKs the read if there is no new measurement yet
+            with self.i2c.claim("sht"):
+                self.bus.i2c_rdwr(write, read)
+        except OSError:
+            self.fetch_misses += 1
+            return False
+        measurement = self._decode(list(read))
+        if measurement is None:
+            self.fetch_misses += 1
+            return False
+        if time.monotonic() < self.settle_until:
+            # affected by the heater, keep the last unaffected sample
+            return True
+        (temp, humid) = measurement
+        self.temperature = self.cali_temp(temp)
+        self.humidity = self.cali_humid(humid)
+        self.sample_time = time.monotonic()
+        self._set_ready()
+        return True
+
+    def _handle_heater_cycle(self, now: float) -> None:
+        if not config.SHT_HEATER_ENABLE:
+            return
+        if self.heating_until == 0 and now >= self.next_heating:
+            self._restart_periodic(heater=True)
+            self.heating_until = now + config.SHT_HEATER_DURATION
+            self.settle_until = self.heating_until + config.SHT_HEATER_SETTLE
+        elif self.heating_until != 0 and now >= self.heating_until:
+            self._restart_periodic(heater=False)
+            self.heating_until = 0
+            self.next_heating = now + config.SHT_HEATER_INTERVAL
+        self.heated = now < self.settle_until
+
+    def _sht_worker(self) -> None:
+        next_fetch = time.monotonic() + self.interval
+        while self.running:
+            delay = next_fetch - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_fetch = max(next_fetch + self.interval, time.monotonic())
+            try:
+                self._handle_heater_cycle(time.monotonic())
+                self._fetch()
+            except OSError:
+                self.fetch_misses += 1
+                time.sleep(0.5)
+                try:
+                    # the sensor may have been power cycled and left the periodic mode
+                    self._restart_periodic(heater=self.heating_until != 0)
+                except OSError:
+                    pass
+
+    def _get_periodic_data(self) -> Dict[str, Any]:
+        sample_age = time.monotonic() - self.sample_time
+        # consider the sensor disconnected if it did not deliver for a few measurement periods
+        if self.humidity is None or sample_age > self.max_sample_age:
+            prt.GLOBAL_ENTITY.print_once("SHT disconnected", "SHT back online")
+            return {"sht_humid": None, "sht_temp": None, "RAW_SHT_AGE": None, "RAW_SHT_HEATED": int(self.heated)}
+        return {
+            "sht_humid": self.humidity,
+            "sht_temp": self.temperature,
+            "RAW_SHT_AGE": round(sample_age, config.DIGIT_ACCURACY),
+            "RAW_SHT_HEATED": int(self.heated),
+        }
+
+    def get_telemetry(self) -> Dict[str, int]:
+        return {"sht_fetch_misses": self.fetch_misses} if self.periodic else {}
+
     def stop(self) -> None:
-        self.sensor.set_heater(False)
+        if not self.periodic:
+            self.i2c.transaction("sht", self.sensor.set_heater, False)
+            self.bus.close()
+            return
+        self.running = False
+        self.thread.join(timeout=1)
+        self._command(SHT_CMD_BREAK)
+        time.sleep(0.001)
+        self._command(SHT_CMD_HEATER_OFF)
+        self.bus.close()
@@ -1,8 +1,12 @@
 import datetime
 import os
+import time
 import psutil
 import prt
 
+# network interfaces of the supported modems, the first one that exists is used
+WWAN_DEVICES = ['wwan0', 'wwp1s0u1u1i5', 'wwp1s0u1u3i5', 'wwp1s0u1u4i5', 'ppp0']
+
 
 def get_cpu_temp():
     try:
@@ -29,6 +33,14 @@ def get_uptime():
         return 0
 
 
+def get_process_age():
+    """Seconds since this process was started, including the interpreter startup and all imports"""
+    try:
+        return time.time() - psutil.Process().create_time()
+    except Exception:
+        return 0
+
+
 def get_disk_usage():
     try:
         return psutil.disk_usage('/').percent
@@ -48,14 +60,22 @@ def get_usb_drive_usage():
         return 0
 
 
+def get_wwan_counters():
+    """(bytes_sent, bytes_recv) of the first modem network interface found, None if there is none"""
+    try:
+        netio = psutil.net_io_counters(pernic=True)
+    except Exception:
+        return None
+    for device in WWAN_DEVICES:
+        if device in netio:
+            return netio[device].bytes_sent, netio[device].bytes_recv
+    return None
+
+
 def get_total_data_usage():
-    for device in ['wwan0', 'wwp1s0u1u1i5', 'wwp1s0u1u3i5', 'wwp1s0u1u4i5', 'ppp0']:
-        try:
-            netio = psutil.net_io_counters(pernic=True)
-            net_usage = netio[device].bytes_sent + netio[device].bytes_recv
-            return round(net_usage / 1000000, 2)
-        except Exception:
-            pass
+    counters = get_wwan_counters()
+    if counters is not None:
+        return round(sum(counters) / 1000000, 2)
     prt.GLOBAL_ENTITY.print_once("Failed to fetch data usage", "Successfully fetching data usage again", 62)
     return 0
 